@@ -1,325 +1,1121 @@
 # treeb/app.py
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
 from pathlib import Path
-from typing import Optional, List  # Optional for type hints, List might be needed for older 3.9 versions if list[] fails
+from typing import Iterable, Iterator, Optional, List, Tuple, Union  # Optional for type hints, List might be needed for older 3.9 versions if list[] fails
+import cProfile
+import functools
 import json
 import os
-import tiktoken
-
-# --- Attempt to import tkinter and set a flag ---
-TKINTER_AVAILABLE = False
-TKINTER_IMPORT_ERROR_MESSAGE = ""
-try:
-    from tkinter import Tk, filedialog
-    _test_root = Tk()
-    _test_root.withdraw()
-    _test_root.destroy()
-    TKINTER_AVAILABLE = True
-except ImportError as e:
-    TKINTER_IMPORT_ERROR_MESSAGE = f"Python 'tkinter' module not found. Directory Browse feature will be disabled. Please install python3-tk (or equivalent for your OS). Error: {e}"
-    print(f"WARNING: {TKINTER_IMPORT_ERROR_MESSAGE}")
-except Exception as e:
-    # This can catch _tkinter.TclError: couldn't connect to display
-    TKINTER_IMPORT_ERROR_MESSAGE = f"Could not initialize tkinter (e.g., no display available or other TclError: {e}). Directory Browse feature will be disabled."
-    print(f"WARNING: {TKINTER_IMPORT_ERROR_MESSAGE}")
+import threading
+import time
+
+STARTUP_BEGAN = time.perf_counter()  # Before the imports below: time-to-first-request includes them
+
+from treeb.classify import DEFAULT_MAX_FILE_BYTES, DEFAULT_MAX_TOTAL_BYTES, ReadLimits
+from treeb.estimate import iter_estimate
+from treeb.exclusions import ExclusionMatcher, get_exclusion_matcher
+from treeb.flatten import (
+    TIKTOKEN_ENCODING_NAME,
+    Flattener,
+    FlattenPlan,
+    Segment,
+    load_encodings,
+    plan_flatten,
+)
+from treeb.gitsource import DEFAULT_BLOB_CACHE_BYTES, GitRepositories, GitRevision
+from treeb.ignorefiles import DirIgnoreContext, IgnoreFileRules
+from treeb.ingest import DEFAULT_CHUNK_BYTES, DEFAULT_MMAP_THRESHOLD_BYTES
+from treeb.jobs import (
+    DEFAULT_ABANDON_SECONDS,
+    DEFAULT_JOB_WORKERS,
+    DEFAULT_MAX_QUEUED_JOBS,
+    DEFAULT_RESULT_TTL_SECONDS,
+    FlattenJob,
+    FlattenJobs,
+    QueueFull,
+)
+from treeb.lazy import BackgroundLoader
+from treeb.listing import DirectoryListingCache, ListedEntry, ListingPage, page_listing
+from treeb.metrics import MetricsRegistry, RequestTrace, count, current_trace, span, tracing
+from treeb.packing import DEFAULT_PRIORITY_POLICY, PackingDecision
+from treeb.presets import (
+    APP_ROOT,
+    DEFAULT_EXCLUSION_PRESETS_DIR,
+    DEFAULT_SELECTION_PRESETS_DIR,
+    EXCLUSION_PRESET_BASE_DIR,
+    PRESET_BASE_DIR,
+    RESULT_CACHE_DIR,
+    SELECTION_PRESET_BASE_DIR,
+    SNAPSHOTS_DIR,
+    SYSTEM_DEFAULTS_FILE,
+    TOKEN_CACHE_DB_PATH,
+    USER_SELECTION_PRESETS_DIR,
+    default_exclusion_rules,
+    find_selection_preset,
+    get_selection_preset_path,
+    load_selection_preset,
+    read_exclusion_rules,
+    save_selection_preset,
+    selection_preset_ids,
+)
+from treeb.resultcache import DEFAULT_MAX_CACHE_BYTES, CachedFlatten, ResultCache, selection_fingerprint
+from treeb.search import (
+    DEFAULT_CONTENT_LIMITS,
+    DEFAULT_CONTENT_REFRESH_SECONDS,
+    DEFAULT_MAX_INDEXES,
+    DEFAULT_MAX_RESULTS,
+    DEFAULT_REFRESH_SECONDS,
+    SearchIndex,
+    SearchIndexes,
+)
+from treeb.selection import Selection, parse_selection
+from treeb.snapshots import (
+    DEFAULT_KEEP_SNAPSHOTS,
+    DIFF_FORMATS,
+    FileChanges,
+    SNAPSHOT_MANIFEST,
+    SNAPSHOT_MODES,
+    SNAPSHOT_TEXTS,
+    Manifest,
+    SnapshotStore,
+    build_manifest,
+    compare_manifests,
+    iter_change_segments,
+    new_snapshot_id,
+    with_token_counts,
+)
+from treeb.tokencache import TokenCountCache
+from treeb.tokenizers import TokenCounts, encodings_to_count, model_token_count, reference_encoding, validate_tokenizer
+from treeb.warm import DEFAULT_WARM_INTERVAL_SECONDS, PresetWarmer
+
+# --- tkinter (Directory Browse) ---
+# Probed on a background thread: creating a Tk root can stall for a long time on a headless machine
+def probe_tkinter() -> Tuple[bool, str]:
+    """(available, error message) for the Directory Browse dialog."""
+    try:
+        from tkinter import Tk
+
+        test_root = Tk()
+        test_root.withdraw()
+        test_root.destroy()
+        return True, ""
+    except ImportError as e:
+        message = f"Python 'tkinter' module not found. Directory Browse feature will be disabled. Please install python3-tk (or equivalent for your OS). Error: {e}"
+    except Exception as e:
+        # This can catch _tkinter.TclError: couldn't connect to display
+        message = f"Could not initialize tkinter (e.g., no display available or other TclError: {e}). Directory Browse feature will be disabled."
+    print(f"WARNING: {message}")
+    return False, message
+
+
+TKINTER_PROBE = BackgroundLoader("tkinter-probe", probe_tkinter)
+TKINTER_PROBE_TIMEOUT_SECONDS = float(os.environ.get("TREEB_TKINTER_PROBE_TIMEOUT", 10))
 
 app = Flask(__name__)
 
 # --- Configuration ---
-APP_ROOT = Path(__file__).resolve().parent
 INITIAL_ROOT_DIR = APP_ROOT
 
-# --- Preset Directory Configuration ---
-PRESET_BASE_DIR = APP_ROOT / "presets"
 
-SELECTION_PRESET_BASE_DIR = PRESET_BASE_DIR / "selections"
-DEFAULT_SELECTION_PRESETS_DIR = SELECTION_PRESET_BASE_DIR / "default"
-USER_SELECTION_PRESETS_DIR = PRESET_BASE_DIR / "user"  # Corrected from PRESET_BASE_DIR to USER_SELECTION_PRESETS_DIR
+def create_default_selection_preset(preset_name: str, relative_paths_to_store: List[str]):
+    preset_file = DEFAULT_SELECTION_PRESETS_DIR / f"{preset_name}.json"
 
-EXCLUSION_PRESET_BASE_DIR = PRESET_BASE_DIR / "exclusions"
-DEFAULT_EXCLUSION_PRESETS_DIR = EXCLUSION_PRESET_BASE_DIR / "default"
+    # Special handling for the "default" preset to ensure it exists, possibly empty
+    if preset_name == "default" and not preset_file.exists():
+        try:
+            preset_file.parent.mkdir(parents=True, exist_ok=True)
+            # Create it empty if paths are not provided or not valid for "default"
+            preset_file.write_text(
+                json.dumps(relative_paths_to_store if relative_paths_to_store else [], indent=2), encoding="utf-8"
+            )
+            app.logger.info(f"Created empty default selection preset: {preset_file.name}")
+        except Exception as e:
+            app.logger.error(f"Could not create empty default preset {preset_file.name}: {e}")
+        return  # Exit after creating the 'default' preset
+
+    # For other default presets (if any in future) or if 'default' exists and we want to populate it (though current logic creates it empty above)
+    verified_paths_to_store = []
+    for rel_path_str in relative_paths_to_store:
+        abs_path = (APP_ROOT / Path(rel_path_str)).resolve()  # Paths are relative to APP_ROOT
+        if abs_path.exists():
+            verified_paths_to_store.append(rel_path_str)  # Store the original relative string
+        else:
+            app.logger.warning(
+                f"Default preset '{preset_name}': path '{rel_path_str}' not found relative to APP_ROOT. Skipping."
+            )
 
-# Create necessary preset directories
-for p_dir in [
-    PRESET_BASE_DIR,
-    SELECTION_PRESET_BASE_DIR,
-    DEFAULT_SELECTION_PRESETS_DIR,
-    USER_SELECTION_PRESETS_DIR,
-    EXCLUSION_PRESET_BASE_DIR,
-    DEFAULT_EXCLUSION_PRESETS_DIR,
-]:
-    p_dir.mkdir(exist_ok=True)
-
-# --- Default Exclusion Data (Master Definition for system_defaults.json) ---
-class DefaultExclusionData:
-    DIRS = [
-        # General
-        ".git",
-        ".venv",
-        "venv",
-        ".env",
-        "env",
-        "node_modules",
-        ".next",
-        "__pycache__",
-        ".pytest_cache",
-        ".mypy_cache",
-        "build",
-        "dist",
-        "target",
-        "out",
-        "site",
-        ".vscode",
-        ".idea",
-        # CI/CD & Docs
-        ".gitlab-ci-local",   # NEW
-        "_docs",              # NEW
-        # Flutter
-        ".dart_tool",
-        "Pods",
-        ".gradle",
-        "DerivedData",
-        ".pub-cache",
-        ".pub",
-        ".generated",
-        "bin",
-        "gen",
-        "proguard",
-        "captures",
-        ".navigation",
-        ".externalNativeBuild",
-        "freeline",
-        "cmake-build-debug",
-        "cmake-build-release",
-        "doc/api",
-        # Svelte (4 and 5)
-        ".svelte-kit",        # already existed, left for clarity
-        "bower_components",
-        ".grunt",
-        ".nuxt",
-        ".vuepress",
-        ".docusaurus",
-        ".serverless",
-        ".vitepress",
-        ".temp",
-        "coverage",
-    ]
-    FILES = [
-        # unchanged ...
-    ]
-    PATTERNS = [
-        # unchanged ...
-    ]
+    if not preset_file.exists() and verified_paths_to_store:  # Only create if it doesn't exist AND there's something to save
+        try:
+            preset_file.parent.mkdir(parents=True, exist_ok=True)
+            preset_file.write_text(json.dumps(verified_paths_to_store, indent=2), encoding="utf-8")
+            app.logger.info(
+                f"Created default selection preset: {preset_file.name} with {len(verified_paths_to_store)} items."
+            )
+        except Exception as e:
+            app.logger.error(f"Could not create default preset {preset_file.name}: {e}")
+    elif preset_file.exists() and verified_paths_to_store:  # If it exists, don't overwrite from this function, admin should manage it.
+        app.logger.info(
+            f"Default selection preset '{preset_file.name}' already exists. Not overwriting with verified paths."
+        )
+    elif not preset_file.exists() and not verified_paths_to_store and preset_name != "default":  # Don't create if no valid paths unless it's the special "default"
+        app.logger.info(f"Default selection preset '{preset_name}' not created as no verified paths were provided.")
 
 
 # --- Function to Load Initial Active Exclusions ---
 def load_or_create_initial_exclusions() -> dict:
-    default_exclusion_file_path = DEFAULT_EXCLUSION_PRESETS_DIR / "system_defaults.json"
-    rules_from_code = {
-        "description": "System default exclusions (source: app.py DefaultExclusionData). Applied at startup.",
-        "dirs": list(DefaultExclusionData.DIRS),
-        "files": list(DefaultExclusionData.FILES),
-        "patterns": list(DefaultExclusionData.PATTERNS),
-    }
+    loaded_rules = read_exclusion_rules(SYSTEM_DEFAULTS_FILE)
+    if loaded_rules is not None:
+        app.logger.info(f"Loaded active exclusion rules from {SYSTEM_DEFAULTS_FILE}")
+        return loaded_rules
 
-    if default_exclusion_file_path.exists():
-        try:
-            with open(default_exclusion_file_path, "r", encoding="utf-8") as f:
-                loaded_rules = json.load(f)
-            if all(key in loaded_rules for key in ["description", "dirs", "files", "patterns"]) and isinstance(
-                loaded_rules["dirs"], list
-            ) and isinstance(loaded_rules["files"], list) and isinstance(loaded_rules["patterns"], list):
-                app.logger.info(f"Loaded active exclusion rules from {default_exclusion_file_path}")
-                return loaded_rules
-            else:
-                app.logger.warning(
-                    f"File {default_exclusion_file_path} has invalid structure. Using internal defaults and attempting to recreate file."
-                )
-        except Exception as e:
-            app.logger.error(
-                f"Error loading {default_exclusion_file_path}: {e}. Using internal defaults and attempting to recreate file."
-            )
-
-    app.logger.info(
-        f"Using internal DefaultExclusionData. Creating/overwriting {default_exclusion_file_path} for user reference."
-    )
+    rules_from_code = default_exclusion_rules()
+    app.logger.info(f"Using internal DefaultExclusionData. Creating/overwriting {SYSTEM_DEFAULTS_FILE} for user reference.")
     try:
         DEFAULT_EXCLUSION_PRESETS_DIR.mkdir(parents=True, exist_ok=True)
-        with open(default_exclusion_file_path, "w", encoding="utf-8") as f:
+        with open(SYSTEM_DEFAULTS_FILE, "w", encoding="utf-8") as f:
             json.dump(rules_from_code, f, indent=2)
-        app.logger.info(f"Created/Updated default exclusion file: {default_exclusion_file_path}")
+        app.logger.info(f"Created/Updated default exclusion file: {SYSTEM_DEFAULTS_FILE}")
     except Exception as e:
-        app.logger.error(f"Could not create/update default exclusion file {default_exclusion_file_path}: {e}")
+        app.logger.error(f"Could not create/update default exclusion file {SYSTEM_DEFAULTS_FILE}: {e}")
     return rules_from_code
 
 
-ACTIVE_EXCLUSION_RULES = load_or_create_initial_exclusions()
+def bootstrap_presets() -> dict:
+    """Create the preset directories, system_defaults.json and the "default" selection preset; returns the active exclusion rules."""
+    for p_dir in [
+        PRESET_BASE_DIR,
+        SELECTION_PRESET_BASE_DIR,
+        DEFAULT_SELECTION_PRESETS_DIR,
+        USER_SELECTION_PRESETS_DIR,
+        EXCLUSION_PRESET_BASE_DIR,
+        DEFAULT_EXCLUSION_PRESETS_DIR,
+    ]:
+        try:
+            p_dir.mkdir(exist_ok=True)
+        except OSError as e:
+            app.logger.error(f"Could not create preset directory {p_dir}: {e}")
+    rules = load_or_create_initial_exclusions()
+    # Ensure a "default.json" selection preset exists (can be empty)
+    create_default_selection_preset("default", [])
+    # Example of creating another default preset if needed:
+    # create_default_selection_preset("my_app_core_files", ["app.py", "static/js/main.js", "templates/index.html"])
+    return rules
+
+
+# Bootstrapped on first use (or in the background when the server starts) rather than at import
+PRESETS_BOOTSTRAP = BackgroundLoader("presets", bootstrap_presets)
+
+
+def active_exclusion_rules() -> dict:
+    return PRESETS_BOOTSTRAP.get()
 
 
 # --- Tiktoken Configuration & LLM Context ---
-TIKTOKEN_ENCODING_NAME = "cl100k_base"
-ENCODING = None
-try:
-    ENCODING = tiktoken.get_encoding(TIKTOKEN_ENCODING_NAME)
-    app.logger.info(f"Successfully loaded tiktoken encoding: {TIKTOKEN_ENCODING_NAME}")
-except Exception as e:
-    app.logger.error(f"Could not load tiktoken encoding '{TIKTOKEN_ENCODING_NAME}': {e}.")
+def load_warm_encodings() -> dict:
+    """ENCODING_LOADER's job: load the BPE ranks of every encoding counted (TIKTOKEN_ENCODING_NAME first) and run
+    one encode with each, so the first count pays for neither."""
+    encodings = load_encodings(encodings_to_count([TIKTOKEN_ENCODING_NAME] + [m["tokenizer"] for m in MODEL_CONTEXT_INFO]))
+    for encoding in encodings.values():
+        encoding.encode_ordinary("def warm_up():\n    return 'treeb'\n")
+    return encodings
+
+
+# Loaded on a background thread; only requests that count tokens wait for it (/api/tree never does)
+ENCODING_LOADER = BackgroundLoader("tiktoken", load_warm_encodings)
+
+
+def loaded_encodings() -> dict:
+    """The tiktoken encodings that could be loaded, by name, waiting for the background load if it is still running."""
+    return ENCODING_LOADER.get()
+
+
+def current_encoding():
+    """The encoding of the output's token count (None if unavailable); budgets and shards without a model use it too."""
+    return loaded_encodings().get(TIKTOKEN_ENCODING_NAME)
+
+
+# "tokenizer" is a tiktoken encoding, or a treeb.tokenizers estimator for models without a local tokenizer
 MODEL_CONTEXT_INFO = [
-    {"id": "gpt4o", "displayName": "4o", "window": 128000},
-    {"id": "claude3o", "displayName": "o3", "window": 200000},
-    {"id": "gemini25pro", "displayName": "G2.5", "window": 1048576},
-    {"id": "grok3", "displayName": "G3", "window": 1000000},
-    {"id": "grok4", "displayName": "G4", "window": 256000},
-    {"id": "gpt41", "displayName": "4.1", "window": 32768},
+    {"id": "gpt4o", "displayName": "4o", "window": 128000, "tokenizer": "o200k_base"},
+    {"id": "claude3o", "displayName": "o3", "window": 200000, "tokenizer": "estimate:claude"},
+    {"id": "gemini25pro", "displayName": "G2.5", "window": 1048576, "tokenizer": "estimate:gemini"},
+    {"id": "grok3", "displayName": "G3", "window": 1000000, "tokenizer": "estimate:grok"},
+    {"id": "grok4", "displayName": "G4", "window": 256000, "tokenizer": "estimate:grok"},
+    {"id": "gpt41", "displayName": "4.1", "window": 32768, "tokenizer": "o200k_base"},
 ]
+for _model in MODEL_CONTEXT_INFO:
+    validate_tokenizer(_model["tokenizer"])
+
+# Per-file token counts survive restarts (see TOKEN_CACHE_DB_PATH), so Generate only re-tokenizes files that changed
+TOKEN_CACHE = TokenCountCache(TOKEN_CACHE_DB_PATH)
+
+# Flatten pipeline: files are read on FLATTEN_READER_WORKERS threads while cache misses are tokenized in
+# batches of FLATTEN_TOKENIZER_BATCH_SIZE segments on FLATTEN_TOKENIZER_WORKERS threads (0 = inline)
+FLATTEN_READER_WORKERS = int(os.environ.get("TREEB_READER_WORKERS", min(8, (os.cpu_count() or 1) * 2)))
+FLATTEN_TOKENIZER_WORKERS = int(os.environ.get("TREEB_TOKENIZER_WORKERS", min(4, os.cpu_count() or 1)))
+FLATTEN_TOKENIZER_BATCH_SIZE = int(os.environ.get("TREEB_TOKENIZER_BATCH_SIZE", 64))
+FLATTEN_TOKENIZER_BATCH_CHARS = int(os.environ.get("TREEB_TOKENIZER_BATCH_CHARS", 4 * 1024 * 1024))
+# Before anything is read, binary and minified files and files over the byte limits (0 = no limit) are set
+# aside; the output lists them as skipped with their reason and size
+FLATTEN_READ_LIMITS = ReadLimits(
+    max_file_bytes=int(os.environ.get("TREEB_MAX_FILE_BYTES", DEFAULT_MAX_FILE_BYTES)) or None,
+    max_total_bytes=int(os.environ.get("TREEB_MAX_TOTAL_BYTES", DEFAULT_MAX_TOTAL_BYTES)) or None,
+    skip_binary=os.environ.get("TREEB_SKIP_BINARY", "1") != "0",
+    skip_minified=os.environ.get("TREEB_SKIP_MINIFIED", "1") != "0",
+)
+# Files of FLATTEN_MMAP_THRESHOLD bytes or more (0 = none) are memory-mapped and streamed out and tokenized in
+# parts of about FLATTEN_CHUNK_BYTES instead of being read whole
+FLATTEN_MMAP_THRESHOLD = int(os.environ.get("TREEB_MMAP_THRESHOLD", DEFAULT_MMAP_THRESHOLD_BYTES)) or None
+FLATTEN_CHUNK_BYTES = int(os.environ.get("TREEB_CHUNK_BYTES", DEFAULT_CHUNK_BYTES))
+
+# Directory listings behind /api/tree, kept until inotify (or, without it, the directory's mtime) says they changed
+LISTING_CACHE = DirectoryListingCache(
+    max_entries=int(os.environ.get("TREEB_LISTING_CACHE_ENTRIES", 200_000)),
+    use_inotify=os.environ.get("TREEB_LISTING_INOTIFY", "1") != "0",
+)
+# /api/tree sends directory children TREE_PAGE_SIZE at a time by default (0 sends them all), followed by a
+# "more" node that the page clicks for the next page, so opening a huge directory costs one page of nodes
+TREE_PAGE_SIZE = int(os.environ.get("TREEB_TREE_PAGE_SIZE", 500))
+
+# Repositories read when a request names a git revision ("rev", with the repository path as "repo"): trees and
+# blobs come from .git through one `git cat-file --batch` process per repository, and up to
+# GIT_BLOB_CACHE_BYTES of blob contents stay in memory for the next flatten of the same revision
+GIT_BLOB_CACHE_BYTES = int(os.environ.get("TREEB_GIT_BLOB_CACHE_BYTES", DEFAULT_BLOB_CACHE_BYTES))
+GIT_REPOSITORIES = GitRepositories(blob_cache_bytes=GIT_BLOB_CACHE_BYTES)
+
+# A flatten asked to ("snapshot": "manifest", or "texts" to store the texts too, for unified diffs) records a
+# manifest of what it sent (paths, text hashes, token counts) in the background, so that a later request with
+# "since" can send only what changed since then; about SNAPSHOT_KEEP are kept (TREEB_SNAPSHOTS=0 disables them)
+SNAPSHOT_KEEP = int(os.environ.get("TREEB_SNAPSHOT_KEEP", DEFAULT_KEEP_SNAPSHOTS))
+SNAPSHOTS = SnapshotStore(SNAPSHOTS_DIR, keep=SNAPSHOT_KEEP) if os.environ.get("TREEB_SNAPSHOTS", "1") != "0" else None
+
+# Full flattens of the working tree are stored by selection (paths, exclusion rules, read limits), up to
+# RESULT_CACHE_BYTES on disk (0 disables it): a flatten of an unchanged selection is served from there after
+# a stat of each directory and file, and one where some files changed only reads those
+RESULT_CACHE_BYTES = int(os.environ.get("TREEB_RESULT_CACHE_BYTES", DEFAULT_MAX_CACHE_BYTES))
+RESULT_CACHE = ResultCache(RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_BYTES) if RESULT_CACHE_BYTES > 0 else None
+
+# /api/search answers from an in-memory index of each tree root (SEARCH_MAX_INDEXES at most), built in the
+# background when the tree loads and refreshed from LISTING_CACHE at most every SEARCH_REFRESH_SECONDS; file
+# contents are indexed (trigrams) from a root's first content search, within the SEARCH_CONTENT_* byte limits
+SEARCH_INDEXES = SearchIndexes(
+    max_indexes=int(os.environ.get("TREEB_SEARCH_MAX_INDEXES", DEFAULT_MAX_INDEXES)),
+    refresh_seconds=float(os.environ.get("TREEB_SEARCH_REFRESH_SECONDS", DEFAULT_REFRESH_SECONDS)),
+    content_limits=ReadLimits(
+        max_file_bytes=int(os.environ.get("TREEB_SEARCH_CONTENT_MAX_FILE_BYTES", DEFAULT_CONTENT_LIMITS.max_file_bytes)) or None,
+        max_total_bytes=int(os.environ.get("TREEB_SEARCH_CONTENT_MAX_TOTAL_BYTES", DEFAULT_CONTENT_LIMITS.max_total_bytes)) or None,
+    ),
+    content_refresh_seconds=float(os.environ.get("TREEB_SEARCH_CONTENT_REFRESH_SECONDS", DEFAULT_CONTENT_REFRESH_SECONDS)),
+)
+MAX_SEARCH_RESULTS = 500
+
+# Every /api/tree and flatten request is timed per stage (walk, exclusion checks, tree, classify, read,
+# tokenize, ...) and counted (files visited, excluded, read, bytes, tokens); the totals are served at /metrics.
+# Requests with "debug" get their own breakdown back. With PROFILE_DIR set, requests with "profile" also run
+# under cProfile and leave their stats there (for pstats or snakeviz).
+METRICS = MetricsRegistry()
+PROFILE_DIR = os.environ.get("TREEB_PROFILE_DIR") or None
+
+# /api/flatten/jobs runs flattens on FLATTEN_JOBS' worker threads (at most FLATTEN_JOB_WORKERS at once, with
+# up to FLATTEN_JOB_QUEUE more waiting), keeps their results for FLATTEN_JOB_RESULT_TTL seconds and cancels
+# jobs whose page has not asked about them for FLATTEN_JOB_ABANDON_SECONDS
+FLATTEN_JOBS = FlattenJobs(
+    workers=int(os.environ.get("TREEB_FLATTEN_JOB_WORKERS", DEFAULT_JOB_WORKERS)),
+    max_queued=int(os.environ.get("TREEB_FLATTEN_JOB_QUEUE", DEFAULT_MAX_QUEUED_JOBS)),
+    result_ttl=float(os.environ.get("TREEB_FLATTEN_JOB_RESULT_TTL", DEFAULT_RESULT_TTL_SECONDS)),
+    abandon_seconds=float(os.environ.get("TREEB_FLATTEN_JOB_ABANDON_SECONDS", DEFAULT_ABANDON_SECONDS)),
+)
+
+# Warm selection presets have their output kept up to date in RESULT_CACHE by PRESET_WARMER, checked every
+# WARM_INTERVAL seconds (by mtime, re-reading only changed files), so that Generate with one is a cache hit.
+# Needs the result cache; a WARM_INTERVAL of 0 turns warming off.
+WARM_INTERVAL = float(os.environ.get("TREEB_WARM_INTERVAL", DEFAULT_WARM_INTERVAL_SECONDS))
+
+
+# Time from STARTUP_BEGAN to the first response, reported by /api/status and logged once
+FIRST_RESPONSE_MS: Optional[float] = None
+_first_response_lock = threading.Lock()
+
+
+def start_background_startup():
+    """Start the deferred startup work (presets, tokenizer load and warm-up, tkinter probe, preset warming)
+    without waiting for it."""
+    for loader in (PRESETS_BOOTSTRAP, ENCODING_LOADER, TKINTER_PROBE):
+        loader.start()
+    if PRESET_WARMER is not None:
+        PRESET_WARMER.start()
 # ------------------------------------------------------------------
 
 # ------------------------------------------------------------------ HELPER FUNCTIONS
-def get_selection_preset_path(name: str, preset_type: str) -> Optional[Path]:
-    """Return the JSON preset file path for a given name/type, or None if invalid."""
-    safe_name = "".join(c for c in name if c.isalnum() or c in "-_").strip()
-    if not safe_name:
-        return None
+def check_if_item_is_excluded(item: Path, rules: dict) -> Optional[dict]:  # MODIFIED HERE
+    """Checks if a single item matches exclusion rules based on its name and type."""
+    return get_exclusion_matcher(rules).match_path(item)
 
-    if preset_type == "default":
-        base_dir = DEFAULT_SELECTION_PRESETS_DIR
-    elif preset_type == "user":
-        base_dir = USER_SELECTION_PRESETS_DIR
-    else:
-        return None
 
-    return base_dir / f"{safe_name}.json"
+def request_flag(value) -> bool:
+    """Interpret a boolean request option sent as JSON (true/false) or as a query string value ("1", "true")."""
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
 
 
-def check_if_item_is_excluded(item: Path, rules: dict) -> Optional[dict]:  # MODIFIED HERE
-    """Checks if a single item matches exclusion rules based on its name and type."""
-    if item.is_dir():
-        if item.name in rules.get("dirs", []):
-            return {"type": "Directory Name", "rule": item.name}
-        for pattern in rules.get("patterns", []):  # Patterns can match directory names too
-            if item.match(pattern):  # Path.match is available in Python 3.5+
-                return {"type": "Directory Pattern", "rule": pattern}
-    elif item.is_file():
-        if item.name in rules.get("files", []):
-            return {"type": "File Name", "rule": item.name}
-        for pattern in rules.get("patterns", []):
-            if item.match(pattern):  # Path.match is available in Python 3.5+
-                return {"type": "File Pattern", "rule": pattern}
-    return None
+# --- Lazy Loading Tree Node Builder ---
+def _error_js_node(node_id: str, text: str) -> dict:
+    return {
+        "id": node_id,
+        "text": text,
+        "type": "error",
+        "icon": "jstree-warning",
+        "children": False,
+        "data": {"excluded_info": None},
+    }
 
 
-# --- Lazy Loading Tree Node Builder ---
-def dir_to_js_lazy(item: Path) -> dict:
-    global ACTIVE_EXCLUSION_RULES
+def _lazy_js_node(node_id: str, node_text: str, is_dir: bool, exclusion_info: Optional[dict]) -> dict:
+    jstree_node_data = {"excluded_info": exclusion_info}
+
+    if is_dir:
+        return {
+            "id": node_id,
+            "text": node_text,
+            "children": True,  # keep lazy load default
+            "type": "folder",
+            "data": jstree_node_data,
+        }
+    else:  # File
+        return {
+            "id": node_id,
+            "text": node_text,
+            "icon": "jstree-file",
+            "type": "file",
+            "children": False,
+            "data": jstree_node_data,
+        }
+
+
+def dir_to_js_lazy(item: Path, ignore_rules: Optional[IgnoreFileRules] = None, revision: Optional[GitRevision] = None) -> dict:
     try:
+        if revision is not None:  # `item` is already resolved; it only has to exist in the revision
+            if not revision.exists(item):
+                return _error_js_node(str(item), f"{item.name} (Not Found)")
+            is_dir = revision.is_dir(item)
+            exclusion_info = get_exclusion_matcher(active_exclusion_rules()).match(
+                str(item), item.name, is_dir, revision.is_file(item)
+            )
+            return _lazy_js_node(str(item), item.name if item.name else str(item), is_dir, exclusion_info)
+
         if not item.exists():
-            return {
-                "id": str(item),
-                "text": f"{item.name} (Not Found)",
-                "type": "error",
-                "icon": "jstree-warning",
-                "children": False,
-                "data": {"excluded_info": None},
-            }
+            return _error_js_node(str(item), f"{item.name} (Not Found)")
 
-        exclusion_info = check_if_item_is_excluded(item, ACTIVE_EXCLUSION_RULES)
+        exclusion_info = check_if_item_is_excluded(item, active_exclusion_rules())
+        if not exclusion_info and ignore_rules is not None:
+            exclusion_info = ignore_rules.match(str(item), item.is_dir())
         node_text = item.name if item.name else str(item)
-        item_abs_path_str = str(item.resolve())
+        return _lazy_js_node(str(item.resolve()), node_text, item.is_dir(), exclusion_info)
+    except Exception as e:
+        app.logger.error(f"Error processing path {item} for lazy tree node: {e}")
+        return _error_js_node(str(item), f"{item.name} (Processing Error)")
 
-        jstree_node_data = {"excluded_info": exclusion_info}
 
-        if item.is_dir():
-            return {
-                "id": item_abs_path_str,
-                "text": node_text,
-                "children": True,  # keep lazy load default
-                "type": "folder",
-                "data": jstree_node_data,
-            }
-        else:  # File
-            return {
-                "id": item_abs_path_str,
-                "text": node_text,
-                "icon": "jstree-file",
-                "type": "file",
-                "children": False,
-                "data": jstree_node_data,
-            }
+def entry_to_js_lazy(
+    entry: ListedEntry,
+    resolved_parent: str,
+    matcher: ExclusionMatcher,
+    ignore_context: Optional[DirIgnoreContext] = None,
+) -> dict:
+    """dir_to_js_lazy for a child from LISTING_CACHE: uses the type recorded at listing time instead of stat'ing again."""
+    try:
+        if not entry.exists:
+            return _error_js_node(entry.path, f"{entry.name} (Not Found)")  # Dangling symlink
+
+        exclusion_info = matcher.match(entry.path, entry.name, entry.is_dir, entry.is_file)
+        if not exclusion_info and ignore_context is not None:
+            exclusion_info = ignore_context.match(entry.path, entry.name, entry.is_dir)
+        # Same id as item.resolve(), but only symlinks need resolving when the parent is already resolved
+        node_id = entry.real_path if entry.is_symlink else os.path.join(resolved_parent, entry.name)
+        return _lazy_js_node(node_id, entry.name, entry.is_dir, exclusion_info)
     except Exception as e:
-        app.logger.error(f"Error processing path {item} for lazy tree node: {e}")
-        return {
-            "id": str(item),
-            "text": f"{item.name} (Processing Error)",
-            "type": "error",
-            "icon": "jstree-warning",
-            "children": False,
-            "data": {"excluded_info": None},
-        }
+        app.logger.error(f"Error processing path {entry.path} for lazy tree node: {e}")
+        return _error_js_node(entry.path, f"{entry.name} (Processing Error)")
+
+
+def compact_js_node(node: dict, name: str, parent_id: str) -> dict:
+    """A node from entry_to_js_lazy as sent in a compact page: its name ("n") and type ("t": "d", "f" or "e"),
+    plus its id only where it is not the parent's id joined with the name (symlinks), its text only where it
+    is not the name (errors) and its exclusion ("x") only when it is excluded. The page rebuilds the rest."""
+    compact = {"n": name, "t": "d" if node["type"] == "folder" else node["type"][0]}
+    if node["id"] != os.path.join(parent_id, name):
+        compact["id"] = node["id"]
+    if node["text"] != name:
+        compact["text"] = node["text"]
+    if node["data"]["excluded_info"] is not None:
+        compact["x"] = node["data"]["excluded_info"]
+    return compact
+
+
+def page_info(dir_id: str, page: ListingPage, name_filter: str = "") -> dict:
+    """What the page needs to ask for the rest of a directory: sizes, the next page's cursor and the filter."""
+    return {
+        "id": dir_id,
+        "total": page.total,
+        "matched": page.matched,
+        "shown": page.start + len(page.entries),
+        "cursor": page.cursor,
+        "filter": name_filter,
+    }
+
+
+def _more_js_node(info: dict) -> dict:
+    """The node after a page of children: clicked for the next page (or to change the filter)."""
+    remaining = info["matched"] - info["shown"]
+    text = f"… {remaining:,} more" if info["cursor"] else f"Showing names containing \"{info['filter']}\""
+    return {
+        # Resolved paths never hold an empty part, so this cannot be the id of an entry
+        "id": info["id"] + os.sep + os.sep + "more",
+        "text": text,
+        "type": "more",
+        "icon": False,
+        "children": False,
+        "state": {"checkbox_disabled": True},
+        "a_attr": {"class": "tree-more"},
+        "data": {"excluded_info": None, "page": info},
+    }
+
+
+def list_directory_nodes(
+    dir_path: str,
+    matcher: ExclusionMatcher,
+    ignore_rules: Optional[IgnoreFileRules] = None,
+    revision: Optional[GitRevision] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    name_filter: str = "",
+    until: Optional[str] = None,
+) -> Tuple[List[dict], ListingPage]:
+    """jsTree nodes for a page of the children of an already-resolved directory (see page_listing; all of them
+    by default), and the page. Raises OSError like os.scandir.
+
+    With a revision, the directory is listed as it is in that commit instead of the working tree. Only the
+    entries of the page are checked against the exclusion rules and made into nodes.
+    """
+    with span("list"):
+        entries = revision.list_directory(dir_path) if revision is not None else LISTING_CACHE.list(dir_path)
+        page = page_listing(entries, limit, cursor, name_filter, until)
+    count("directories_listed")
+    count("entries_listed", len(entries))
+    with span("nodes"):  # Exclusion checks (and ignore files) and the nodes themselves
+        ignore_context = ignore_rules.for_directory(dir_path, [e.name for e in entries]) if ignore_rules else None
+        nodes = [entry_to_js_lazy(entry, dir_path, matcher, ignore_context) for entry in page.entries]
+    count("excluded", sum(1 for node in nodes if node.get("data", {}).get("excluded_info") is not None))
+    return nodes, page
+
+
+def tree_page_options(args) -> dict:
+    """limit, cursor, name_filter and until for list_directory_nodes from /api/tree's query. Raises ValueError."""
+    try:
+        limit = int(args.get("limit") or TREE_PAGE_SIZE)
+    except ValueError:
+        raise ValueError("limit must be a whole number.")
+    return {
+        "limit": limit if limit > 0 else None,
+        "cursor": args.get("cursor") or None,
+        "name_filter": args.get("filter", "").strip(),
+        "until": args.get("until") or None,
+    }
+
+
+def search_index_for(root: Path, revision: Optional[GitRevision] = None) -> SearchIndex:
+    """The search index of an already-resolved tree root, with the active exclusion rules (started if new)."""
+    lister = revision.list_directory if revision is not None else LISTING_CACHE.list
+    return SEARCH_INDEXES.index(str(root), get_exclusion_matcher(active_exclusion_rules()), lister, revision)
+
+
+def tree_response(nodes: Union[List[dict], dict]) -> Response:
+    """JSON response for /api/tree with an ETag, answered with 304 when the browser already has this payload.
+    Not with "debug": traced adds the request's breakdown to the payload afterwards."""
+    with span("respond"):
+        response = jsonify(nodes)
+        response.headers["Cache-Control"] = "no-cache"  # Cache, but revalidate every time
+        if request_flag(request.args.get("debug")):
+            return response
+        response.add_etag()
+        return response.make_conditional(request)
+
+
+def request_options() -> dict:
+    """The query arguments, plus the fields of a JSON object body."""
+    options = request.args.to_dict()
+    body = request.get_json(force=True, silent=True) if request.method == "POST" else None
+    if isinstance(body, dict):
+        options.update(body)
+    return options
+
+
+def dump_profile(profiler: cProfile.Profile, trace: RequestTrace):
+    name = f"{trace.endpoint}-{time.strftime('%Y%m%d-%H%M%S')}-{threading.get_ident()}-{id(trace) % 10000}.prof"
+    path = Path(PROFILE_DIR) / name
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(str(path))
+        trace.profile_path = str(path)
+    except OSError as e:
+        app.logger.error(f"Could not write profile {path}: {e}")
+
+
+def start_profiler(profiler: Optional[cProfile.Profile]) -> bool:
+    if profiler is None:
+        return False
+    try:
+        profiler.enable()
+    except ValueError as e:  # Another request is being profiled (the profiler is process-wide on Python 3.12+)
+        app.logger.warning(f"Profile: not profiling this part of the request: {e}")
+        return False
+    return True
+
+
+def traced_stream(records: Iterable, trace: RequestTrace, profiler: Optional[cProfile.Profile]) -> Iterator:
+    """A streamed body, produced with `trace` current (and under the profiler); recorded when it ends."""
+    iterator = iter(records)
+    try:
+        while True:
+            with tracing(trace):
+                profiling = start_profiler(profiler)
+                try:
+                    record = next(iterator, None)
+                finally:
+                    if profiling:
+                        profiler.disable()
+            if record is None:
+                return
+            yield record
+    finally:
+        if hasattr(iterator, "close"):
+            iterator.close()
+        if profiler is not None:
+            dump_profile(profiler, trace)
+        METRICS.record(trace)
+
+
+def traced(endpoint: str):
+    """Run the view with a RequestTrace current, recorded in METRICS once the response is complete.
+
+    With "debug" set in the request, the response carries the trace's breakdown: in a Server-Timing header,
+    and as "debug" in a JSON object response (streamed views add it to their own summary record). With
+    "profile" set and PROFILE_DIR configured, the view runs under cProfile.
+    """
+
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            options = request_options()
+            debug, profile = request_flag(options.get("debug")), request_flag(options.get("profile"))
+            trace = RequestTrace(endpoint, detailed=debug or profile)
+            profiler = cProfile.Profile() if PROFILE_DIR and profile else None
+            with tracing(trace):
+                profiling = start_profiler(profiler)
+                try:
+                    response = app.make_response(view(*args, **kwargs))
+                finally:
+                    if profiling:
+                        profiler.disable()
+            if response.is_streamed:
+                response.response = traced_stream(response.response, trace, profiler)
+                return response
+            if profiler is not None:
+                dump_profile(profiler, trace)
+            METRICS.record(trace)
+            if debug:
+                response.headers["Server-Timing"] = trace.server_timing()
+                if response.is_json and response.status_code == 200:
+                    data = response.get_json()
+                    if isinstance(data, dict):
+                        data["debug"] = trace.breakdown()
+                        response.set_data(app.json.dumps(data))
+            return response
+
+        return wrapper
+
+    return decorate
+
+
+def traced_segments(segments: Iterable[Segment]) -> Iterator[Segment]:
+    """`segments`, timing the wait for each (reading the files) as the "read" stage and counting the files read."""
+    iterator = iter(segments)
+    while True:
+        with span("read"):
+            segment = next(iterator, None)
+        if segment is None:
+            return
+        if segment.key is not None and segment.final:
+            count("files_read")
+            count("bytes_read", segment.key[2])
+        yield segment
+
+
+def count_plan(plan: FlattenPlan):
+    count("files", len(plan.files))
+    count("files_skipped", len(plan.skipped))
+
+
+# ------------------------------------------------------------------ FLATTEN OUTPUT
+def revision_from_request(values, default_repo: Optional[str] = None) -> Optional[GitRevision]:
+    """The git revision a request reads from ("rev" of the repository at "repo"), or None for the working tree.
+
+    Raises ValueError for a missing or unknown repository or revision.
+    """
+    rev = (values.get("rev") or "").strip()
+    if not rev:
+        return None
+    repo = values.get("repo") or default_repo
+    if not repo:
+        raise ValueError('A revision needs the path of its repository ("repo").')
+    return GIT_REPOSITORIES.revision(str(Path(repo).resolve()), rev)
+
+
+def new_flattener(source: Optional[GitRevision] = None, cancel: Optional[threading.Event] = None) -> Flattener:
+    """The flatten engine with the active exclusion rules and this server's tokenizer settings, reading from
+    `source` (a git revision) instead of the working tree when given, and stopping once `cancel` is set."""
+    return Flattener(
+        active_exclusion_rules(),
+        encoding=current_encoding(),
+        count_encodings=list(loaded_encodings().values()),
+        token_cache=TOKEN_CACHE,
+        reader_workers=FLATTEN_READER_WORKERS,
+        tokenizer_workers=FLATTEN_TOKENIZER_WORKERS,
+        tokenizer_batch_size=FLATTEN_TOKENIZER_BATCH_SIZE,
+        tokenizer_batch_chars=FLATTEN_TOKENIZER_BATCH_CHARS,
+        read_limits=FLATTEN_READ_LIMITS,
+        mmap_threshold=FLATTEN_MMAP_THRESHOLD,
+        chunk_bytes=FLATTEN_CHUNK_BYTES,
+        source=source,
+        cancel=cancel,
+    )
+
+
+def model_from_request(data: dict, model_key: str) -> Optional[dict]:
+    """The MODEL_CONTEXT_INFO entry whose id is data[model_key], None if not given. Raises ValueError."""
+    model_id = data.get(model_key)
+    if not model_id:
+        return None
+    model = next((m for m in MODEL_CONTEXT_INFO if m["id"] == model_id), None)
+    if model is None:
+        raise ValueError(f"Unknown model for {model_key}: {model_id!r}")
+    return model
 
 
-def build_nested_dict(paths: List[Path], root_for_display: Path) -> dict:  # Used List[Path] for clarity for 3.9
-    tree = {}
-    resolved_root_for_display = root_for_display.resolve()
-    for p in paths:
+def token_limit_from_request(data: dict, prefix: str) -> Optional[int]:
+    """Token limit asked for with "<prefix>_tokens" and/or "<prefix>_model" (a MODEL_CONTEXT_INFO id); the smaller wins.
+
+    With a model, the limit is in that model's tokens (see limit_flattener)."""
+    limits = []
+    tokens_key, model_key = f"{prefix}_tokens", f"{prefix}_model"
+    if data.get(tokens_key) not in (None, ""):
         try:
-            abs_p = p.resolve()
-            if resolved_root_for_display in abs_p.parents or resolved_root_for_display == abs_p:
-                rel_parts = abs_p.relative_to(resolved_root_for_display).parts
-                if not rel_parts:
-                    rel_parts = (abs_p.name,) if abs_p.name else (str(abs_p),)
-            else:
-                rel_parts = (abs_p.name,) if abs_p.name else (str(abs_p),)
+            limits.append(int(data[tokens_key]))
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid {tokens_key}: {data[tokens_key]!r}")
+    model = model_from_request(data, model_key)
+    if model is not None:
+        limits.append(model["window"])
+    if not limits:
+        return None
+    if min(limits) <= 0:
+        raise ValueError(f"The {prefix} token limit must be positive.")
+    return min(limits)
+
+
+def limit_flattener(flattener: Flattener, data: dict, prefix: str) -> Tuple[Flattener, float]:
+    """The flattener to measure a token limit with, and the model tokens per token it counts.
+
+    With "<prefix>_model" that is the model's tiktoken encoding, or the reference encoding of its estimator
+    (the limit is then scaled by the estimator's factor); otherwise, or if that encoding could not be
+    loaded, the flattener's own encoding.
+    """
+    model = model_from_request(data, f"{prefix}_model")
+    if model is None:
+        return flattener, 1.0
+    name, factor = reference_encoding(model["tokenizer"])
+    encoding = loaded_encodings().get(name)
+    if encoding is None:
+        return flattener, 1.0
+    if flattener.encoding is not None and flattener.encoding.name == name:
+        return flattener, factor
+    return flattener.with_encoding(encoding), factor
+
+
+def plan_packing(flattener: Flattener, plan: FlattenPlan, data: dict) -> Tuple[Flattener, Optional[PackingDecision]]:
+    """Packing decision for a flatten request with a token budget (None if it has none) and the flattener to render
+    it with, which measured it. Raises ValueError."""
+    budget = token_limit_from_request(data, "budget")
+    if budget is None:
+        return flattener, None
+    flattener, factor = limit_flattener(flattener, data, "budget")
+    return flattener, flattener.pack(
+        plan,
+        int(budget / factor),
+        policy=data.get("budget_policy") or DEFAULT_PRIORITY_POLICY,
+        weights=data.get("budget_weights"),
+    )
 
-        except ValueError:
-            rel_parts = (p.name if p.name else str(p),)
-        except Exception as e:
-            app.logger.error(
-                f"Path resolution error in build_nested_dict for {p} relative to {root_for_display}: {e}"
+
+def snapshot_selection(flattener: Flattener, selection: Selection, data: dict) -> str:
+    """The fingerprint snapshots of this flatten are kept under: "latest" is the newest of the same one."""
+    return selection_fingerprint(selection.include, flattener, request_flag(data.get("ignore_files")), selection.exclude)
+
+
+def snapshot_mode(data: dict) -> Optional[str]:
+    """What a flatten request asked to record (one of SNAPSHOT_MODES, true meaning the manifest only), or None
+    for nothing. Raises ValueError."""
+    value = data.get("snapshot")
+    if isinstance(value, str) and value.strip().lower() in SNAPSHOT_MODES:
+        return value.strip().lower()
+    if isinstance(value, str) and value.strip().lower() not in ("", "0", "1", "true", "false", "yes", "no", "on", "off"):
+        raise ValueError(f"Unknown snapshot {value!r} (expected true or one of: {', '.join(SNAPSHOT_MODES)})")
+    return SNAPSHOT_MANIFEST if request_flag(value) else None
+
+
+def plan_changes(
+    flattener: Flattener, plan: FlattenPlan, data: dict, selection_key: str
+) -> Optional[Tuple[Manifest, Manifest, FileChanges]]:
+    """For a flatten request with "since" (a snapshot id, or "latest" for the newest of this selection below
+    this root): that snapshot, the manifest of the selection now and what changed in between; None for a full
+    flatten. Raises ValueError, also for a snapshot of another root.
+
+    Files are compared by version (one stat) first; only those whose version differs are read and hashed.
+    """
+    since = data.get("since")
+    if not since:
+        return None
+    if SNAPSHOTS is None:
+        raise ValueError("Snapshots are disabled on this server (TREEB_SNAPSHOTS=0).")
+    if (data.get("diff") or "files") not in DIFF_FORMATS:
+        raise ValueError(f"Unknown diff {data.get('diff')!r} (expected one of: {', '.join(DIFF_FORMATS)})")
+    if token_limit_from_request(data, "budget") is not None or token_limit_from_request(data, "shard") is not None:
+        raise ValueError("Use either 'since' or a token budget or shards, not both.")
+    root = str(plan.common_ancestor) if plan.common_ancestor is not None else None
+    previous = SNAPSHOTS.load(str(since), root, selection_key)
+    current = build_manifest(
+        flattener, plan, SNAPSHOTS, previous=previous, selection=selection_key, store_texts=snapshot_mode(data) == SNAPSHOT_TEXTS
+    )
+    return previous, current, compare_manifests(previous, current)
+
+
+def record_snapshot(
+    flattener: Flattener,
+    plan: FlattenPlan,
+    packing: Optional[PackingDecision],
+    selection_key: str,
+    mode: Optional[str],
+    current: Optional[Manifest] = None,
+) -> Optional[str]:
+    """Have the manifest of a flatten that was just sent (built then unless given) saved in the background and
+    return its id; None when no snapshot was asked for (`mode`), snapshots are disabled or nothing was selected.
+    """
+    if SNAPSHOTS is None or plan.empty or mode is None:
+        return None
+    snapshot_id = current.id if current is not None else new_snapshot_id()
+
+    def build() -> Manifest:
+        manifest = current
+        if manifest is None:
+            root = str(plan.common_ancestor) if plan.common_ancestor is not None else None
+            manifest = build_manifest(
+                flattener,
+                plan,
+                SNAPSHOTS,
+                packing,
+                previous=SNAPSHOTS.latest(root, selection_key, wait=False),
+                selection=selection_key,
+                store_texts=mode == SNAPSHOT_TEXTS,
+                snapshot_id=snapshot_id,
             )
-            rel_parts = (p.name + " (path error)",)
+        return with_token_counts(flattener, manifest)
 
-        cursor = tree
-        for part in rel_parts:
-            cursor = cursor.setdefault(part, {})
-    return tree
+    return SNAPSHOTS.save_later(snapshot_id, build)
 
 
-def ascii_tree(d: dict, prefix: str = "") -> List[str]:  # Used List[str] and dict
-    lines = []
-    items = list(d.items())
-    for i, (name, child) in enumerate(items):
-        is_last = i == (len(items) - 1)
-        connector = "└── " if is_last else "├── "
-        lines.append(prefix + connector + name)
-        if child:
-            extension = "    " if is_last else "│   "
-            lines.extend(ascii_tree(child, prefix + extension))
-    return lines
+def output_token_count(counts: TokenCounts) -> int:
+    """The output's token count (TIKTOKEN_ENCODING_NAME): 0 when it was not counted, -1 on tokenization errors."""
+    if TIKTOKEN_ENCODING_NAME not in counts.by_encoding:
+        app.logger.warning("Tiktoken encoding not available. Token count 0.")
+        return 0
+    return counts.by_encoding[TIKTOKEN_ENCODING_NAME]
+
+
+def model_percentages_for(plan: FlattenPlan, counts: TokenCounts, estimated_encodings: Tuple[str, ...] = ()) -> List[dict]:
+    """Context window use per model, each from the count of its own tokenizer (see model_token_count).
+
+    Counts of the `estimated_encodings` are marked estimated for the models that use them.
+    """
+    model_percentages = []
+    token_count = counts.by_encoding.get(TIKTOKEN_ENCODING_NAME, 0)
+    if plan.empty and token_count <= 0:  # Nothing selected: only show models when the message was counted
+        return model_percentages
+    if token_count == -1:  # Tokenization error
+        model_percentages.append({"name": "LLMs", "percentage": "N/A (Tokenization Error)"})
+        return model_percentages
+    for model in MODEL_CONTEXT_INFO:
+        model_tokens, estimated = model_token_count(model["tokenizer"], counts)
+        estimated = estimated or reference_encoding(model["tokenizer"])[0] in estimated_encodings
+        if model_tokens < 0:
+            model_percentages.append({"name": model["displayName"], "percentage": "N/A (Tokenization Error)"})
+            continue
+        if model_tokens == 0 and model["window"] == 0:  # Avoid division by zero if both are zero
+            percentage = 0.0
+        elif model["window"] == 0:  # Model has "infinite" window or not applicable
+            percentage = 100.0 if model_tokens > 0 else 0.0  # Full if there are tokens, else 0
+        else:
+            percentage = round((model_tokens / model["window"]) * 100, 2)
+
+        # Ensure very small percentages are still visible (e.g., 0.01%)
+        model_percentages.append(
+            {
+                "name": model["displayName"],
+                "percentage": (0.01 if 0 < percentage < 0.01 else percentage),
+                "tokens": model_tokens,
+                "tokenizer": model["tokenizer"],
+                "estimated": estimated,
+            }
+        )
+    return model_percentages
+
 
+def is_full_flatten(data: dict) -> bool:
+    """Whether a flatten request sends every file in full (no "since", token budget or shards). Raises ValueError."""
+    return not data.get("since") and all(token_limit_from_request(data, prefix) is None for prefix in ("budget", "shard"))
+
+
+def flatten_text(
+    flattener: Flattener, segments: Iterable[Segment], cached: Optional[CachedFlatten] = None, job: Optional[FlattenJob] = None
+) -> Tuple[str, TokenCounts]:
+    """The output made of `segments` and its token counts, noting each segment in `cached` and `job` if given."""
+    token_counter = flattener.new_model_counter()
+    text_parts = []
+    try:
+        for segment in traced_segments(segments):
+            text_parts.append(segment.text)
+            with span("tokenize"):
+                token_counter.add(*segment)
+            if cached is not None:
+                cached.record(segment)
+            if job is not None:
+                job.add_segment(segment, token_counter.counted().get(TIKTOKEN_ENCODING_NAME, 0))
+        with span("tokenize"):
+            counts = token_counter.counts()
+    finally:
+        token_counter.close()
+    return "".join(text_parts), counts
+
+
+def request_selection(data: dict) -> Selection:
+    """The selection of a flatten request: "selection" ({"root": ..., "include": [...], "exclude": [...]},
+    paths relative to root), else the plain list "paths". With "preset", the page sends a selection preset it
+    loaded and has not changed since (what PRESET_WARMER keeps warm): its stored selection. Raises ValueError."""
+    if data.get("preset"):
+        preset_file = find_selection_preset(str(data["preset"]))
+        if preset_file is None:
+            raise ValueError(f"Selection preset '{data['preset']}' not found")
+        return load_selection_preset(preset_file).selection
+    if data.get("selection") is not None:
+        return parse_selection(data["selection"])
+    return Selection(data.get("paths", []))
+
+
+def flatten_result(flattener: Flattener, data: dict, job: Optional[FlattenJob] = None) -> dict:
+    """The /api/flatten response, reporting progress to `job` when run as one. Raises ValueError for invalid
+    options.
+
+    Full flattens of the working tree go through RESULT_CACHE: an unchanged selection is answered with the
+    stored output, and a changed one re-reads only the files that changed.
+    """
+    selection, ignore_files = request_selection(data), request_flag(data.get("ignore_files"))
+    cached = None
+    if RESULT_CACHE is not None and flattener.source is None and is_full_flatten(data):
+        cached = CachedFlatten(RESULT_CACHE, flattener, selection.include, ignore_files, selection.exclude)
+        plan = cached.plan()
+    else:
+        plan = flattener.plan(selection.include, ignore_files=ignore_files, excluded=selection.exclude)
+    count_plan(plan)
+    if job is not None:
+        job.files_total = len(plan.files) - len(plan.skipped)
+    selection_key, snapshot = snapshot_selection(flattener, selection, data), snapshot_mode(data)
+    with span("changes"):
+        changed = plan_changes(flattener, plan, data, selection_key)
+    if token_limit_from_request(data, "shard") is not None:
+        if token_limit_from_request(data, "budget") is not None:
+            raise ValueError("Use either a token budget or shards, not both.")
+        # Shard token counts are in the tokens of the encoding that measured them (the shard model's, if given)
+        shard_flattener, factor = limit_flattener(flattener, data, "shard")
+        with span("shards"):
+            shards = shard_flattener.shards(
+                plan,
+                int(token_limit_from_request(data, "shard") / factor),
+                header_mode=data.get("shard_header") or "reference",
+            )
+        shard_counts = [shard["token_count"] for shard in shards]
+        token_count = -1 if -1 in shard_counts else sum(shard_counts)
+        counts = TokenCounts({shard_flattener.encoding.name: token_count}, sum(len(shard["text"]) for shard in shards))
+        return {
+            "shards": shards,
+            "token_count": token_count,
+            "token_counts": counts.by_encoding,
+            "model_percentages": model_percentages_for(plan, counts),
+            "skipped": Flattener.skipped_report(plan),
+            **({"commit": flattener.source.commit} if flattener.source is not None else {}),
+        }
+    with span("packing"):
+        flattener, packing = plan_packing(flattener, plan, data)
+
+    current, unchanged = None, cached.unchanged_result(plan) if cached is not None else None
+    if unchanged is not None:
+        final_text, counts = unchanged
+        count("result_cache_hits")
+    else:
+        if changed is not None:
+            previous, current, changes = changed
+            segments = iter_change_segments(flattener, plan, changes, SNAPSHOTS, previous, data.get("diff") or "files")
+        elif cached is not None:
+            segments = cached.iter_segments(plan)
+        else:
+            segments = flattener.iter_segments(plan, packing)
+        final_text, counts = flatten_text(flattener, segments, cached, job)
+        if cached is not None:
+            with span("result_cache"):
+                cached.save(plan, final_text, counts)
+    count("tokens", max(output_token_count(counts), 0))
+
+    result = {
+        "text": final_text,
+        "token_count": output_token_count(counts),
+        "token_counts": counts.by_encoding,
+        "model_percentages": model_percentages_for(plan, counts),
+        "skipped": Flattener.skipped_report(plan),
+    }
+    if packing is not None:
+        result["packing"] = packing.to_json()
+    if flattener.source is not None:
+        result["commit"] = flattener.source.commit
+    if changed is not None:
+        result["changes"] = changes.to_json()
+    snapshot_id = record_snapshot(flattener, plan, packing, selection_key, snapshot, current)
+    if snapshot_id is not None:
+        result["snapshot"] = snapshot_id
+    return result
+
+
+def warm_preset_ids() -> List[str]:
+    """Ids of the selection presets saved as warm."""
+    warm_ids = []
+    for preset_id in selection_preset_ids():
+        preset_file = find_selection_preset(preset_id)
+        try:
+            if preset_file is not None and load_selection_preset(preset_file).warm:
+                warm_ids.append(preset_id)
+        except (OSError, ValueError) as e:
+            app.logger.debug(f"Skipping unreadable preset {preset_id}: {e}")
+    return warm_ids
+
+
+def warm_selection_preset(preset_id: str, cancel: threading.Event) -> dict:
+    """Bring the output of a warm preset in RESULT_CACHE up to date: what a full flatten of its paths (sent by
+    the page as "preset") finds there. Raises ValueError for a preset that is gone, Cancelled once `cancel` is set."""
+    preset_file = find_selection_preset(preset_id)
+    if preset_file is None:
+        raise ValueError(f"Selection preset '{preset_id}' not found")
+    preset = load_selection_preset(preset_file)
+    ENCODING_LOADER.get()  # Counted like Generate counts them, or the stored counts would not do for it
+    trace = RequestTrace("warm_preset")
+    try:
+        with tracing(trace):
+            flattener = new_flattener(cancel=cancel)
+            selection = preset.selection
+            cached = CachedFlatten(RESULT_CACHE, flattener, selection.include, preset.ignore_files, selection.exclude)
+            plan = cached.plan()
+            unchanged = cached.unchanged_result(plan)
+            if unchanged is not None:
+                counts = unchanged[1]
+            else:
+                text, counts = flatten_text(flattener, cached.iter_segments(plan), cached)
+                with span("result_cache"):
+                    cached.save(plan, text, counts)
+    finally:
+        METRICS.record(trace)
+    return {"rebuilt": unchanged is None, "files": len(plan.files) - len(plan.skipped), "tokens": output_token_count(counts)}
+
+
+PRESET_WARMER = (
+    PresetWarmer(warm_preset_ids, warm_selection_preset, interval=WARM_INTERVAL)
+    if RESULT_CACHE is not None and WARM_INTERVAL > 0
+    else None
+)
 
 # ------------------------------------------------------------------ ROUTES
+@app.after_request
+def record_first_response(response: Response) -> Response:
+    global FIRST_RESPONSE_MS
+    if FIRST_RESPONSE_MS is None:
+        with _first_response_lock:
+            if FIRST_RESPONSE_MS is None:
+                FIRST_RESPONSE_MS = (time.perf_counter() - STARTUP_BEGAN) * 1000
+                app.logger.info(f"First response ({request.path}) {FIRST_RESPONSE_MS:.0f} ms after startup")
+    return response
+
+
+@app.get("/api/status")
+def api_status():
+    """Time to the first response, the state of the deferred startup work and the flatten jobs kept, by state."""
+    return jsonify(
+        {
+            "uptime_ms": round((time.perf_counter() - STARTUP_BEGAN) * 1000, 1),
+            "first_response_ms": None if FIRST_RESPONSE_MS is None else round(FIRST_RESPONSE_MS, 1),
+            "startup": {
+                loader.name: {"status": loader.status, "load_ms": None if loader.load_ms is None else round(loader.load_ms, 1)}
+                for loader in (PRESETS_BOOTSTRAP, ENCODING_LOADER, TKINTER_PROBE)
+            },
+            "flatten_jobs": FLATTEN_JOBS.counts,
+        }
+    )
+
+
+@app.get("/metrics")
+def metrics():
+    """Request counts and durations, time per stage and counters of /api/tree and the flatten endpoints, in
+    the Prometheus text format."""
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/")
 def index():
-    return render_template("index.html", initial_path=str(INITIAL_ROOT_DIR), tkinter_available=TKINTER_AVAILABLE)
+    return render_template(
+        "index.html",
+        initial_path=str(INITIAL_ROOT_DIR),
+        # Until the probe has finished the button stays enabled; browse-for-directory waits for the answer
+        tkinter_available=TKINTER_PROBE.start().peek((True, ""))[0],
+        models=MODEL_CONTEXT_INFO,
+    )
 
 
 @app.route("/api/browse-for-directory", methods=["GET"])
 def browse_for_directory_api():
-    if not TKINTER_AVAILABLE:
+    try:
+        tkinter_available, tkinter_error_message = TKINTER_PROBE.get(timeout=TKINTER_PROBE_TIMEOUT_SECONDS)
+    except TimeoutError:
+        app.logger.warning("Browse directory attempt while the tkinter probe is still running (display not responding?)")
+        return jsonify({"error": "Still checking whether a display is available for the directory dialog. Try again shortly.", "selected_path": None}), 503
+    if not tkinter_available:
         app.logger.warning(
-            f"Browse directory attempt failed: tkinter support not available. Original import error: {TKINTER_IMPORT_ERROR_MESSAGE}"
+            f"Browse directory attempt failed: tkinter support not available. Original import error: {tkinter_error_message}"
         )
         user_error_message = "Directory Browse feature is disabled because the 'tkinter' Python module is not available or failed to initialize."
-        if "module not found" in TKINTER_IMPORT_ERROR_MESSAGE.lower():
+        if "module not found" in tkinter_error_message.lower():
             user_error_message += " Please install python3-tk (or equivalent for your OS)."
-        elif "display" in TKINTER_IMPORT_ERROR_MESSAGE.lower() or "tclerror" in TKINTER_IMPORT_ERROR_MESSAGE.lower():
+        elif "display" in tkinter_error_message.lower() or "tclerror" in tkinter_error_message.lower():
             user_error_message += " Ensure a display environment is available (e.g., for Linux/WSL, ensure X11/WSLg is working)."
 
         return jsonify({"error": user_error_message, "selected_path": None}), 501
 
     try:
-        # Re-import locally in case the initial global import failed but condition changed (unlikely but safer)
         from tkinter import Tk, filedialog
 
         root = Tk()
@@ -344,14 +1140,43 @@ def browse_for_directory_api():
 
 
 @app.get("/api/tree")
+@traced("tree")
 def api_tree():
+    """Lazy jsTree nodes: the root (with two levels preloaded) for id "#", else a directory's children.
+
+    Children come a page at a time ("limit", default TREE_PAGE_SIZE, 0 for all; "cursor" from the page before;
+    "filter" to keep the names containing it; "until" to reach a given name), the last page of a directory
+    being followed by a "more" node holding the page's "page" info. With "compact", a directory's children
+    come as {"id", "sep", "nodes", "page"} with compact_js_node nodes and no "more" node.
+    With "rev" (and "repo", which defaults to "path"), directories are listed as of that git revision.
+    """
+    matcher = get_exclusion_matcher(active_exclusion_rules())
     node_id_param = request.args.get("id")
     initial_path_param = request.args.get("path")
+    path_str = initial_path_param if initial_path_param else str(INITIAL_ROOT_DIR)
+    try:
+        revision = revision_from_request(request.args, default_repo=path_str if node_id_param == "#" else None)
+        page_options = tree_page_options(request.args)
+    except ValueError as e:
+        if node_id_param == "#":
+            return tree_response([_error_js_node(path_str, f"{Path(path_str).name or path_str} ({e})")])
+        return jsonify({"error": str(e)}), 400
+    # Everything in a revision is tracked, so ignore files do not apply to it
+    ignore_rules = IgnoreFileRules() if request_flag(request.args.get("ignore_files")) and revision is None else None
+
+    def is_directory(path: Path) -> bool:
+        return revision.is_dir(path) if revision is not None else path.is_dir()
+
+    def paged_children(dir_id: str, **options) -> List[dict]:
+        """A page of a directory's nodes, followed by its "more" node when there is more to show."""
+        nodes, page = list_directory_nodes(dir_id, matcher, ignore_rules, revision, **options)
+        if page.cursor is not None or options.get("name_filter"):
+            nodes.append(_more_js_node(page_info(dir_id, page, options.get("name_filter", ""))))
+        return nodes
 
     current_scan_path = None
 
     if node_id_param == "#":
-        path_str = initial_path_param if initial_path_param else str(INITIAL_ROOT_DIR)
         try:
             current_scan_path = Path(path_str).resolve()
         except Exception as e:
@@ -364,9 +1189,9 @@ def api_tree():
                 "children": False,
                 "data": {"excluded_info": None},
             }
-            return jsonify([error_node])
+            return tree_response([error_node])
 
-        if not current_scan_path.exists() or not current_scan_path.is_dir():
+        if not is_directory(current_scan_path):
             display_name = current_scan_path.name if current_scan_path.name else str(current_scan_path)
             error_node = {
                 "id": str(current_scan_path),
@@ -376,19 +1201,17 @@ def api_tree():
                 "children": False,
                 "data": {"excluded_info": None},
             }
-            return jsonify([error_node])
+            return tree_response([error_node])
 
-        root_node_obj = dir_to_js_lazy(current_scan_path)
+        root_node_obj = dir_to_js_lazy(current_scan_path, ignore_rules, revision)
         root_node_obj["state"] = {"opened": True}
+        search_index_for(current_scan_path, revision)  # Index in the background, ready for the first search
 
-        # Preload level 1 children
+        # Preload level 1 children (their first page)
         level1_nodes = []
         try:
-            items = sorted(list(current_scan_path.iterdir()), key=lambda p: (not p.is_dir(), p.name.lower()))
-            for child_item in items:
-                child_node = dir_to_js_lazy(child_item)
-
-                if child_item.is_dir():
+            for child_node in paged_children(str(current_scan_path), limit=page_options["limit"]):
+                if child_node["type"] == "folder":
                     # Determine if excluded by rules (based on node data computed in dir_to_js_lazy)
                     is_excluded = child_node.get("data", {}).get("excluded_info") is not None
 
@@ -399,16 +1222,11 @@ def api_tree():
                         # Preload level 2 children ONLY for non-excluded directories
                         level2_nodes = []
                         try:
-                            sub_items = sorted(
-                                list(child_item.iterdir()), key=lambda p: (not p.is_dir(), p.name.lower())
-                            )
-                            for sub_child_item in sub_items:
-                                sub_child_node = dir_to_js_lazy(sub_child_item)
-                                level2_nodes.append(sub_child_node)
+                            level2_nodes = paged_children(child_node["id"], limit=page_options["limit"])
                         except PermissionError:
-                            app.logger.warning(f"Permission denied while listing level 2 children of {child_item}")
+                            app.logger.warning(f"Permission denied while listing level 2 children of {child_node['id']}")
                         except Exception as e:
-                            app.logger.error(f"Error listing level 2 children for {child_item}: {e}")
+                            app.logger.error(f"Error listing level 2 children for {child_node['id']}: {e}")
                         child_node["children"] = level2_nodes
                     else:
                         # Keep excluded directories lazily closed (children True so user can open manually if desired)
@@ -421,218 +1239,341 @@ def api_tree():
             app.logger.error(f"Error listing level 1 children for {current_scan_path}: {e}")
 
         root_node_obj["children"] = level1_nodes
-        return jsonify([root_node_obj])
+        return tree_response([root_node_obj])
     else:
+        compact = request_flag(request.args.get("compact"))
         try:
             current_scan_path = Path(node_id_param).resolve()
         except Exception as e:
             app.logger.error(f"Invalid node ID path resolution for '{node_id_param}': {e}")
-            return jsonify([])
+            return tree_response({"id": node_id_param, "sep": os.sep, "nodes": [], "page": None} if compact else [])
 
-        if not current_scan_path.is_dir():
-            return jsonify([])
+        dir_id = str(current_scan_path)
+        if not is_directory(current_scan_path):
+            return tree_response({"id": dir_id, "sep": os.sep, "nodes": [], "page": None} if compact else [])
 
-        children_nodes = []
+        children_nodes, info = [], None
         try:
             # Sort directories first, then files, all alphabetically
-            items = sorted(list(current_scan_path.iterdir()), key=lambda p: (not p.is_dir(), p.name.lower()))
-            for child_item in items:
-                children_nodes.append(dir_to_js_lazy(child_item))
+            if compact:
+                nodes, page = list_directory_nodes(dir_id, matcher, ignore_rules, revision, **page_options)
+                children_nodes = [compact_js_node(node, entry.name, dir_id) for node, entry in zip(nodes, page.entries)]
+                info = page_info(dir_id, page, page_options["name_filter"])
+            else:
+                children_nodes = paged_children(dir_id, **page_options)
         except PermissionError:
             app.logger.warning(f"Permission denied while listing children of {current_scan_path}")
         except Exception as e:
             app.logger.error(f"Error listing children for {current_scan_path}: {e}")
-        return jsonify(children_nodes)
+        if compact:
+            return tree_response({"id": dir_id, "sep": os.sep, "nodes": children_nodes, "page": info})
+        return tree_response(children_nodes)
+
+
+@app.get("/api/search")
+def api_search():
+    """Paths below the tree root "path" whose names fuzzy-match "q", or with "content" the files containing "q".
+
+    Answered from the root's search index (see SEARCH_INDEXES), so it never walks the tree itself; "complete" is
+    false while the index is still being built, and results then cover what is indexed so far. Each result has
+    the ids of the directories to open, root first, to reveal its node in the tree.
+    """
+    started = time.perf_counter()
+    query = request.args.get("q", "").strip()
+    path_str = request.args.get("path") or str(INITIAL_ROOT_DIR)
+    content = request_flag(request.args.get("content"))
+    try:
+        limit = int(request.args.get("limit") or DEFAULT_MAX_RESULTS)
+    except ValueError:
+        return jsonify({"error": "limit must be a whole number."}), 400
+    limit = max(1, min(limit, MAX_SEARCH_RESULTS))
+    try:
+        revision = revision_from_request(request.args, default_repo=path_str)
+        root = Path(path_str).resolve()
+        if not (revision.is_dir(root) if revision is not None else root.is_dir()):
+            raise ValueError(f"Not a directory: {path_str}")
+        index = search_index_for(root, revision)
+        ignore_rules = IgnoreFileRules() if request_flag(request.args.get("ignore_files")) and revision is None else None
+
+        def is_ignored(path: str, is_dir: bool) -> bool:
+            return ignore_rules.match(path, is_dir) is not None
+
+        is_excluded = is_ignored if ignore_rules is not None else None
+        if content:
+            index.enable_content()
+            result = index.search_content(query, limit, is_excluded)
+        else:
+            result = index.search(query, limit, is_excluded)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    results = []
+    for hit in result.hits:
+        item = {
+            "id": hit.node_id,
+            "path": hit.path,
+            "name": os.path.basename(hit.path),
+            "type": "folder" if hit.is_dir else "file",
+            "ancestors": index.ancestors(hit.path),
+        }
+        if hit.line is not None:
+            item.update({"line": hit.line, "snippet": hit.snippet})
+        else:
+            item["score"] = hit.score
+        results.append(item)
+    summary = {"paths": index.path_count}
+    if index.content is not None:
+        summary.update({"files": index.content.file_count, "bytes": index.content.indexed_bytes})
+    return jsonify(
+        {
+            "results": results,
+            "complete": result.complete,
+            "truncated": result.truncated,
+            "indexed": summary,
+            "took_ms": round((time.perf_counter() - started) * 1000, 2),
+        }
+    )
 
 
 @app.post("/api/flatten")
+@traced("flatten")
 def api_flatten():
-    global ACTIVE_EXCLUSION_RULES
     data = request.get_json(force=True)  # Add force=True if content-type might be an issue
-    raw_paths_from_client = data.get("paths", [])
-    token_count = 0
-    model_percentages = []
-
-    resolved_paths_for_structure_set = set()
-    files_to_process_set = set()
-
-    initial_selection_nodes = []
-    for p_str in raw_paths_from_client:
+    try:
+        flattener = new_flattener(revision_from_request(data))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        result = flatten_result(flattener, data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    with span("respond"):
+        return jsonify(result)
+
+
+@app.post("/api/flatten/stream")
+@traced("flatten_stream")
+def api_flatten_stream():
+    """Same output as /api/flatten, sent as newline-delimited JSON while it is produced.
+
+    Records are {"type": "text", "text": ...} in output order (the ASCII tree first, then each file as it is
+    read), then one {"type": "summary", "token_count": ..., "token_counts": {...}, "model_percentages": [...],
+    "skipped": [...]} record (with "packing" when a token budget was given, "changes" with "since", "snapshot"
+    when one was asked for, and the "commit" read when the request named a git revision), or an {"type": "error", "error": ...}
+    record if generation fails part way. Only a bounded number of files is held in memory at any time. Shards
+    are not streamed: a request with shard options gets a 400.
+    """
+    data = request.get_json(force=True)
+    try:
+        flattener = new_flattener(revision_from_request(data))
+        selection = request_selection(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    plan = flattener.plan(selection.include, ignore_files=request_flag(data.get("ignore_files")), excluded=selection.exclude)
+    count_plan(plan)
+    selection_key = snapshot_selection(flattener, selection, data)
+    try:
+        if token_limit_from_request(data, "shard") is not None:
+            raise ValueError("Shards are not streamed: use /api/flatten for shard_tokens or shard_model.")
+        snapshot = snapshot_mode(data)
+        with span("changes"):
+            changed = plan_changes(flattener, plan, data, selection_key)
+        with span("packing"):
+            flattener, packing = plan_packing(flattener, plan, data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def generate():
+        if changed is not None:
+            previous, current, changes = changed
+            segments = iter_change_segments(flattener, plan, changes, SNAPSHOTS, previous, data.get("diff") or "files")
+        else:
+            current, segments = None, flattener.iter_segments(plan, packing)
+        token_counter = flattener.new_model_counter()
         try:
-            path_item = Path(p_str).resolve()
+            for text, file_key, final in traced_segments(segments):
+                with span("tokenize"):
+                    token_counter.add(text, file_key, final)
+                yield json.dumps({"type": "text", "text": text}) + "\n"
+            with span("tokenize"):
+                counts = token_counter.counts()
+            count("tokens", max(output_token_count(counts), 0))
+            summary = {
+                "type": "summary",
+                "token_count": output_token_count(counts),
+                "token_counts": counts.by_encoding,
+                "model_percentages": model_percentages_for(plan, counts),
+                "skipped": Flattener.skipped_report(plan),
+            }
+            if packing is not None:
+                summary["packing"] = packing.to_json()
+            if flattener.source is not None:
+                summary["commit"] = flattener.source.commit
+            if changed is not None:
+                summary["changes"] = changes.to_json()
+            snapshot_id = record_snapshot(flattener, plan, packing, selection_key, snapshot, current)
+            if snapshot_id is not None:
+                summary["snapshot"] = snapshot_id
+            if request_flag(data.get("debug")) and current_trace() is not None:
+                summary["debug"] = current_trace().breakdown()
+            yield json.dumps(summary) + "\n"
         except Exception as e:
-            app.logger.warning(f"Flatten: Invalid path string {p_str} from client: {e}. Skipping.")
-            continue
+            app.logger.error(f"Flatten stream failed: {e}")
+            yield json.dumps({"type": "error", "error": f"Generation failed: {e}"}) + "\n"
+        finally:
+            token_counter.close()
 
-        if not path_item.exists():
-            app.logger.warning(f"Flatten: Selected path {p_str} (resolved to {path_item}) does not exist. Skipping.")
-            continue
+    return Response(generate(), mimetype="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
 
-        exclusion_info = check_if_item_is_excluded(path_item, ACTIVE_EXCLUSION_RULES)
-        if exclusion_info:
-            app.logger.debug(
-                f"Flatten: Directly selected item {path_item} is excluded by rule: {exclusion_info}. Skipping."
-            )
-            continue
-        initial_selection_nodes.append(path_item)
 
-    queue = list(initial_selection_nodes)
-    visited_for_walk = set()
+@app.post("/api/flatten/jobs")
+def submit_flatten_job_api():
+    """Start a flatten in the background and return its job id ({"id": ..., "state": "queued", ...}) at once.
 
-    while queue:
-        current_path = queue.pop(0)
+    Takes the same options as /api/flatten. Poll GET /api/flatten/jobs/<id> for progress and, once done, the
+    result; a full job queue is answered with 503.
+    """
+    data = request.get_json(force=True)
+    try:
+        source = revision_from_request(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-        if current_path in visited_for_walk and current_path.is_dir():  # Avoid re-processing dirs already fully walked
-            continue
+    def run(job: FlattenJob) -> dict:
+        trace = RequestTrace("flatten_job")
+        try:
+            with tracing(trace):
+                return flatten_result(new_flattener(source, job.cancel_event), data, job)
+        finally:
+            METRICS.record(trace)
 
-        if current_path.is_dir():
-            visited_for_walk.add(current_path)
-
-        # Crucially, items passed directly by user are added to structure/content regardless of their *own* exclusion,
-        # UNLESS they were filtered out by `initial_selection_nodes` block above.
-        # Exclusion rules primarily apply to *children* discovered during directory traversal.
-        if current_path not in initial_selection_nodes:  # Only check exclusion for *descendants*, not original selections
-            exclusion_info = check_if_item_is_excluded(current_path, ACTIVE_EXCLUSION_RULES)
-            if exclusion_info:
-                app.logger.debug(
-                    f"Flatten: Traversed item {current_path} excluded by rule: {exclusion_info}. Skipping its children."
-                )
-                continue
-
-        resolved_paths_for_structure_set.add(current_path)  # Add all traversable, non-excluded items to structure
-
-        if current_path.is_file():
-            files_to_process_set.add(current_path)
-        elif current_path.is_dir():
-            try:
-                # Sort children for consistent processing order
-                children = sorted(list(current_path.iterdir()), key=lambda p: (not p.is_dir(), p.name.lower()))
-                for child_item in children:  # Add all children to queue; they'll be checked for exclusion when popped
-                    queue.append(child_item)
-            except PermissionError:
-                app.logger.warning(f"Flatten: Permission error iterating directory {current_path}")
-            except Exception as e:
-                app.logger.error(f"Flatten: Error iterating directory {current_path}: {e}")
-
-    if not resolved_paths_for_structure_set and not files_to_process_set:
-        text_content = "No files or directories selected, or all selected items/contents are excluded by current rules."
-        if ENCODING:
-            try:
-                tokens = ENCODING.encode(text_content, disallowed_special=())
-                token_count = len(tokens)
-            except Exception as e:
-                app.logger.error(f"Error tokenizing message: {e}")
-        if token_count > 0:  # Or >=0 if you want to show models even for 0 tokens
-            for model in MODEL_CONTEXT_INFO:
-                percentage = (
-                    round((token_count / model["window"]) * 100, 2) if model["window"] > 0 else (100.0 if token_count > 0 else 0.0)
-                )
-                model_percentages.append({"name": model["displayName"], "percentage": (0.01 if 0 < percentage < 0.01 else percentage)})
-        return jsonify({"text": text_content, "token_count": token_count, "model_percentages": model_percentages})
-
-    final_resolved_paths_for_structure = sorted(list(resolved_paths_for_structure_set), key=lambda p: str(p).lower())
-    final_files_to_process = sorted(list(files_to_process_set), key=lambda p: str(p).lower())
-
-    header = ""
-    common_ancestor_for_tree = None
-    if not final_resolved_paths_for_structure:
-        header = "No valid paths for structure (after exclusion).\n\n"
-    else:
+    try:
+        job = FLATTEN_JOBS.submit(run)
+    except QueueFull as e:
+        return jsonify({"error": str(e)}), 503
+    return jsonify(job.to_json()), 202
+
+
+@app.get("/api/flatten/jobs/<job_id>")
+def flatten_job_api(job_id: str):
+    """A flatten job's state ("queued", "running", "done", "failed" or "cancelled") and progress: "files_done"
+    of "files_total" files read, their "bytes" and the "tokens" counted so far. A done job carries the
+    /api/flatten response as "result" (unless asked with ?result=0); a failed one its "error". Finished jobs are
+    kept for FLATTEN_JOB_RESULT_TTL seconds.
+
+    With ?text_from=<offset>, a running job also returns the output produced after that character offset as
+    "text", and the offset it reaches as "text_end" (the next text_from), to show the output as it grows.
+    """
+    job = FLATTEN_JOBS.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired flatten job."}), 404
+    data = job.to_json(with_result=request_flag(request.args.get("result", "1")))
+    if request.args.get("text_from") is not None:
         try:
-            abs_path_strings_for_commonpath = [str(p.resolve()) for p in final_resolved_paths_for_structure]
-            if not abs_path_strings_for_commonpath:
-                common_ancestor_for_tree = Path(".").resolve()  # Fallback
-            else:
-                common_ancestor_str = os.path.commonpath(abs_path_strings_for_commonpath)
-                common_ancestor_for_tree = Path(common_ancestor_str)
-                if common_ancestor_for_tree.is_file():  # commonpath can return a file if all paths are that file
-                    common_ancestor_for_tree = common_ancestor_for_tree.parent
-        except ValueError:  # commonpath raises ValueError if paths are on different drives (Windows)
-            common_ancestor_for_tree = Path(".").resolve()  # Fallback
-
-        subset = build_nested_dict(final_resolved_paths_for_structure, common_ancestor_for_tree)
-
-        header_root_name_display = ""
-        if common_ancestor_for_tree:
-            name_to_display = common_ancestor_for_tree.name
-            # Handle cases where common_ancestor is root (e.g., '/', 'C:\') or '.'
-            if not name_to_display or name_to_display == "." and str(common_ancestor_for_tree) != ".":
-                name_to_display = str(common_ancestor_for_tree)
-            elif name_to_display == "." and str(common_ancestor_for_tree) == ".":
-                name_to_display = "Selected Structure"  # Or APP_ROOT.name or similar context
-            header_root_name_display = f"{name_to_display}/\n" if name_to_display else "Selected Structure/\n"
-        else:  # Should ideally not happen if common_ancestor_for_tree is set
-            header_root_name_display = "Selected Structure/\n"
-
-        header = "code base:\n" + header_root_name_display + "\n".join(ascii_tree(subset)) + "\n\n"
-
-    body_parts = ["Context files:\n"]
-    if not final_files_to_process:
-        body_parts.append("No files selected/accessible/found (after exclusion and directory expansion).\n")
-    else:
-        for f_path in final_files_to_process:
-            display_f_path_str = ""
-            try:
-                if common_ancestor_for_tree and common_ancestor_for_tree.is_dir():
-                    try:
-                        # Attempt to make path relative to the common ancestor for display
-                        display_f_path_str = str(f_path.relative_to(common_ancestor_for_tree))
-                    except ValueError:  # path is not under common_ancestor (e.g. different drive, or complex selection)
-                        display_f_path_str = f".../{f_path.parent.name}/{f_path.name}" if f_path.parent and f_path.parent.name else f_path.name
-                else:  # Fallback if no good common_ancestor
-                    display_f_path_str = f".../{f_path.parent.name}/{f_path.name}" if f_path.parent and f_path.parent.name else f_path.name
-
-                content = f_path.read_text(encoding="utf-8", errors="replace")
-                body_parts.append(f"{display_f_path_str}\n\"\"\"\n{content}\n\"\"\"\n\n")
-            except UnicodeDecodeError:
-                body_parts.append(f"{display_f_path_str}\n\"\"\"\n[binary file or undecodable content skipped]\n\"\"\"\n\n")
-            except Exception as e:
-                body_parts.append(f"{display_f_path_str}\n\"\"\"\n[Error reading file: {e}]\n\"\"\"\n\n")
-
-    final_text = header + "".join(body_parts)
-    if ENCODING:
+            offset = int(request.args["text_from"])
+        except ValueError:
+            return jsonify({"error": "text_from must be a whole number."}), 400
+        data["text"], data["text_end"] = job.text_from(max(offset, 0))
+    return jsonify(data)
+
+
+@app.post("/api/flatten/jobs/<job_id>/cancel")
+def cancel_flatten_job_api(job_id: str):
+    """Stop a flatten job: a queued job never starts, a running one stops walking and reading files mid-way."""
+    job = FLATTEN_JOBS.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired flatten job."}), 404
+    return jsonify(job.to_json())
+
+
+@app.post("/api/estimate")
+def api_estimate():
+    """What a flatten of the selection would hold, without producing it: file count, bytes and tokens per model.
+
+    Takes the same "selection" (or "paths", or "preset"), "ignore_files" and "rev"/"repo" as /api/flatten. Token counts come from the token
+    cache where it knows a file's current version and are estimated from file sizes elsewhere; nothing but the
+    first bytes of uncached files is read. Sent as newline-delimited JSON: {"type": "progress", ...} records
+    with running totals while a large selection is looked at, then one {"type": "summary", "files": ...,
+    "bytes": ..., "skipped": ..., "token_count": ..., "token_counts": {...}, "estimated": [...],
+    "model_percentages": [...]} record, or an {"type": "error", "error": ...} record. "estimated" lists the
+    encodings whose count is not exact. Closing the connection stops the estimate.
+    """
+    data = request.get_json(force=True)
+    try:
+        flattener = new_flattener(revision_from_request(data))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    ignore_files = request_flag(data.get("ignore_files"))
+
+    def generate():
         try:
-            tokens = ENCODING.encode(final_text, disallowed_special=())  # Consider allowed_special if needed
-            token_count = len(tokens)
+            selection = request_selection(data)
+            plan = plan_flatten(
+                selection.include, flattener.exclusion_rules, ignore_files, flattener.source, excluded=selection.exclude
+            )
+            for estimate in iter_estimate(flattener, plan):
+                if not estimate.done:
+                    yield json.dumps({"type": "progress", **estimate.to_json()}) + "\n"
+                    continue
+                counts = TokenCounts(estimate.token_counts(), estimate.chars)
+                estimated = estimate.estimated_encodings()
+                summary = {
+                    "type": "summary",
+                    **estimate.to_json(),
+                    "token_count": output_token_count(counts),
+                    "model_percentages": model_percentages_for(plan, counts, tuple(estimated)),
+                }
+                if flattener.source is not None:
+                    summary["commit"] = flattener.source.commit
+                yield json.dumps(summary) + "\n"
         except Exception as e:
-            app.logger.error(f"Error tokenizing final text: {e}")
-            token_count = -1  # Indicate error
-    else:
-        app.logger.warning("Tiktoken encoding not available. Token count 0.")
-        # token_count remains 0
-
-    if token_count >= 0:  # Valid token count (0 or more)
-        for model in MODEL_CONTEXT_INFO:
-            if token_count == 0 and model["window"] == 0:  # Avoid division by zero if both are zero
-                percentage = 0.0
-            elif model["window"] == 0:  # Model has "infinite" window or not applicable
-                percentage = 100.0 if token_count > 0 else 0.0  # Full if there are tokens, else 0
-            else:
-                percentage = round((token_count / model["window"]) * 100, 2)
+            app.logger.error(f"Estimate failed: {e}")
+            yield json.dumps({"type": "error", "error": f"Estimate failed: {e}"}) + "\n"
 
-            # Ensure very small percentages are still visible (e.g., 0.01%)
-            model_percentages.append(
-                {"name": model["displayName"], "percentage": (0.01 if 0 < percentage < 0.01 else percentage)}
-            )
-    elif token_count == -1:  # Tokenization error
-        model_percentages.append({"name": "LLMs", "percentage": "N/A (Tokenization Error)"})
+    return Response(generate(), mimetype="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
 
-    return jsonify({"text": final_text, "token_count": token_count, "model_percentages": model_percentages})
+
+@app.get("/api/snapshots")
+def list_snapshots_api():
+    """The stored flatten snapshots, newest first, for use as "since" in /api/flatten."""
+    if SNAPSHOTS is None:
+        return jsonify({"snapshots": []})
+    return jsonify({"snapshots": [manifest.summary() for manifest in SNAPSHOTS.list()]})
 
 
 # ---------------------------------------------------------- SELECTION PRESET ROUTES
+def preset_freshness(preset_id: str) -> Optional[dict]:
+    """How up to date the warmed output of a warm preset is (see WarmStatus), None while warming is off."""
+    if PRESET_WARMER is None:
+        return None
+    status = PRESET_WARMER.status(preset_id)
+    return status.to_json() if status is not None else {"state": "pending"}
+
+
 @app.get("/api/presets")
 def list_selection_presets_api():
+    """The selection presets; warm ones carry "warm": true and their "freshness"."""
+    PRESETS_BOOTSTRAP.get()  # So that the "default" preset is there on a fresh install
+    warm_ids = set(warm_preset_ids())
     presets = []
-    for p_file in sorted(DEFAULT_SELECTION_PRESETS_DIR.glob("*.json")):
-        presets.append({"name": p_file.stem, "type": "default", "id": f"default/{p_file.stem}"})
-    for p_file in sorted(USER_SELECTION_PRESETS_DIR.glob("*.json")):
-        presets.append({"name": p_file.stem, "type": "user", "id": f"user/{p_file.stem}"})
+    for preset_id in selection_preset_ids():
+        preset_type, name = preset_id.split("/", 1)
+        preset = {"name": name, "type": preset_type, "id": preset_id}
+        if preset_id in warm_ids:
+            preset.update(warm=True, freshness=preset_freshness(preset_id))
+        presets.append(preset)
     return jsonify(presets)
 
 
+@app.get("/api/presets/warm")
+def warm_presets_api():
+    """The freshness of each warm preset's output, by preset id, for the page to show without listing presets."""
+    return jsonify({preset_id: preset_freshness(preset_id) for preset_id in warm_preset_ids()})
+
+
 @app.get("/api/presets/<path:preset_id>")
 def load_selection_preset_api(preset_id: str):
+    """A preset's selection: {"include": [...], "exclude": [...]}, absolute paths."""
     try:
         preset_type, name = preset_id.split("/", 1)
     except ValueError:
@@ -641,24 +1582,12 @@ def load_selection_preset_api(preset_id: str):
     if not p or not p.exists():
         return jsonify({"error": f"Preset '{name}' of type '{preset_type}' not found"}), 404
     try:
-        paths_from_preset_file = json.loads(p.read_text(encoding="utf-8"))
-        resolved_absolute_paths = []
-        if isinstance(paths_from_preset_file, list):
-            for path_str_in_file in paths_from_preset_file:
-                path_obj = Path(path_str_in_file)
-                # If path is relative, it's assumed to be relative to APP_ROOT
-                # If absolute, it's used as is.
-                # Presets should ideally store paths relative to APP_ROOT or be very explicit about absolute paths.
-                if not path_obj.is_absolute():
-                    path_obj = (APP_ROOT / path_obj).resolve()
-                else:
-                    path_obj = path_obj.resolve()  # Ensure absolute paths are also resolved (e.g. symlinks)
-                resolved_absolute_paths.append(str(path_obj))
-            return jsonify(resolved_absolute_paths)
-        else:
-            return jsonify({"error": "Invalid preset file format (expected a list of paths)"}), 500
+        selection = load_selection_preset(p).selection
+        return jsonify({"include": list(selection.include), "exclude": list(selection.exclude)})
     except json.JSONDecodeError as e:
         return jsonify({"error": f"Failed to parse preset JSON: {e}"}), 500
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 500
     except Exception as e:
         return jsonify({"error": f"Failed to load preset: {e}"}), 500
 
@@ -669,23 +1598,17 @@ def save_selection_preset_api(name: str):
     if not preset_file_path:
         return jsonify({"error": "Invalid preset name (contains invalid characters or is empty)."}), 400
     data = request.get_json(force=True)
-    absolute_paths_from_client = data.get("paths", [])  # Expecting a list of absolute paths from client
-    paths_to_save_in_preset = []
-
-    app_root_resolved = APP_ROOT.resolve()
-    for abs_path_str in absolute_paths_from_client:
-        path_obj = Path(abs_path_str).resolve()
-        try:
-            # Try to make path relative to APP_ROOT for portability
-            relative_path = path_obj.relative_to(app_root_resolved)
-            paths_to_save_in_preset.append(str(relative_path))
-        except ValueError:
-            # If not relative to APP_ROOT (e.g. different drive, or outside structure), save the absolute path
-            paths_to_save_in_preset.append(str(path_obj))
     try:
-        preset_file_path.parent.mkdir(parents=True, exist_ok=True)
-        preset_file_path.write_text(json.dumps(paths_to_save_in_preset, indent=2), encoding="utf-8")
-        return jsonify({"saved": True, "id": f"user/{name}", "name": name, "type": "user"})
+        # The page sends its compact "selection"; a plain list of absolute "paths" is accepted too
+        selection = parse_selection(data["selection"]) if data.get("selection") is not None else Selection(data.get("paths", []))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    warm = request_flag(data.get("warm"))
+    try:
+        save_selection_preset(preset_file_path, selection, warm, request_flag(data.get("ignore_files")))
+        if warm and PRESET_WARMER is not None:
+            PRESET_WARMER.start().wake(f"user/{name}")
+        return jsonify({"saved": True, "id": f"user/{name}", "name": name, "type": "user", "warm": warm})
     except Exception as e:
         return jsonify({"error": f"Failed to save user preset: {e}"}), 500
 
@@ -711,55 +1634,16 @@ def delete_selection_preset_api(preset_id: str):
         return jsonify({"error": f"Failed to delete preset: {e}"}), 500
 
 
-if __name__ == "__main__":
-    def create_default_selection_preset(preset_name: str, relative_paths_to_store: List[str]):
-        preset_file = DEFAULT_SELECTION_PRESETS_DIR / f"{preset_name}.json"
-
-        # Special handling for the "default" preset to ensure it exists, possibly empty
-        if preset_name == "default" and not preset_file.exists():
-            try:
-                preset_file.parent.mkdir(parents=True, exist_ok=True)
-                # Create it empty if paths are not provided or not valid for "default"
-                preset_file.write_text(
-                    json.dumps(relative_paths_to_store if relative_paths_to_store else [], indent=2), encoding="utf-8"
-                )
-                app.logger.info(f"Created empty default selection preset: {preset_file.name}")
-            except Exception as e:
-                app.logger.error(f"Could not create empty default preset {preset_file.name}: {e}")
-            return  # Exit after creating the 'default' preset
-
-        # For other default presets (if any in future) or if 'default' exists and we want to populate it (though current logic creates it empty above)
-        verified_paths_to_store = []
-        for rel_path_str in relative_paths_to_store:
-            abs_path = (APP_ROOT / Path(rel_path_str)).resolve()  # Paths are relative to APP_ROOT
-            if abs_path.exists():
-                verified_paths_to_store.append(rel_path_str)  # Store the original relative string
-            else:
-                app.logger.warning(
-                    f"Default preset '{preset_name}': path '{rel_path_str}' not found relative to APP_ROOT. Skipping."
-                )
-
-        if not preset_file.exists() and verified_paths_to_store:  # Only create if it doesn't exist AND there's something to save
-            try:
-                preset_file.parent.mkdir(parents=True, exist_ok=True)
-                preset_file.write_text(json.dumps(verified_paths_to_store, indent=2), encoding="utf-8")
-                app.logger.info(
-                    f"Created default selection preset: {preset_file.name} with {len(verified_paths_to_store)} items."
-                )
-            except Exception as e:
-                app.logger.error(f"Could not create default preset {preset_file.name}: {e}")
-        elif preset_file.exists() and verified_paths_to_store:  # If it exists, don't overwrite from this function, admin should manage it.
-            app.logger.info(
-                f"Default selection preset '{preset_file.name}' already exists. Not overwriting with verified paths."
-            )
-        elif not preset_file.exists() and not verified_paths_to_store and preset_name != "default":  # Don't create if no valid paths unless it's the special "default"
-            app.logger.info(f"Default selection preset '{preset_name}' not created as no verified paths were provided.")
+# `python app.py` runs the development server with the reloader: the module then also runs in the watching
+# parent process, which never serves requests (the serving child has WERKZEUG_RUN_MAIN set)
+USE_RELOADER = True
 
-    # Ensure a "default.json" selection preset exists (can be empty)
-    create_default_selection_preset("default", [])
-    # Example of creating another default preset if needed:
-    # create_default_selection_preset("my_app_core_files", ["app.py", "static/js/main.js", "templates/index.html"])
+# Start the deferred startup work without waiting for it, as soon as the module is loaded (also when a WSGI
+# server or another program imports it), except in the reloader's watching process
+if not (__name__ == "__main__" and USE_RELOADER and os.environ.get("WERKZEUG_RUN_MAIN") != "true"):
+    start_background_startup()
 
+if __name__ == "__main__":
     # Run the Flask app
     # Set host='0.0.0.0' to make it accessible from the network
-    app.run(debug=True, port=5006, host="0.0.0.0")
+    app.run(debug=True, use_reloader=USE_RELOADER, port=5006, host="0.0.0.0")
@@ -0,0 +1,547 @@
+# treeb/bench.py
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+RESULTS_VERSION = 1
+APP_DIR = Path(__file__).resolve().parent
+# Every generated file gets this modification time, so that two generations of a spec are identical
+FIXED_MTIME = 1_600_000_000
+SOURCE_EXTENSIONS = [".py", ".js", ".ts", ".md", ".txt", ".json", ".yaml", ".c"]
+# Directory names the default exclusion rules leave out of the tree's selection and the output
+EXCLUDED_DIR_NAMES = ["build", "dist", "__pycache__", ".venv", "target", ".next", "bin"]
+BINARY_HEADERS = [b"\x89PNG\r\n\x1a\n", b"PK\x03\x04", b"\x7fELF", b"SQLite format 3\x00"]
+# Changes smaller than this are noise whatever their ratio
+MIN_REGRESSION_MS = 5.0
+DEFAULT_THRESHOLD = 0.10
+
+
+class RepoSpec(NamedTuple):
+    depth: int = 4  # Directory levels below the root
+    fanout: int = 4  # Subdirectories per directory
+    files_per_dir: int = 8
+    median_file_bytes: int = 2048  # File sizes are log-normal around this median
+    file_size_sigma: float = 1.0
+    max_file_bytes: int = 1024 * 1024
+    excluded_dir_ratio: float = 0.1  # Share of subdirectories named like build output (excluded by default)
+    binary_ratio: float = 0.05  # Share of files with binary content
+    node_modules_depth: int = 3  # Levels of nested packages in the root's node_modules; 0 for none
+    node_modules_fanout: int = 3  # Packages per node_modules directory
+    seed: int = 0
+
+
+PROFILES: Dict[str, RepoSpec] = {
+    "small": RepoSpec(depth=3, fanout=3, files_per_dir=6, node_modules_depth=2),
+    "medium": RepoSpec(),
+    "large": RepoSpec(depth=5, fanout=5, files_per_dir=10, node_modules_depth=4, node_modules_fanout=4),
+}
+
+
+class RepoStats(NamedTuple):
+    dirs: int
+    files: int
+    bytes: int
+    excluded_dirs: int
+    binary_files: int
+    node_modules_files: int
+    deep_path: str  # Relative path of the deepest directory reachable without passing an excluded one
+    digest: str  # sha256 over every path and content: equal digests mean identical repositories
+
+
+def source_line_pool(rng: random.Random, count: int = 2048) -> List[str]:
+    words = ["self", "value", "items", "config", "result", "path", "node", "index", "count", "data", "tree", "token"]
+    templates = [
+        "def {a}_{b}({c}, {d}=None):",
+        "    return {a}.{b}({c}) + {n}",
+        "    for {a} in {b}.{c}():",
+        "        {a}[{n}] = {b}.get('{c}', {n})",
+        "class {A}{B}({C}):",
+        "    \"\"\"{A} {b} of the {c} {d}.\"\"\"",
+        "    if {a} is not None and {b} > {n}:",
+        "# {A} {b} {c}: {n} {d}",
+        "{a} = {{'{b}': {n}, '{c}': [{n}, {n}]}}",
+        "",
+    ]
+    lines = []
+    for _ in range(count):
+        picked = {key: rng.choice(words) for key in "abcd"}
+        picked.update({key.upper(): value.capitalize() for key, value in picked.items()})
+        picked["C"] = rng.choice(words).capitalize()
+        lines.append(rng.choice(templates).format(n=rng.randrange(1000), **picked))
+    return lines
+
+
+def text_content(rng: random.Random, pool_text: str, size: int) -> bytes:
+    """About `size` bytes of source-like text cut from the pool at line boundaries."""
+    parts = []
+    remaining = size
+    while remaining > 0:
+        start = pool_text.find("\n", rng.randrange(len(pool_text))) + 1
+        part = pool_text[start : start + remaining]
+        parts.append(part)
+        remaining -= len(part)
+    return "".join(parts).encode("utf-8")
+
+
+def file_size(rng: random.Random, spec: RepoSpec) -> int:
+    return max(1, min(int(rng.lognormvariate(math.log(spec.median_file_bytes), spec.file_size_sigma)), spec.max_file_bytes))
+
+
+def generate_repo(root: Path, spec: RepoSpec) -> RepoStats:
+    """Write the synthetic repository of `spec` under `root` (which must not exist yet).
+
+    The same spec always gives the same paths, contents and modification times.
+    """
+    rng = random.Random(spec.seed)
+    pool_text = "\n".join(source_line_pool(rng)) + "\n"
+    digest = hashlib.sha256()
+    counts = {"dirs": 0, "files": 0, "bytes": 0, "excluded_dirs": 0, "binary_files": 0, "node_modules_files": 0}
+
+    def write_file(path: Path, in_node_modules: bool):
+        size = file_size(rng, spec)
+        if rng.random() < spec.binary_ratio:
+            path = path.with_suffix(".bin")
+            content = rng.choice(BINARY_HEADERS) + rng.randbytes(size)
+            counts["binary_files"] += 1
+        else:
+            content = text_content(rng, pool_text, size)
+        path.write_bytes(content)
+        os.utime(path, (FIXED_MTIME, FIXED_MTIME))
+        digest.update(f"{path.relative_to(root)}\0{len(content)}\0".encode())
+        digest.update(content)
+        counts["files"] += 1
+        counts["bytes"] += len(content)
+        if in_node_modules:
+            counts["node_modules_files"] += 1
+
+    def write_dir(path: Path, level: int, excluded: bool):
+        path.mkdir(parents=True)
+        counts["dirs"] += 1
+        for index in range(spec.files_per_dir):
+            write_file(path / f"file_{index}{rng.choice(SOURCE_EXTENSIONS)}", False)
+        if level < spec.depth:
+            for index in range(spec.fanout):
+                # The first subdirectory is never excluded, so there is always a path to the deepest level
+                name = rng.choice(EXCLUDED_DIR_NAMES) if index > 0 and rng.random() < spec.excluded_dir_ratio else None
+                if not excluded and name is not None and not (path / name).exists():
+                    counts["excluded_dirs"] += 1
+                    write_dir(path / name, level + 1, True)
+                else:
+                    write_dir(path / f"dir_{level + 1}_{index}", level + 1, excluded)
+
+    def write_packages(path: Path, level: int):
+        path.mkdir(parents=True)
+        counts["dirs"] += 1
+        for index in range(spec.node_modules_fanout):
+            package = path / f"package_{level}_{index}"
+            package.mkdir()
+            counts["dirs"] += 1
+            for file_index in range(spec.files_per_dir):
+                write_file(package / f"module_{file_index}.js", True)
+            if level < spec.node_modules_depth:
+                write_packages(package / "node_modules", level + 1)
+
+    write_dir(root, 0, False)
+    if spec.node_modules_depth > 0:
+        write_packages(root / "node_modules", 1)
+    for dirpath, _, _ in os.walk(root):  # Now that nothing is added to them any more
+        os.utime(dirpath, (FIXED_MTIME, FIXED_MTIME))
+    deep_path = "/".join(f"dir_{level}_0" for level in range(1, spec.depth + 1))
+    return RepoStats(deep_path=deep_path, digest=digest.hexdigest(), **counts)
+
+
+def spec_key(spec: RepoSpec) -> str:
+    return hashlib.sha256(json.dumps(spec._asdict(), sort_keys=True).encode()).hexdigest()[:12]
+
+
+def prepare_repo(base_dir: Path, spec: RepoSpec) -> Tuple[Path, RepoStats]:
+    """The repository of `spec` under base_dir, generated unless a previous run left the same spec there."""
+    root = base_dir / "repo"
+    marker = base_dir / "spec.json"
+    if marker.exists():
+        try:
+            saved = json.loads(marker.read_text(encoding="utf-8"))
+            if saved["spec"] == spec._asdict() and root.is_dir():
+                return root, RepoStats(**saved["stats"])
+        except (ValueError, KeyError, TypeError):
+            pass
+    if root.exists():
+        raise ValueError(f"{root} exists but was not generated for this spec; remove it or use another --repo-dir")
+    base_dir.mkdir(parents=True, exist_ok=True)
+    stats = generate_repo(root, spec)
+    marker.write_text(json.dumps({"spec": spec._asdict(), "stats": stats._asdict()}, indent=2), encoding="utf-8")
+    return root, stats
+
+
+# ----------------------------------------------------------------- SCENARIOS
+# Each runs in a fresh child process, so that its first run meets cold in-process caches (listing cache,
+# token cache, git objects) and its peak RSS is its own. The OS page cache stays warm after generation.
+
+
+class SyscallCounter:
+    """Syscalls made between start() and stop(): read and write calls from /proc/self/io (Linux; all threads),
+    plus file opens and directory listings seen by an audit hook."""
+
+    AUDITED = {"open": "open", "os.scandir": "scandir", "os.listdir": "listdir"}
+
+    def __init__(self):
+        self._events = dict.fromkeys(self.AUDITED.values(), 0)
+        self._active = False
+        self._start: Dict[str, int] = {}
+        sys.addaudithook(self._hook)
+
+    def _hook(self, event: str, _args):
+        if self._active and event in self.AUDITED:
+            self._events[self.AUDITED[event]] += 1
+
+    @staticmethod
+    def _proc_io() -> Dict[str, int]:
+        try:
+            with open("/proc/self/io", encoding="ascii") as f:
+                fields = dict(line.split(":", 1) for line in f if ":" in line)
+        except OSError:
+            return {}
+        return {"read": int(fields.get("syscr", 0)), "write": int(fields.get("syscw", 0))}
+
+    def start(self):
+        self._events = dict.fromkeys(self._events, 0)
+        self._start = self._proc_io()
+        self._active = True
+
+    def stop(self) -> Dict[str, int]:
+        self._active = False
+        end = self._proc_io()
+        counts = {name: end[name] - self._start[name] for name in end if name in self._start}
+        counts.update(self._events)
+        return counts
+
+
+def peak_rss_kb() -> Optional[int]:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak  # Bytes on macOS, KB elsewhere
+
+
+def checked(response):
+    if response.status_code not in (200, 304):
+        raise RuntimeError(f"{response.request.path}: HTTP {response.status_code}: {response.get_data(as_text=True)[:200]}")
+    return response
+
+
+def scenario_tree_root(app_module, client, repo: Path) -> Callable[[], None]:
+    """The tree's first load: the root with two levels preloaded."""
+    return lambda: checked(client.get("/api/tree", query_string={"id": "#", "path": str(repo)}))
+
+
+def scenario_tree_deep(app_module, client, repo: Path, deep_path: str) -> Callable[[], None]:
+    """Expanding one directory after the other from the root down to the deepest level."""
+    chain = [repo]
+    for part in deep_path.split("/") if deep_path else []:
+        chain.append(chain[-1] / part)
+
+    def run():
+        for directory in chain:
+            checked(client.get("/api/tree", query_string={"id": str(directory)}))
+
+    return run
+
+
+def scenario_flatten(app_module, client, repo: Path) -> Callable[[], None]:
+    """Generate for the whole repository: walk, read and count tokens (cold token cache on the first run)."""
+    return lambda: checked(client.post("/api/flatten", json={"paths": [str(repo)]}))
+
+
+def scenario_flatten_cached(app_module, client, repo: Path) -> Callable[[], None]:
+    """The same Generate through the result cache: the first run stores the output, the others are answered
+    from it after a stat of each directory and file."""
+    return lambda: checked(client.post("/api/flatten", json={"paths": [str(repo)]}))
+
+
+def scenario_tokenize(app_module, client, repo: Path) -> Callable[[], None]:
+    """Counting the tokens of the flatten output with every encoding, without the token cache or any reading."""
+    flattener = app_module.new_flattener()
+    flattener.token_cache = None
+    plan = flattener.plan([str(repo)])
+    segments = list(flattener.iter_segments(plan))
+
+    def run():
+        counter = flattener.new_model_counter()
+        try:
+            for segment in segments:
+                counter.add(segment.text, None, segment.final)
+            counter.counts()
+        finally:
+            counter.close()
+
+    return run
+
+
+SCENARIOS = ["tree_root", "tree_deep", "flatten", "flatten_cached", "tokenize"]
+
+
+def run_scenario(name: str, repo: Path, deep_path: str, work_dir: Path, repeat: int) -> dict:
+    """Run one scenario `repeat` times in this process (see run_in_child)."""
+    os.environ["TREEB_WARM_INTERVAL"] = "0"  # Importing app would start flattening warm presets in the background
+    sys.path.insert(0, str(APP_DIR))
+    import app as app_module
+
+    from treeb.presets import default_exclusion_rules
+    from treeb.resultcache import ResultCache
+    from treeb.tokencache import TokenCountCache
+
+    token_db = work_dir / f"tokens-{name}.sqlite"
+    for stale in work_dir.glob(f"tokens-{name}.sqlite*"):
+        stale.unlink()
+    app_module.TOKEN_CACHE = TokenCountCache(token_db)
+    # The result cache under presets/cache would answer flattens stored by earlier runs (or by using the app):
+    # only flatten_cached uses one, emptied first
+    app_module.RESULT_CACHE = None
+    if name == "flatten_cached":
+        result_dir = work_dir / f"results-{name}"
+        shutil.rmtree(result_dir, ignore_errors=True)
+        app_module.RESULT_CACHE = ResultCache(result_dir)
+    app_module.PRESETS_BOOTSTRAP.set(default_exclusion_rules())
+    encodings = sorted(app_module.loaded_encodings())  # Loaded before timing anything
+    client = app_module.app.test_client()
+    if name == "tree_deep":
+        run = scenario_tree_deep(app_module, client, repo, deep_path)
+    else:
+        run = globals()[f"scenario_{name}"](app_module, client, repo)
+
+    counter = SyscallCounter()
+    setup_rss = peak_rss_kb()
+    times, syscalls = [], []
+    for _ in range(repeat):
+        counter.start()
+        started = time.perf_counter()
+        run()
+        times.append((time.perf_counter() - started) * 1000)
+        syscalls.append(counter.stop())
+        # The tree root starts its search index in the background: let it finish outside the next run
+        while app_module.SEARCH_INDEXES.busy:
+            time.sleep(0.01)
+    warm_times = times[1:] or times
+    warm_syscalls = syscalls[1:] or syscalls
+    return {
+        "cold_ms": round(times[0], 2),
+        "warm_ms": round(statistics.median(warm_times), 2),
+        "warm_min_ms": round(min(warm_times), 2),
+        "runs_ms": [round(t, 2) for t in times],
+        "setup_rss_kb": setup_rss,
+        "peak_rss_kb": peak_rss_kb(),
+        "syscalls_cold": syscalls[0],
+        "syscalls_warm": {key: round(statistics.mean(run[key] for run in warm_syscalls)) for key in warm_syscalls[0]},
+        "encodings": encodings,
+    }
+
+
+def run_in_child(name: str, repo: Path, stats: RepoStats, work_dir: Path, repeat: int, verbose: bool) -> dict:
+    command = [sys.executable, str(Path(__file__).resolve()), "scenario", name, str(repo), stats.deep_path, str(work_dir), str(repeat)]
+    completed = subprocess.run(command, stdout=subprocess.PIPE, stderr=None if verbose else subprocess.PIPE, text=True)
+    if completed.returncode != 0:
+        detail = (completed.stderr or "").strip().splitlines()[-1:] or [f"exit status {completed.returncode}"]
+        return {"error": detail[0]}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def git_commit() -> Optional[str]:
+    try:
+        completed = subprocess.run(["git", "rev-parse", "HEAD"], cwd=APP_DIR, capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return completed.stdout.strip() or None
+
+
+# ---------------------------------------------------------------- COMPARISON
+def comparable_metrics(scenario: dict) -> Dict[str, float]:
+    metrics = {key: scenario[key] for key in ("cold_ms", "warm_ms", "peak_rss_kb") if scenario.get(key) is not None}
+    for phase in ("cold", "warm"):
+        for key, value in scenario.get(f"syscalls_{phase}", {}).items():
+            metrics[f"{key}_{phase}"] = value
+    return metrics
+
+
+def compare_results(baseline: dict, current: dict, threshold: float) -> Tuple[List[str], int]:
+    """(report lines, number of regressions): metrics more than `threshold` (a ratio) above the baseline."""
+    lines, regressions = [], 0
+    if baseline.get("repo", {}).get("digest") != current.get("repo", {}).get("digest"):
+        lines.append("warning: the results are for different synthetic repositories")
+    for name, scenario in current["scenarios"].items():
+        before = baseline["scenarios"].get(name)
+        if before is None or "error" in before or "error" in scenario:
+            lines.append(f"{name}: not comparable")
+            continue
+        old_metrics = comparable_metrics(before)
+        for metric, value in comparable_metrics(scenario).items():
+            old = old_metrics.get(metric)
+            if old is None:
+                continue
+            change = (value - old) / old if old else (0.0 if value == old else math.inf)
+            noise = metric.endswith("_ms") and abs(value - old) < MIN_REGRESSION_MS
+            flag = ""
+            if change > threshold and not noise:
+                flag = "  REGRESSION"
+                regressions += 1
+            elif change < -threshold and not noise:
+                flag = "  improved"
+            lines.append(f"{name:14} {metric:16} {old:>12} -> {value:>12} {change:+8.1%}{flag}")
+    return lines, regressions
+
+
+# ----------------------------------------------------------------------- CLI
+def spec_from_args(args) -> RepoSpec:
+    spec = PROFILES[args.profile]
+    overrides = {field: getattr(args, field) for field in RepoSpec._fields if getattr(args, field, None) is not None}
+    return spec._replace(**overrides)
+
+
+def add_spec_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="medium", help="Repository size (default %(default)s)")
+    for field, default in RepoSpec._field_defaults.items():
+        parser.add_argument(f"--{field.replace('_', '-')}", dest=field, type=type(default), metavar="N", help=f"Override the profile's {field}")
+
+
+def format_table(results: dict) -> List[str]:
+    lines = [f"{'scenario':14} {'cold ms':>10} {'warm ms':>10} {'peak RSS':>10} {'opens':>7} {'scandirs':>9} {'reads':>8}"]
+    for name, scenario in results["scenarios"].items():
+        if "error" in scenario:
+            lines.append(f"{name:14} error: {scenario['error']}")
+            continue
+        cold = scenario["syscalls_cold"]
+        rss = f"{scenario['peak_rss_kb'] / 1024:.0f} MB" if scenario.get("peak_rss_kb") else "n/a"
+        lines.append(
+            f"{name:14} {scenario['cold_ms']:>10.1f} {scenario['warm_ms']:>10.1f} {rss:>10} "
+            f"{cold.get('open', 0):>7} {cold.get('scandir', 0):>9} {cold.get('read', '-'):>8}"
+        )
+    return lines
+
+
+def command_run(args) -> int:
+    spec = spec_from_args(args)
+    work_dir = Path(args.repo_dir or Path(tempfile.gettempdir()) / f"treeb-bench-{spec_key(spec)}")
+    started = time.perf_counter()
+    try:
+        repo, stats = prepare_repo(work_dir, spec)
+    except (OSError, ValueError) as e:
+        print(f"bench: {e}", file=sys.stderr)
+        return 1
+    print(
+        f"bench: {stats.files} files, {stats.dirs} directories, {stats.bytes / 1024 / 1024:.1f} MB in {repo} "
+        f"({time.perf_counter() - started:.1f}s)",
+        file=sys.stderr,
+    )
+    names = args.scenario or SCENARIOS
+    results = {
+        "version": RESULTS_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "repeat": args.repeat,
+        "spec": spec._asdict(),
+        "repo": stats._asdict(),
+        "scenarios": {},
+    }
+    for name in names:
+        results["scenarios"][name] = run_in_child(name, repo, stats, work_dir, args.repeat, args.verbose)
+    print("\n".join(format_table(results)))
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2) + "\n", encoding="utf-8")
+        print(f"bench: results written to {args.output}", file=sys.stderr)
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        lines, regressions = compare_results(baseline, results, args.threshold)
+        print("\n".join(lines))
+        return 1 if regressions else 0
+    return 0
+
+
+def command_compare(args) -> int:
+    baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+    current = json.loads(Path(args.current).read_text(encoding="utf-8"))
+    lines, regressions = compare_results(baseline, current, args.threshold)
+    print("\n".join(lines))
+    print(f"{regressions} regression(s) over {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+def command_scenario(args) -> int:
+    print(json.dumps(run_scenario(args.name, Path(args.repo), args.deep_path, Path(args.work_dir), args.repeat)))
+    return 0
+
+
+def command_generate(args) -> int:
+    spec = spec_from_args(args)
+    try:
+        repo, stats = prepare_repo(Path(args.directory), spec)
+    except (OSError, ValueError) as e:
+        print(f"bench: {e}", file=sys.stderr)
+        return 1
+    print(json.dumps({"repo": str(repo), **stats._asdict()}, indent=2))
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="bench.py",
+        description="Benchmark the tree, flatten and tokenize paths on a reproducible synthetic repository.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Generate the repository if needed and run the scenarios")
+    add_spec_arguments(run)
+    run.add_argument("--scenario", action="append", choices=SCENARIOS, help="Run only this scenario (repeatable)")
+    run.add_argument("--repeat", type=int, default=5, help="Runs per scenario; the first is the cold one (default %(default)s)")
+    run.add_argument("--repo-dir", help="Where to generate the repository (default: a directory under the system temp dir)")
+    run.add_argument("-o", "--output", default="bench_results.json", help="Results file (default %(default)s; '' for none)")
+    run.add_argument("--compare", metavar="BASELINE", help="Compare with an earlier results file; exit 1 on regressions")
+    run.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Regression ratio (default %(default)s)")
+    run.add_argument("-v", "--verbose", action="store_true", help="Show the scenarios' log output")
+    run.set_defaults(handler=command_run)
+
+    compare = commands.add_parser("compare", help="Compare two results files; exit 1 on regressions")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Regression ratio (default %(default)s)")
+    compare.set_defaults(handler=command_compare)
+
+    generate = commands.add_parser("generate", help="Only generate the synthetic repository")
+    generate.add_argument("directory")
+    add_spec_arguments(generate)
+    generate.set_defaults(handler=command_generate)
+
+    scenario = commands.add_parser("scenario")  # Internal: one scenario in a child process
+    scenario.add_argument("name", choices=SCENARIOS)
+    scenario.add_argument("repo")
+    scenario.add_argument("deep_path")
+    scenario.add_argument("work_dir")
+    scenario.add_argument("repeat", type=int)
+    scenario.set_defaults(handler=command_scenario)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
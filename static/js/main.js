@@ -6,12 +6,38 @@ $(function () {
   const $btnLoadPath = $("#btnLoadPath");
   const $charCountDisplay = $("#charCountDisplay");
   const $resultTextArea = $("#result");
+  const $chkIgnoreFiles = $("#chkIgnoreFiles");
+  const $revisionInput = $("#revision");
+  const $budgetSelect = $("#budgetSelect");
+  const $chkChangesOnly = $("#chkChangesOnly");
+  const $searchQuery = $("#searchQuery");
+  const $chkSearchContent = $("#chkSearchContent");
+  const $searchResults = $("#searchResults");
+  const $selectionEstimate = $("#selectionEstimate");
+  const $btnCancelGenerate = $("#btnCancelGenerate");
+  // Snapshot recorded by the last Generate with "Changes only" checked ({id, key}): the next one of the same
+  // selection (key) sends what changed since it
+  let lastSnapshot = null;
+  // The git revision the tree was built from ({} for the working tree): child listings and Generate use it too
+  let treeRevision = {};
+  // The root the tree was built from: searches look below it
+  let treeRoot = "";
+  let searchTimer = null;
+  let searchRequest = 0; // Responses to older searches are dropped
+  let estimateTimer = null;
+  let estimateAbort = null; // Cancels the estimate in flight when the selection changes again
+  // Folder id -> the children its next load_node gets, instead of asking the server (see reloadChildren)
+  let preparedChildren = {};
 
 
   function getCurrentTreePath() {
       return $rootPathInput.val().trim();
   }
 
+  function useIgnoreFiles() {
+      return $chkIgnoreFiles.is(':checked');
+  }
+
   function applyExclusionStyles(instance) {
       if (!instance) instance = $tree.jstree(true);
       if (!instance) { console.warn("applyExclusionStyles: jsTree instance not found."); return; }
@@ -22,7 +48,7 @@ $(function () {
           const nodeObj = instance.get_node(nodeId);
           const domNodeLi = instance.get_node(nodeId, true); 
 
-          if (nodeObj && domNodeLi && domNodeLi.length) {
+          if (nodeObj && domNodeLi && domNodeLi.length && !isMoreNode(nodeObj)) {
               const anchor = domNodeLi.children('.jstree-anchor');
               
               instance.enable_checkbox(nodeObj); 
@@ -42,6 +68,11 @@ $(function () {
   function buildTree(pathArg = "") {
       const pathForTree = pathArg || getCurrentTreePath() || "";
       $rootPathInput.val(pathForTree);
+      const rev = $revisionInput.val().trim();
+      treeRevision = rev ? { 'rev': rev, 'repo': pathForTree } : {};
+      treeRoot = pathForTree;
+      $searchResults.hide().empty();
+      scheduleEstimate();
 
       if ($tree.jstree(true)) {
           $tree.jstree(true).destroy();
@@ -50,17 +81,26 @@ $(function () {
 
       $tree.jstree({
           core: {
-              data: {
-                  url: "/api/tree",
-                  data: function (node) { 
-                      if (node.id === "#") { 
-                          return { 'id': '#', 'path': $("#rootPath").val().trim() };
-                      } else { 
-                          return { 'id': node.id }; 
-                      }
-                  },
-                  cache: false, 
-                  error: function(xhr, textStatus, errorThrown) {
+              data: function (node, callback) {
+                  if (node.id !== "#") {
+                      const prepared = preparedChildren[node.id];
+                      if (prepared) { delete preparedChildren[node.id]; callback.call(this, prepared); return; }
+                      fetchChildPage(node.id, {})
+                      .done(page => callback.call(this, pageNodes(page)))
+                      .fail((xhr, textStatus, errorThrown) => {
+                          console.error(`jsTree: Could not load children for "${node.text}":`, xhr, textStatus, errorThrown);
+                          callback.call(this, false);
+                      });
+                      return;
+                  }
+                  $.ajax({
+                      url: "/api/tree",
+                      data: Object.assign({ 'id': '#', 'path': $("#rootPath").val().trim(), 'ignore_files': useIgnoreFiles() ? 1 : 0 }, treeRevision),
+                      dataType: "json",
+                      cache: true // Server sends ETag + no-cache: the browser revalidates and reuses unchanged listings (304)
+                  })
+                  .done(nodes => callback.call(this, withMoreTexts(nodes)))
+                  .fail(function(xhr, textStatus, errorThrown) {
                       let errorMsg = "jsTree AJAX Error: Failed to load tree data.";
                       if (xhr.responseJSON && xhr.responseJSON.error) {
                           errorMsg = `Server Error: ${xhr.responseJSON.error}`;
@@ -73,7 +113,7 @@ $(function () {
                       }
                       $tree.html(`<p style="color:red; font-style:italic;">${errorMsg}</p>`);
                       console.error("jsTree AJAX data error:", xhr, textStatus, errorThrown);
-                  }
+                  });
               },
               check_callback: true, 
               themes: { responsive: false, stripes: true, dots: true } 
@@ -85,6 +125,11 @@ $(function () {
           },
           conditionalselect: function (node, event) {
               let instance = $.jstree.reference(node.id); 
+              if (isMoreNode(node)) {  // Not an entry: shows the next page, or changes the folder's filter
+                  if (!node.data.page.cursor || (event && $(event.target).closest('.tree-more-filter').length)) filterFolder(instance, node);
+                  else showMore(instance, node);
+                  return false;
+              }
               let current = node;
               while(current) { 
                   if (current.data && current.data.excluded_info) {
@@ -113,6 +158,7 @@ $(function () {
       .on('refresh.jstree', function(e, data) { 
           applyExclusionStyles($.jstree.reference(this));
       })
+      .on('changed.jstree', () => scheduleEstimate())
       .on('after_open.jstree', function(e, data){ 
           applyExclusionStyles(data.instance);
       })
@@ -130,24 +176,443 @@ $(function () {
       });
   }
 
-  function refreshPresetList() {
+  // --- Paged folders: children come a page at a time, followed by a "more" node that shows the next page ---
+  // Pages are asked for in the compact format: names and types, with ids rebuilt here from the folder's id.
+  const compactTypes = { d: "folder", f: "file", e: "error" };
+
+  function fetchChildPage(folderId, params) {
+      return $.ajax({
+          url: "/api/tree",
+          data: Object.assign({ 'id': folderId, 'compact': 1, 'ignore_files': useIgnoreFiles() ? 1 : 0 }, params, treeRevision),
+          dataType: "json",
+          cache: true
+      });
+  }
+
+  function escapeHtml(text) {
+      return $("<div>").text(text).html();
+  }
+
+  function moreText(info) {
+      const filter = info.filter ? ` containing "${escapeHtml(info.filter)}"` : "";
+      const text = info.cursor
+          ? `… ${(info.matched - info.shown).toLocaleString()} more${filter} (${info.shown.toLocaleString()} of ${info.matched.toLocaleString()} shown)`
+          : `${info.matched.toLocaleString()} of ${info.total.toLocaleString()} names${filter}`;
+      return `${text} <span class="tree-more-filter" title="Show only the names containing a text">${info.filter ? "change filter" : "filter"}</span>`;
+  }
+
+  function moreNode(info, sep) {
+      return {
+          id: info.id + sep + sep + "more", text: moreText(info), type: "more", icon: false, children: false,
+          state: { checkbox_disabled: true }, a_attr: { "class": "tree-more" }, data: { excluded_info: null, page: info }
+      };
+  }
+
+  // The tree's nodes lose the types the types plugin is not set up with: "more" nodes are told by their page info
+  function isMoreNode(node) {
+      return !!(node.data && node.data.page);
+  }
+
+  // The "more" nodes of a response in the jsTree format (the root's preloaded levels) get the same text
+  function withMoreTexts(nodes) {
+      nodes.forEach(node => {
+          if (node.type === "more") node.text = moreText(node.data.page);
+          else if (Array.isArray(node.children)) withMoreTexts(node.children);
+      });
+      return nodes;
+  }
+
+  function pageNodes(page) {
+      const prefix = page.id.endsWith(page.sep) ? page.id : page.id + page.sep;
+      const nodes = page.nodes.map(item => {
+          const type = compactTypes[item.t];
+          const node = { id: item.id || prefix + item.n, text: item.text || item.n, type: type, children: type === "folder", data: { excluded_info: item.x || null } };
+          if (type !== "folder") node.icon = type === "file" ? "jstree-file" : "jstree-warning";
+          return node;
+      });
+      if (page.page && (page.page.cursor || page.page.filter)) nodes.push(moreNode(page.page, page.sep));
+      return nodes;
+  }
+
+  // Reloads a folder with the given children; get_json() nodes keep their state (checked, opened, loaded subtree)
+  // and new ones are checked like the "more" node they were shown from
+  function reloadChildren(instance, folder, nodes, more, done) {
+      if (instance.is_checked(more)) {
+          nodes.filter(node => !node.state || !("selected" in node.state))
+              .forEach(node => { node.state = Object.assign({ selected: true }, node.state); });
+      }
+      preparedChildren[folder.id] = nodes;
+      instance.load_node(folder, () => {
+          applyExclusionStyles(instance);
+          scheduleEstimate();
+          if (done) done();
+      });
+  }
+
+  // Adds the next page of the folder of `more` (or, with `until`, the pages up to that name) to the tree
+  function showMore(instance, more, until, done) {
+      const info = more.data.page;
+      const params = { 'cursor': info.cursor, 'filter': info.filter };
+      if (until) params.until = until;
+      fetchChildPage(info.id, params)
+      .done(page => {
+          const folder = instance.get_node(more.parent);
+          const shown = folder.children.filter(id => id !== more.id).map(id => instance.get_json(id));
+          reloadChildren(instance, folder, shown.concat(pageNodes(page)), more, done);
+      })
+      .fail(() => { alert(`Could not list more of ${info.id}.`); if (done) done(); });
+  }
+
+  // Shows only the names containing a text in the folder of `more`; checks on the entries it hides are dropped
+  function filterFolder(instance, more) {
+      const info = more.data.page;
+      const filter = prompt("Show only the names containing (empty for all):", info.filter);
+      if (filter === null) return;
+      fetchChildPage(info.id, { 'filter': filter.trim() })
+      .done(page => {
+          const folder = instance.get_node(more.parent);
+          const nodes = pageNodes(page).map(node => !isMoreNode(node) && instance.get_node(node.id) ? instance.get_json(node.id) : node);
+          reloadChildren(instance, folder, nodes, more);
+      })
+      .fail(() => alert(`Could not filter ${info.id}.`));
+  }
+
+  // The node of `path`, showing the pages of its folder up to it first if needed; done(node, or false)
+  function pageInNode(instance, path, done) {
+      const node = instance.get_node(path);
+      if (node) { done(node); return; }
+      const rootId = instance.get_node('#').children[0];
+      if (!rootId || !path.startsWith(rootId)) { done(false); return; }
+      const folder = instance.get_node(ancestorIds(rootId, path).pop() || rootId);
+      const more = folder && folder.children.map(id => instance.get_node(id)).find(isMoreNode);
+      if (!more || !more.data.page.cursor) { done(false); return; }
+      showMore(instance, more, path.slice(path.search(/[^\\/]*$/)), () => done(instance.get_node(path)));
+  }
+
+  // --- Search: answered from the server's index of the tree root, so nothing has to be expanded first ---
+  function scheduleSearch(delay) {
+      clearTimeout(searchTimer);
+      searchTimer = setTimeout(runSearch, delay);
+  }
+
+  function runSearch() {
+      const query = $searchQuery.val().trim();
+      const content = $chkSearchContent.is(':checked');
+      if (!query || (content && query.length < 3)) { $searchResults.hide().empty(); return; }
+      const requestId = ++searchRequest;
+      const params = Object.assign({ 'q': query, 'path': treeRoot, 'ignore_files': useIgnoreFiles() ? 1 : 0, 'content': content ? 1 : 0 }, treeRevision);
+      fetch("/api/search?" + $.param(params))
+      .then(r => r.json().then(d => { if (!r.ok) throw new Error(d.error || "Search failed"); return d; }))
+      .then(data => {
+          if (requestId !== searchRequest) return;
+          renderSearchResults(data);
+          if (!data.complete) scheduleSearch(500); // Still indexing: ask again for more
+      })
+      .catch(e => {
+          if (requestId === searchRequest) $searchResults.show().empty().append($('<li class="search-note">').text("Search error: " + e.message));
+      });
+  }
+
+  function renderSearchResults(data) {
+      const instance = $tree.jstree(true);
+      $searchResults.empty().show();
+      data.results.forEach(hit => {
+          const isChecked = !!(instance && instance.get_node(hit.id) && instance.is_checked(hit.id));
+          const $check = $('<input type="checkbox" title="Check in the tree">').prop('checked', isChecked);
+          const detail = hit.line ? `${hit.path}:${hit.line}  ${hit.snippet}` : hit.path;
+          const $item = $('<li>').attr('title', hit.path)
+              .append($check)
+              .append($('<span>').text((hit.type === 'folder' ? '📁 ' : '') + hit.name))
+              .append($('<span class="search-detail">').text(detail));
+          $check.on('click', e => { e.stopPropagation(); revealNode(hit, $check.is(':checked')); });
+          $item.on('click', () => revealNode(hit, null));
+          $searchResults.append($item);
+      });
+      let note = null;
+      if (!data.complete) note = "Indexing… showing the matches found so far.";
+      else if (data.results.length === 0) note = "No matches.";
+      else if (data.truncated) note = "More matches: refine the query to see them.";
+      if (note) $searchResults.append($('<li class="search-note">').text(note));
+  }
+
+  function revealNode(hit, check) {
+      // Opens the hit's ancestors one after the other (each may load lazily, or page in), then scrolls to it and, if
+      // `check` is true or false, checks or unchecks it
+      const instance = $tree.jstree(true);
+      if (!instance) return;
+      const pending = hit.ancestors.slice();
+      (function openNext() {
+          if (pending.length) {
+              pageInNode(instance, pending.shift(), ancestor => {
+                  if (!ancestor) { alert(`Could not reveal ${hit.path}: one of its folders is not in the tree.`); return; }
+                  instance.open_node(ancestor, openNext, 0);
+              });
+              return;
+          }
+          pageInNode(instance, hit.id, revealed);
+      })();
+
+      function revealed(node) {
+          if (!node) { alert(`Could not reveal ${hit.path}: it is not in the tree (reload the tree if it was just created).`); return; }
+          if (check === true) instance.check_node(node);
+          else if (check === false) instance.uncheck_node(node);
+          applyExclusionStyles(instance);
+          $tree.find('.search-revealed').removeClass('search-revealed');
+          const $li = instance.get_node(node, true);
+          if ($li && $li.length) {
+              $li.children('.jstree-anchor').addClass('search-revealed');
+              $li[0].scrollIntoView({behavior: "smooth", block: "nearest"});
+          }
+      }
+  }
+
+  $searchQuery.on("input", () => scheduleSearch(150));
+  $searchQuery.on("keydown", e => { if (e.key === "Escape") { $searchQuery.val(""); $searchResults.hide().empty(); } });
+  $chkSearchContent.on("change", () => scheduleSearch(0));
+
+  // --- Live estimate of the checked selection: sizes and (mostly cached) token counts, no text generated ---
+  function scheduleEstimate() {
+      clearTimeout(estimateTimer);
+      estimateTimer = setTimeout(runEstimate, 300);
+  }
+
+  function formatBytes(size) {
+      if (size < 1024) return `${size} bytes`;
+      const units = ["KB", "MB", "GB"];
+      let unit = -1;
+      do { size /= 1024; unit++; } while (size >= 1024 && unit < units.length - 1);
+      return `${size.toFixed(1)} ${units[unit]}`;
+  }
+
+  function renderEstimate(est) {
+      if (est.type === "progress") {
+          const tokens = est.token_counts && Object.values(est.token_counts)[0];
+          $selectionEstimate.text(`Estimating… ${est.files}/${est.files_total} files, ${formatBytes(est.bytes)}` +
+              (tokens !== undefined ? `, ~${tokens} tokens so far` : ""));
+          return;
+      }
+      const approx = est.estimated.length > 0 ? "~" : "";
+      let text = `Selection: ${est.files} files, ${formatBytes(est.bytes)}`;
+      if (est.skipped) text += ` (${est.skipped} skipped)`;
+      if (est.token_count > 0) text += `, ${approx}${est.token_count} tokens`;
+      const models = (est.model_percentages || []).filter(m => m.tokens !== undefined)
+          .map(m => `${m.name} ${m.estimated ? "~" : ""}${m.percentage}%`);
+      if (models.length) text += " || " + models.join(" | ");
+      $selectionEstimate.text(text).attr("title", approx ? "Files not tokenized yet are estimated from their size; Generate counts them exactly." : "");
+  }
+
+  function runEstimate() {
+      if (estimateAbort) estimateAbort.abort();
+      estimateAbort = null;
+      const instance = $tree.jstree(true);
+      const selection = instance ? compactSelection(instance) : { include: [] };
+      if (selection.include.length === 0) { $selectionEstimate.empty(); return; }
+      const controller = estimateAbort = new AbortController();
+      fetch("/api/estimate", {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify(Object.assign({ selection: selection, ignore_files: useIgnoreFiles() }, treeRevision)),
+          signal: controller.signal
+      })
+      .then(response => {
+          if (!response.ok) return response.json().then(d => { throw new Error(d.error || "Estimate failed"); });
+          const reader = response.body.getReader();
+          const decoder = new TextDecoder();
+          let pendingLine = "";
+          const handleLine = line => {
+              if (!line) return;
+              const record = JSON.parse(line);
+              if (record.type === "error") throw new Error(record.error);
+              renderEstimate(record);
+          };
+          const pump = () => reader.read().then(({ done, value }) => {
+              if (done) { handleLine(pendingLine); return; }
+              const lines = (pendingLine + decoder.decode(value, { stream: true })).split("\n");
+              pendingLine = lines.pop();
+              lines.forEach(handleLine);
+              return pump();
+          });
+          return pump();
+      })
+      .catch(e => {
+          if (e.name !== "AbortError" && controller === estimateAbort) $selectionEstimate.text("Estimate error: " + e.message);
+      });
+  }
+
+  function refreshPresetList(selectId) {
       $.getJSON("/api/presets", list => {
           const $sel = $("#presetList").empty().append('<option value="">- Select Selection Preset -</option>');
+          warmPresets = {};
           if (list && list.length > 0) {
               let defaultGroup = $('<optgroup label="Default Selections"></optgroup>');
               let userGroup = $('<optgroup label="User Selections"></optgroup>');
               list.forEach(preset => {
-                  const option = $(`<option value="${$("<div/>").text(preset.id).html()}">${$("<div/>").text(preset.name).html()}</option>`);
+                  const label = preset.name + (preset.warm ? " (warm)" : "");
+                  const option = $(`<option value="${$("<div/>").text(preset.id).html()}">${$("<div/>").text(label).html()}</option>`);
                   (preset.type === "default" ? defaultGroup : userGroup).append(option);
+                  if (preset.warm) warmPresets[preset.id] = preset.freshness;
               });
               if (defaultGroup.children().length > 0) $sel.append(defaultGroup);
               if (userGroup.children().length > 0) $sel.append(userGroup);
+              if (selectId) $sel.val(selectId);
           } else { $sel.append(`<option disabled value="">No selection presets yet</option>`); }
+          renderPresetFreshness();
       }).fail(() => $("#presetList").empty().append(`<option disabled value="">Error loading selection presets</option>`));
   }
 
+  // Warm presets have their output kept up to date by the server: Generate right after loading one (without
+  // changing the selection) sends the preset's id and gets that output back. Their freshness is shown here.
+  let warmPresets = {};  // Preset id -> freshness, for the warm ones
+  let loadedPreset = null;  // {id, checked}: the preset loaded last and the checked node ids it left
+
+  function describeAge(seconds) {
+      if (seconds === null || seconds === undefined) return "never";
+      return seconds < 90 ? `${Math.round(seconds)} s ago` : `${Math.round(seconds / 60)} min ago`;
+  }
+
+  function renderPresetFreshness() {
+      const freshness = warmPresets[$("#presetList").val()];
+      const $freshness = $("#presetFreshness");
+      if (!freshness) { $freshness.text("").attr("title", ""); return; }
+      const texts = {
+          pending: "Warm: waiting to be built",
+          warming: "Warm: checking for changes…",
+          fresh: `Warm: up to date as of ${describeAge(freshness.checked_seconds_ago)}`,
+          failed: `Warm: failed (${freshness.error || "unknown error"})`,
+      };
+      $freshness.text(texts[freshness.state] || "").attr("title", freshness.state === "fresh"
+          ? `${freshness.files} files, ${(freshness.tokens || 0).toLocaleString()} tokens; last rebuilt ${describeAge(freshness.rebuilt_seconds_ago)}`
+          : "");
+  }
+
+  function refreshPresetFreshness() {
+      if (!warmPresets.hasOwnProperty($("#presetList").val())) return;
+      $.getJSON("/api/presets/warm", statuses => {
+          Object.keys(warmPresets).forEach(id => { if (statuses[id]) warmPresets[id] = statuses[id]; });
+          renderPresetFreshness();
+      });
+  }
+
+  // --- Compact selections: {"root", "include", "exclude"}, paths relative to the tree's root node ---
+  // A checked node stands for its whole subtree. A partly checked folder is sent either as its checked parts
+  // or as the folder less its unchecked parts, whichever lists fewer paths; nodes excluded by the rules are
+  // left out (the server excludes them anyway). In a folder only partly shown (more pages, or a filter), the
+  // entries not shown are as checked as its "more" node, so they are sent with the folder or not at all. The
+  // server then walks each subtree once.
+  function compactSelection(instance) {
+      const rootId = instance.get_node('#').children[0];
+      const selection = { root: rootId, include: [], exclude: [] };
+      if (!rootId) return selection;
+      const relative = id => {
+          if (id === rootId) return ".";
+          if (!id.startsWith(rootId)) return id;
+          const rest = id.slice(rootId.length);
+          if (/[\\/]$/.test(rootId)) return rest;
+          return /^[\\/]/.test(rest) ? rest.slice(1) : id;
+      };
+      const costs = {};  // Folder id -> [paths listing its checked parts, paths listing its unchecked parts]
+      const isFolderToSplit = node => node.state.loaded && node.children.length > 0;
+      const cost = node => {
+          if (costs[node.id]) return costs[node.id];
+          let checkedParts = 0, uncheckedParts = 0;
+          // The entries a "more" node stands for can only be sent as the folder (checked) or not at all
+          const more = node.children.map(childId => instance.get_node(childId)).find(isMoreNode);
+          if (more) { if (instance.is_checked(more)) checkedParts = Infinity; else uncheckedParts = Infinity; }
+          node.children.forEach(childId => {
+              const child = instance.get_node(childId);
+              if (child.state.checkbox_disabled) return;
+              if (instance.is_checked(child)) { checkedParts += 1; return; }
+              if (!isFolderToSplit(child)) { uncheckedParts += 1; return; }
+              const [childChecked, childUnchecked] = cost(child);
+              checkedParts += Math.min(childChecked, 1 + childUnchecked);
+              uncheckedParts += Math.min(childUnchecked, 1 + childChecked);
+          });
+          return costs[node.id] = [checkedParts, uncheckedParts];
+      };
+      // Lists the checked parts of `node` (included: false) or its unchecked parts (included: true)
+      const emit = (node, included) => {
+          node.children.forEach(childId => {
+              const child = instance.get_node(childId);
+              if (child.state.checkbox_disabled) return;
+              const checked = instance.is_checked(child);
+              if (checked) { if (!included) selection.include.push(relative(child.id)); return; }
+              if (!isFolderToSplit(child)) { if (included) selection.exclude.push(relative(child.id)); return; }
+              const [childChecked, childUnchecked] = cost(child);
+              if (included ? childUnchecked <= 1 + childChecked : childChecked <= 1 + childUnchecked) {
+                  emit(child, included);
+              } else {
+                  (included ? selection.exclude : selection.include).push(relative(child.id));
+                  emit(child, !included);
+              }
+          });
+      };
+      const root = instance.get_node(rootId);
+      if (instance.is_checked(root)) {
+          selection.include.push(".");
+      } else if (isFolderToSplit(root)) {
+          const [checkedParts, uncheckedParts] = cost(root);
+          if (checkedParts <= 1 + uncheckedParts) {
+              emit(root, false);
+          } else {
+              selection.include.push(".");
+              emit(root, true);
+          }
+      }
+      return selection;
+  }
+
+  // Ids of the nodes between the tree's root node and `path`, both left out
+  function ancestorIds(rootId, path) {
+      if (path === rootId || !path.startsWith(rootId)) return [];
+      const rest = path.slice(rootId.length);
+      const sep = /[\\/]$/.test(rootId) ? rootId.slice(-1) : rest.charAt(0);
+      if (sep !== "/" && sep !== "\\") return [];
+      const prefix = rootId.endsWith(sep) ? rootId : rootId + sep;
+      const parts = rest.split(sep).filter(Boolean);
+      return parts.slice(0, -1).map((part, i) => prefix + parts.slice(0, i + 1).join(sep));
+  }
+
+  // Checks the included paths of a selection ({"include", "exclude"}, absolute) and unchecks the excluded ones,
+  // loading the folders on the way to them (and the pages they are on) first; calls done(number of paths found)
+  function applySelection(instance, selection, done) {
+      const rootId = instance.get_node('#').children[0];
+      const items = selection.include.map(path => [path, true]).concat(selection.exclude.map(path => [path, false]));
+      const tried = {};
+      let found = 0;
+      (function next() {
+          while (items.length) {
+              const [path, check] = items[0];
+              const unloaded = ancestorIds(rootId, path).concat([path]).find(id => {
+                  const node = instance.get_node(id);
+                  return !tried[id] && (!node || (id !== path && !node.state.loaded));
+              });
+              if (unloaded) {
+                  tried[unloaded] = true;
+                  if (instance.get_node(unloaded)) instance.load_node(unloaded, next);
+                  else pageInNode(instance, unloaded, next);
+                  return;
+              }
+              items.shift();
+              const node = instance.get_node(path);
+              if (!node) continue;
+              found++;
+              if (check) instance.check_node(node); else instance.uncheck_node(node);
+          }
+          done(found);
+      })();
+  }
+
+  function checkedNodeIds(treeInstance) {
+      return treeInstance.get_checked(true).map(nodeId => treeInstance.get_node(nodeId).id);
+  }
+
+  $("#presetList").on("change", renderPresetFreshness);
+  setInterval(refreshPresetFreshness, 5000);
+
   $btnLoadPath.on("click", () => buildTree());
+  $chkIgnoreFiles.on("change", () => buildTree());
   $rootPathInput.on("keypress", function(e){ if(e.which === 13) $btnLoadPath.click(); });
+  $revisionInput.on("keypress", function(e){ if(e.which === 13) $btnLoadPath.click(); });
 
   // Check if the browse button exists and is not disabled (it might be if tkinter is not available)
   if ($btnBrowsePath.length && !$btnBrowsePath.is(':disabled')) {
@@ -193,20 +658,20 @@ $(function () {
   $("#btnSavePreset").on("click", () => {
       const n = prompt("Save current selection as (user preset name):"); if (!n || n.trim()==="") return;
       const ti = $tree.jstree(true); if (!ti) {alert("Tree not initialized."); return;}
-      const checkedNodesPaths = ti.get_checked(true).map(nodeId => ti.get_node(nodeId).id);
+      const selection = compactSelection(ti);
 
-      if (checkedNodesPaths.length === 0) { alert("No items selected to save in preset."); return; }
+      if (selection.include.length === 0) { alert("No items selected to save in preset."); return; }
 
       fetch("/api/presets/"+encodeURIComponent(n.trim()), {
           method:"POST",
           headers:{"Content-Type":"application/json"},
-          body:JSON.stringify({paths: checkedNodesPaths}) 
+          body:JSON.stringify({selection: selection, warm: $("#chkWarmPreset").is(':checked'), ignore_files: useIgnoreFiles()})
       })
       .then(r => { if(!r.ok) return r.json().then(e => {throw new Error(e.error || "Failed to save selection preset")}); return r.json();})
       .then(d => {
           if(d.saved){
-              refreshPresetList();
-              $("#presetList").val(d.id); 
+              refreshPresetList(d.id);
+              loadedPreset = {id: d.id, checked: checkedNodeIds(ti).sort().join("\n")};
               alert(`Preset '${d.name}' saved successfully.`);
           } else {
               alert("Error saving selection preset: "+(d.error||"Unknown error"));
@@ -218,46 +683,46 @@ $(function () {
       const presetId = $("#presetList").val(); if(!presetId){alert("Please select a selection preset to load.");return;}
       fetch("/api/presets/"+encodeURIComponent(presetId))
       .then(r => { if(!r.ok) return r.json().then(e => {throw new Error(e.error || "Failed to load preset paths")}); return r.json();})
-      .then(absolutePathsFromPreset => { 
+      .then(presetSelection => {
           const treeInstance = $tree.jstree(true);
           if(!treeInstance){alert("Tree not initialized. Cannot load preset.");return;}
           treeInstance.uncheck_all(true); 
-          
-          treeInstance.check_node(absolutePathsFromPreset); 
-
-          let loadedAndCheckedCount = 0;
-          let firstVisibleNodeToReveal = null;
-
-          absolutePathsFromPreset.forEach(pathStr => {
-              const nodeObj = treeInstance.get_node(pathStr);
-              if (nodeObj && treeInstance.is_checked(pathStr)) {
-                  loadedAndCheckedCount++;
-                  if (!firstVisibleNodeToReveal) firstVisibleNodeToReveal = nodeObj.id;
-
-                  let parentPath = treeInstance.get_parent(nodeObj);
-                  while(parentPath && parentPath !== "#") {
-                      treeInstance.open_node(parentPath, null, 0); 
-                      parentPath = treeInstance.get_parent(parentPath);
+
+          const total = presetSelection.include.length + presetSelection.exclude.length;
+          applySelection(treeInstance, presetSelection, loadedAndCheckedCount => {
+              let firstVisibleNodeToReveal = null;
+              presetSelection.include.forEach(pathStr => {
+                  const nodeObj = treeInstance.get_node(pathStr);
+                  if (nodeObj && treeInstance.is_checked(pathStr)) {
+                      if (!firstVisibleNodeToReveal) firstVisibleNodeToReveal = nodeObj.id;
+
+                      let parentPath = treeInstance.get_parent(nodeObj);
+                      while(parentPath && parentPath !== "#") {
+                          treeInstance.open_node(parentPath, null, 0); 
+                          parentPath = treeInstance.get_parent(parentPath);
+                      }
                   }
-              }
-          });
-          applyExclusionStyles(treeInstance); 
+              });
+              applyExclusionStyles(treeInstance); 
 
-          if(firstVisibleNodeToReveal){
-              const nodeElement = treeInstance.get_node(firstVisibleNodeToReveal, true);
-              if(nodeElement && nodeElement.length){
-                   nodeElement[0].scrollIntoView({behavior: "smooth", block: "nearest"});
+              if(firstVisibleNodeToReveal){
+                  const nodeElement = treeInstance.get_node(firstVisibleNodeToReveal, true);
+                  if(nodeElement && nodeElement.length){
+                       nodeElement[0].scrollIntoView({behavior: "smooth", block: "nearest"});
+                  }
               }
-          }
 
-          if (absolutePathsFromPreset.length > 0 && loadedAndCheckedCount < absolutePathsFromPreset.length) {
-              alert(`Note: ${absolutePathsFromPreset.length - loadedAndCheckedCount} out of ${absolutePathsFromPreset.length} item(s) from the preset were not selected. They might be excluded, not exist, or their parent directories haven't been expanded yet.`);
-          } else if (loadedAndCheckedCount > 0) {
-              // alert(`${loadedAndCheckedCount} item(s) from the preset loaded and selected.`);
-          } else if (absolutePathsFromPreset.length > 0) {
-               alert("No items from the preset could be selected. They might be excluded, not exist, or their parent directories haven't been expanded.");
-          }
+              // Only a preset loaded in full is sent as such: the page shows what will be flattened
+              loadedPreset = loadedAndCheckedCount === total
+                  ? {id: presetId, checked: checkedNodeIds(treeInstance).sort().join("\n")}
+                  : null;
 
+              if (total > 0 && loadedAndCheckedCount < total) {
+                  alert(`Note: ${total - loadedAndCheckedCount} out of ${total} item(s) from the preset were not found in the tree. They might be excluded, not exist, or lie outside the tree's root.`);
+              } else if (presetSelection.include.length > 0 && loadedAndCheckedCount === 0) {
+                  alert("No items from the preset could be selected. They might be excluded, not exist, or lie outside the tree's root.");
+              }
+          });
       }).catch(e => { alert("Error loading selection preset: "+e.message); console.error("Load selection preset error:", e); });
   });
 
@@ -270,6 +735,132 @@ $(function () {
       .then(d=>{if(d.deleted){refreshPresetList(); alert(`Preset '${pName}' deleted.`);}else alert("Error deleting selection preset: "+(d.error||"Unknown error"));}).catch(e=>{alert("Error: "+e.message);console.error("Delete selection preset error:",e);});
   });
 
+  function renderTokenInfo(data) {
+      let tokenInfoHtml = "";
+      if (data.token_count !== undefined && data.token_count >= 0) {
+          tokenInfoHtml = `<strong>${data.token_count}</strong> tokens`;
+          if (data.model_percentages && data.model_percentages.length > 0) {
+              tokenInfoHtml += " || ";
+              const percentagesHtmlParts = data.model_percentages.map(m => {
+                  if (m.name === "LLMs" && m.percentage === "N/A (Tokenization Error)") { 
+                       return `${m.name}: <span style="color: red; font-weight: normal;">${m.percentage}</span>`;
+                  }
+                  let percVal = parseFloat(m.percentage); let displayPercStr; let color = "#333"; 
+                  if (isNaN(percVal)) {
+                      displayPercStr = "N/A"; color = "#777"; 
+                  } else {
+                      if (percVal === 0) { color = "#6c757d"; } 
+                      else if (percVal < 50) { color = "green"; }
+                      else if (percVal < 80) { color = "orange"; }
+                      else if (percVal <= 100) { color = "red"; }
+                      else { color = "#b30000"; } 
+
+                      if (percVal === 0) { displayPercStr = "0"; }
+                      else if (percVal < 0.1 && percVal > 0) { displayPercStr = percVal.toFixed(2); } 
+                      else if (percVal < 10) { displayPercStr = percVal.toFixed(1); } 
+                      else { displayPercStr = Math.round(percVal).toString(); } 
+
+                      if (displayPercStr.endsWith(".0")) { displayPercStr = displayPercStr.slice(0, -2); } 
+                  }
+                  const countTitle = m.tokens !== undefined ? ` title="${m.estimated ? "~" : ""}${m.tokens} tokens (${m.tokenizer})"` : "";
+                  return `<span${countTitle}>${m.name}: <span style="color: ${color}; font-weight: normal;">${displayPercStr}%</span></span>`;
+              }).join(" |  ");
+              tokenInfoHtml += percentagesHtmlParts;
+          }
+      } else if (data.token_count === -1) { 
+           tokenInfoHtml = "<strong style='color:red;'>Tokenization Error</strong>";
+           if (data.model_percentages && data.model_percentages.length > 0 && data.model_percentages[0].name === "LLMs") {
+               tokenInfoHtml += ` / ${data.model_percentages[0].name}: <span style="color: red; font-weight: normal;">${data.model_percentages[0].percentage}</span>`
+           }
+      }
+      else {
+          tokenInfoHtml = "Token info not available.";
+      }
+      if (data.packing) {
+          const c = data.packing.counts;
+          tokenInfoHtml += ` || Budget ${data.packing.budget}: ${c.full} full, ${c.truncated} truncated, ${c.tree_only} tree only`;
+      }
+      if (data.changes) {
+          const ch = data.changes;
+          tokenInfoHtml += ` || Since last: ${ch.added.length} added, ${ch.modified.length} modified, ${ch.removed.length} removed`;
+      }
+      if (data.skipped && data.skipped.length > 0) {
+          const skippedList = $("<div>").text(data.skipped.map(f => `${f.path}: ${f.reason}`).join("\n")).html().replace(/"/g, "&quot;");
+          tokenInfoHtml += ` || <span title="${skippedList}" style="text-decoration: underline dotted;">${data.skipped.length} skipped</span>`;
+      }
+      $charCountDisplay.html(tokenInfoHtml);
+  }
+
+  // Generate runs as a flatten job on the server: submitted to /api/flatten/jobs, polled for progress and the
+  // output produced since the last poll (shown as it grows), and its result fetched once done. A newer Generate
+  // click or Cancel cancels the job in flight; so does leaving the page.
+  let currentJobId = null;
+  let currentGeneration = 0;
+
+  function cancelFlattenJob() {
+      if (!currentJobId) return;
+      navigator.sendBeacon("/api/flatten/jobs/" + encodeURIComponent(currentJobId) + "/cancel");
+      currentJobId = null;
+  }
+
+  function renderJobProgress(job) {
+      if (job.state === "queued") { $charCountDisplay.html("<i>Waiting for a free worker...</i>"); return; }
+      if (job.files_total === null) { $charCountDisplay.html("<i>Walking the selection...</i>"); return; }
+      $charCountDisplay.html(`<i>Generating... ${job.files_done}/${job.files_total} files, ${formatBytes(job.bytes)}, ${job.tokens} tokens so far</i>`);
+  }
+
+  // Resolves with the /api/flatten result, or null when the job was superseded or cancelled. onText gets each
+  // piece of output produced while the job runs, in order.
+  function runFlattenJob(requestBody, onText) {
+      cancelFlattenJob();
+      const generation = ++currentGeneration;
+      const getJson = (url, options) => fetch(url, options).then(response => response.json().catch(() => {
+          throw new Error("Server error: " + response.statusText);
+      }).then(data => {
+          if (!response.ok) throw new Error(data.error || "Generate failed. Status: " + response.status);
+          return data;
+      }));
+      return getJson("/api/flatten/jobs", {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify(requestBody)
+      })
+      .then(job => {
+          if (generation !== currentGeneration) {  // Superseded while submitting
+              navigator.sendBeacon("/api/flatten/jobs/" + encodeURIComponent(job.id) + "/cancel");
+              return null;
+          }
+          currentJobId = job.id;
+          const jobUrl = "/api/flatten/jobs/" + encodeURIComponent(job.id);
+          let textEnd = 0;  // Characters of output received so far (counted by the server)
+          const poll = () => new Promise(resolve => setTimeout(resolve, 250))
+              .then(() => generation === currentGeneration ? getJson(jobUrl + "?result=0&text_from=" + textEnd) : null)
+              .then(state => {
+                  if (state === null || generation !== currentGeneration) return null;
+                  if (state.text) {
+                      textEnd = state.text_end;
+                      onText(state.text);
+                  }
+                  if (state.state === "queued" || state.state === "running") { renderJobProgress(state); return poll(); }
+                  currentJobId = null;
+                  if (state.state === "failed") throw new Error(state.error || "Generate failed.");
+                  if (state.state === "cancelled") return null;
+                  return getJson(jobUrl).then(done => generation === currentGeneration ? done.result : null);
+              });
+          return poll();
+      });
+  }
+
+  $btnCancelGenerate.on("click", () => {
+      cancelFlattenJob();
+      currentGeneration++;  // The poll in flight drops what it gets
+      $btnCancelGenerate.hide();
+      $resultTextArea.val("Generate cancelled.");
+      $charCountDisplay.html("");
+  });
+
+  $(window).on("pagehide", cancelFlattenJob);
+
   $("#btnGenerate").on("click", () => {
       const treeInstance = $tree.jstree(true);
       if (!treeInstance) {
@@ -278,9 +869,9 @@ $(function () {
           $charCountDisplay.html("");
           return;
       }
-      const checkedNodesPaths = treeInstance.get_checked(true).map(nodeId => treeInstance.get_node(nodeId).id);
+      const selection = compactSelection(treeInstance);
 
-      if (checkedNodesPaths.length === 0) {
+      if (selection.include.length === 0) {
           $resultTextArea.val("No items selected. Please select files or directories to include in the output.");
           $charCountDisplay.html("0 tokens");
           return;
@@ -288,68 +879,41 @@ $(function () {
       $resultTextArea.val("Generating output, please wait... This may take a moment for large selections.");
       $charCountDisplay.html("<i>Calculating token count...</i>");
 
-      fetch("/api/flatten", {
-          method: "POST",
-          headers: { "Content-Type": "application/json" },
-          body: JSON.stringify({ paths: checkedNodesPaths }) 
-      })
-      .then(response => {
-          if (!response.ok) {
-              return response.json()
-                  .catch(() => response.text().then(text => { throw new Error("Server error: " + (text || response.statusText)); }))
-                  .then(errData => {
-                      if (errData && errData.error) throw new Error(errData.error);
-                      throw new Error("Generate failed. Status: " + response.status);
-                  });
-          }
-          return response.json();
+      const requestBody = Object.assign({ selection: selection, ignore_files: useIgnoreFiles() }, treeRevision);
+      if (loadedPreset && loadedPreset.checked === checkedNodeIds(treeInstance).sort().join("\n")) {
+          requestBody.preset = loadedPreset.id;
+      }
+      const snapshotKey = JSON.stringify(requestBody);
+      if ($chkChangesOnly.is(':checked')) {
+          requestBody.snapshot = "texts";  // Texts too: the next Generate sends unified diffs against them
+      }
+      if ($chkChangesOnly.is(':checked') && lastSnapshot && lastSnapshot.key === snapshotKey) {
+          requestBody.since = lastSnapshot.id;
+          requestBody.diff = "unified";
+      } else if ($budgetSelect.val()) {
+          requestBody.budget_model = $budgetSelect.val();
+      }
+      const generation = currentGeneration + 1;  // The one runFlattenJob starts
+      const textChunks = [];
+      $btnCancelGenerate.show();
+      runFlattenJob(requestBody, text => {
+          textChunks.push(text);
+          $resultTextArea.val(textChunks.join(""));  // At most once per poll
       })
-      .then(data => {
-          $resultTextArea.val(data.text !== undefined ? data.text : "Error: No text returned from server.");
-          let tokenInfoHtml = "";
-          if (data.token_count !== undefined && data.token_count >= 0) {
-              tokenInfoHtml = `<strong>${data.token_count}</strong> tokens`;
-              if (data.model_percentages && data.model_percentages.length > 0) {
-                  tokenInfoHtml += " || ";
-                  const percentagesHtmlParts = data.model_percentages.map(m => {
-                      if (m.name === "LLMs" && m.percentage === "N/A (Tokenization Error)") { 
-                           return `${m.name}: <span style="color: red; font-weight: normal;">${m.percentage}</span>`;
-                      }
-                      let percVal = parseFloat(m.percentage); let displayPercStr; let color = "#333"; 
-                      if (isNaN(percVal)) {
-                          displayPercStr = "N/A"; color = "#777"; 
-                      } else {
-                          if (percVal === 0) { color = "#6c757d"; } 
-                          else if (percVal < 50) { color = "green"; }
-                          else if (percVal < 80) { color = "orange"; }
-                          else if (percVal <= 100) { color = "red"; }
-                          else { color = "#b30000"; } 
-
-                          if (percVal === 0) { displayPercStr = "0"; }
-                          else if (percVal < 0.1 && percVal > 0) { displayPercStr = percVal.toFixed(2); } 
-                          else if (percVal < 10) { displayPercStr = percVal.toFixed(1); } 
-                          else { displayPercStr = Math.round(percVal).toString(); } 
-
-                          if (displayPercStr.endsWith(".0")) { displayPercStr = displayPercStr.slice(0, -2); } 
-                      }
-                      return `${m.name}: <span style="color: ${color}; font-weight: normal;">${displayPercStr}%</span>`;
-                  }).join(" |  ");
-                  tokenInfoHtml += percentagesHtmlParts;
-              }
-          } else if (data.token_count === -1) { 
-               tokenInfoHtml = "<strong style='color:red;'>Tokenization Error</strong>";
-               if (data.model_percentages && data.model_percentages.length > 0 && data.model_percentages[0].name === "LLMs") {
-                   tokenInfoHtml += ` / ${data.model_percentages[0].name}: <span style="color: red; font-weight: normal;">${data.model_percentages[0].percentage}</span>`
-               }
-          }
-          else {
-              tokenInfoHtml = "Token info not available.";
+      .then(result => {
+          if (!result) return;  // Superseded by a newer Generate, or cancelled
+          $resultTextArea.val(result.text);
+          if (result.snapshot) {
+              lastSnapshot = { id: result.snapshot, key: snapshotKey };
           }
-          $charCountDisplay.html(tokenInfoHtml);
+          renderTokenInfo(result);
       }).catch(error => {
+          if (generation !== currentGeneration) return;  // Errors of a superseded job are not shown
           $resultTextArea.val("Error during generation: " + error.message);
           $charCountDisplay.html("<span style='color:red;'>Error calculating tokens.</span>");
           console.error("Flatten API call error:", error);
+      }).finally(() => {
+          if (generation === currentGeneration) $btnCancelGenerate.hide();
       });
   });
 
@@ -0,0 +1,5 @@
+# treeb/treeb/__init__.py
+
+from treeb.flatten import FlattenResult, flatten_paths
+
+__all__ = ["FlattenResult", "flatten_paths"]
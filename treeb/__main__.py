@@ -0,0 +1,5 @@
+# treeb/treeb/__main__.py
+
+from treeb.cli import main
+
+raise SystemExit(main())
@@ -0,0 +1,174 @@
+# treeb/treeb/classify.py
+
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from treeb.gitsource import GitRevision
+from treeb.pipeline import map_ordered, raise_if_cancelled
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_FILE_BYTES = 4 * 1024 * 1024  # About a million tokens: more than any context window holds
+DEFAULT_MAX_TOTAL_BYTES = 64 * 1024 * 1024
+
+# Only this much of a file is looked at to tell whether it is text worth reading
+SNIFF_BYTES = 8192
+# Share of control bytes (other than whitespace, backspace and escape) above which the head is not text
+MAX_CONTROL_BYTE_RATIO = 0.1
+TEXT_CONTROL_BYTES = {0x08, 0x09, 0x0A, 0x0C, 0x0D, 0x1B}
+# Minified or generated code: long lines on average. Smaller files are cheap whatever they look like.
+MINIFIED_MIN_BYTES = 4096
+MINIFIED_MEAN_LINE_LENGTH = 300
+MINIFIED_NAME_MARKERS = (".min.",)
+
+MAGIC_NUMBERS: List[Tuple[bytes, str]] = [
+    (b"SQLite format 3\x00", "SQLite database"),
+    (b"\x7fELF", "ELF executable"),
+    (b"\xcf\xfa\xed\xfe", "Mach-O executable"),
+    (b"\xca\xfe\xba\xbe", "Java class or Mach-O executable"),
+    (b"\x00asm", "WebAssembly module"),
+    (b"\x89PNG\r\n\x1a\n", "PNG image"),
+    (b"\xff\xd8\xff", "JPEG image"),
+    (b"GIF87a", "GIF image"),
+    (b"GIF89a", "GIF image"),
+    (b"%PDF-", "PDF document"),
+    (b"PK\x03\x04", "ZIP archive"),
+    (b"\x1f\x8b", "gzip archive"),
+    (b"\xfd7zXZ\x00", "xz archive"),
+    (b"7z\xbc\xaf\x27\x1c", "7-Zip archive"),
+    (b"\x28\xb5\x2f\xfd", "zstd archive"),
+    (b"wOFF", "WOFF font"),
+    (b"wOF2", "WOFF2 font"),
+]
+
+
+class ReadLimits(NamedTuple):
+    max_file_bytes: Optional[int] = DEFAULT_MAX_FILE_BYTES  # None: no limit
+    max_total_bytes: Optional[int] = DEFAULT_MAX_TOTAL_BYTES  # None: no limit
+    skip_binary: bool = True
+    skip_minified: bool = True
+
+
+class SkippedFile(NamedTuple):
+    reason: str
+    size: int  # Bytes, from stat
+
+
+def format_size(size: float) -> str:
+    if size < 1024:
+        return f"{int(size)} bytes"
+    for unit in ("KB", "MB", "GB"):
+        size /= 1024
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}"
+
+
+def skip_message(skipped: SkippedFile) -> str:
+    """What the output shows instead of a skipped file's content."""
+    return f"[skipped: {skipped.reason}, {format_size(skipped.size)}]"
+
+
+def sniff_content(head: bytes, name: str, size: int, limits: ReadLimits) -> Optional[str]:
+    """Why a file starting with `head` should not be read, or None if it looks like text worth including."""
+    if limits.skip_binary:
+        for magic, kind in MAGIC_NUMBERS:
+            if head.startswith(magic):
+                return f"binary ({kind})"
+        if b"\x00" in head:
+            return "binary (contains NUL bytes)"
+        control_bytes = sum(1 for byte in head if byte < 0x20 and byte not in TEXT_CONTROL_BYTES)
+        if head and control_bytes / len(head) > MAX_CONTROL_BYTE_RATIO:
+            return "binary (mostly control bytes)"
+    if limits.skip_minified and size >= MINIFIED_MIN_BYTES:
+        if any(marker in name for marker in MINIFIED_NAME_MARKERS):
+            return "minified (by name)"
+        if len(head) / (head.count(b"\n") + 1) > MINIFIED_MEAN_LINE_LENGTH:
+            return "minified or generated (very long lines)"
+    return None
+
+
+def size_limit_skip(size: int, limits: ReadLimits) -> Optional[SkippedFile]:
+    """The skip for a file over the per-file limit, from its size alone; None if it is within it."""
+    if limits.max_file_bytes is not None and size > limits.max_file_bytes:
+        return SkippedFile(f"over the {format_size(limits.max_file_bytes)} per-file limit", size)
+    return None
+
+
+def total_limit_skip(size: int, limits: ReadLimits) -> SkippedFile:
+    """The skip for a file that would take the files read over the total limit."""
+    return SkippedFile(f"over the {format_size(limits.max_total_bytes)} total size limit", size)
+
+
+def classify_file(
+    f_path: Path, limits: ReadLimits, source: Optional[GitRevision] = None
+) -> Tuple[Optional[SkippedFile], int]:
+    """(why the file is skipped or None, its size), from a stat and a read of at most SNIFF_BYTES.
+
+    Files that cannot be stat'ed or opened are not skipped here: reading them reports the error. With a
+    `source`, the file is looked up in that revision instead of the working tree.
+    """
+    if source is not None:
+        size = source.size(f_path)
+        if size is None:
+            return None, 0
+    else:
+        try:
+            size = os.stat(f_path).st_size
+        except OSError:
+            return None, 0
+    too_large = size_limit_skip(size, limits)
+    if too_large is not None:
+        return too_large, size
+    if size == 0 or not (limits.skip_binary or limits.skip_minified):
+        return None, size
+    try:
+        if source is not None:
+            head = source.read_head(f_path, SNIFF_BYTES)
+        else:
+            with open(f_path, "rb") as f:
+                head = f.read(SNIFF_BYTES)
+    except (OSError, ValueError):
+        return None, size
+    reason = sniff_content(head, f_path.name, size, limits)
+    return (SkippedFile(reason, size) if reason else None), size
+
+
+def classify_files(
+    files: List[Path],
+    limits: ReadLimits,
+    workers: int = 0,
+    source: Optional[GitRevision] = None,
+    cancel: Optional[threading.Event] = None,
+) -> Dict[Path, SkippedFile]:
+    """The files (in output order) not to read, with why: by size, content sniffing, then the total size limit.
+
+    The total limit counts the files that are read; a file that would take it over the limit is skipped and
+    later, smaller files may still fit. Raises Cancelled once `cancel` is set.
+    """
+    results = map_ordered(lambda f_path: classify_file(f_path, limits, source), files, workers)
+    return limit_total(files, results, limits, cancel)
+
+
+def limit_total(
+    files: List[Path],
+    classified: Iterable[Tuple[Optional[SkippedFile], int]],
+    limits: ReadLimits,
+    cancel: Optional[threading.Event] = None,
+) -> Dict[Path, SkippedFile]:
+    """The files to skip, given what classify_file said of each (in the same order), once the total size limit
+    is applied too."""
+    skipped: Dict[Path, SkippedFile] = {}
+    total = 0
+    for f_path, (skip, size) in zip(files, classified):
+        raise_if_cancelled(cancel)
+        if skip is None and limits.max_total_bytes is not None and total + size > limits.max_total_bytes:
+            skip = total_limit_skip(size, limits)
+        if skip is None:
+            total += size
+        else:
+            logger.info(f"Flatten: skipping {f_path}: {skip.reason} ({format_size(size)})")
+            skipped[f_path] = skip
+    return skipped
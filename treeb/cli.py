@@ -0,0 +1,120 @@
+# treeb/treeb/cli.py
+
+import argparse
+import json
+import logging
+import sys
+from pathlib import Path
+from typing import List, Optional
+
+from treeb.classify import DEFAULT_MAX_FILE_BYTES, DEFAULT_MAX_TOTAL_BYTES, ReadLimits, format_size
+from treeb.flatten import TIKTOKEN_ENCODING_NAME, flatten_paths
+from treeb.tokencache import TokenCountCache
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="treeb",
+        description="Flatten files and directories into one text (ASCII tree plus file contents), like Generate in the web UI.",
+    )
+    parser.add_argument("paths", nargs="*", help="Files and directories to include")
+    parser.add_argument("-p", "--preset", help='Selection preset to include: "user/<name>", "default/<name>" or a bare name')
+    parser.add_argument("-o", "--output", help="Write the output to this file instead of stdout")
+    parser.add_argument(
+        "--exclusions",
+        metavar="FILE",
+        help='JSON file with "dirs", "files" and "patterns" lists to use instead of the active exclusion rules',
+    )
+    parser.add_argument("--exclude-dir", action="append", default=[], metavar="NAME", help="Also exclude this directory name/path")
+    parser.add_argument("--exclude-file", action="append", default=[], metavar="NAME", help="Also exclude this file name/path")
+    parser.add_argument("--exclude-pattern", action="append", default=[], metavar="GLOB", help="Also exclude this pattern")
+    parser.add_argument("--gitignore", action="store_true", help="Also exclude items ignored by .gitignore/.ignore files")
+    parser.add_argument(
+        "--max-file-bytes",
+        type=int,
+        default=DEFAULT_MAX_FILE_BYTES,
+        metavar="N",
+        help="Skip files larger than this (0: no limit; default %(default)s)",
+    )
+    parser.add_argument(
+        "--max-total-bytes",
+        type=int,
+        default=DEFAULT_MAX_TOTAL_BYTES,
+        metavar="N",
+        help="Skip files once their total size would exceed this (0: no limit; default %(default)s)",
+    )
+    parser.add_argument(
+        "--include-binary", action="store_true", help="Read files that look binary or minified instead of skipping them"
+    )
+    parser.add_argument("--rev", metavar="REV", help="Read the paths as of this git branch, tag or commit")
+    parser.add_argument(
+        "--repo", default=".", metavar="DIR", help="Git repository for --rev (default: the one containing the current directory)"
+    )
+    parser.add_argument("--no-tokens", action="store_true", help="Do not count tokens (tiktoken is not even imported)")
+    parser.add_argument("--encoding", default=TIKTOKEN_ENCODING_NAME, help="tiktoken encoding for the token count")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the on-disk token count cache")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Do not print the token count to stderr")
+    return parser
+
+
+def load_rules(args) -> Optional[dict]:
+    """Exclusion rules from the command line, or None for the active rules when nothing was given."""
+    from treeb import presets
+
+    if not (args.exclusions or args.exclude_dir or args.exclude_file or args.exclude_pattern):
+        return None
+    if args.exclusions:
+        rules = json.loads(Path(args.exclusions).read_text(encoding="utf-8"))
+        if not isinstance(rules, dict) or not all(isinstance(rules.get(k, []), list) for k in ("dirs", "files", "patterns")):
+            raise ValueError(f'{args.exclusions}: expected an object with "dirs", "files" and "patterns" lists')
+    else:
+        rules = presets.load_exclusion_rules()
+    return {
+        "dirs": list(rules.get("dirs", [])) + args.exclude_dir,
+        "files": list(rules.get("files", [])) + args.exclude_file,
+        "patterns": list(rules.get("patterns", [])) + args.exclude_pattern,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format="treeb: %(message)s")
+    if not args.paths and not args.preset:
+        print("treeb: nothing to flatten (give paths and/or --preset)", file=sys.stderr)
+        return 2
+
+    token_cache = None
+    if not args.no_tokens and not args.no_cache:
+        from treeb import presets
+
+        token_cache = TokenCountCache(presets.TOKEN_CACHE_DB_PATH)
+
+    try:
+        result = flatten_paths(
+            args.paths,
+            preset=args.preset,
+            exclusion_rules=load_rules(args),
+            output=args.output or sys.stdout,
+            count_tokens=not args.no_tokens,
+            ignore_files=args.gitignore,
+            encoding_name=args.encoding,
+            token_cache=token_cache,
+            read_limits=ReadLimits(
+                max_file_bytes=args.max_file_bytes or None,
+                max_total_bytes=args.max_total_bytes or None,
+                skip_binary=not args.include_binary,
+                skip_minified=not args.include_binary,
+            ),
+            revision=args.rev,
+            repository=args.repo,
+        )
+    except (OSError, ValueError) as e:
+        print(f"treeb: {e}", file=sys.stderr)
+        return 1
+
+    if not args.quiet:
+        for skipped in result.skipped:
+            print(f"treeb: skipped {skipped['path']}: {skipped['reason']} ({format_size(skipped['size'])})", file=sys.stderr)
+    if not args.quiet and result.token_count is not None:
+        print(f"treeb: {result.files} files, {result.token_count} tokens ({args.encoding})", file=sys.stderr)
+    return 0
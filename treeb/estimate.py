@@ -0,0 +1,187 @@
+# treeb/treeb/estimate.py
+
+import logging
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+from treeb.classify import SkippedFile, classify_file, size_limit_skip, skip_message, total_limit_skip
+from treeb.flatten import (
+    EMPTY_SELECTION_MESSAGE,
+    NO_FILES_MESSAGE,
+    Flattener,
+    FlattenPlan,
+    display_path_for_file,
+    render_file_block_body,
+)
+from treeb.pipeline import map_ordered
+
+logger = logging.getLogger(__name__)
+
+# Source code and prose average about this many bytes per token. Files the token cache does not know are
+# estimated with it, or with the selection's own ratio once its cached files add up to MIN_RATIO_SAMPLE_BYTES.
+DEFAULT_BYTES_PER_TOKEN = 4.0
+MIN_RATIO_SAMPLE_BYTES = 64 * 1024
+# Running totals are reported at most this often while a large selection is estimated
+DEFAULT_PROGRESS_SECONDS = 0.25
+
+
+class FileEstimate(NamedTuple):
+    size: int  # Bytes, from stat (0 if the file cannot be stat'ed)
+    skipped: Optional[SkippedFile]
+    block_tokens: Dict[str, Optional[int]]  # Tokens of its block body; None where the token cache does not know them
+
+
+def count_with(encodings: Dict[str, object], text: str) -> Dict[str, int]:
+    return {name: len(encoding.encode_ordinary(text)) for name, encoding in encodings.items()}
+
+
+class SelectionEstimate:
+    """Running totals of what a flatten of the plan would send: files, bytes read and tokens per encoding.
+
+    Token counts are exact for text counted here (tree, path lines, skip messages) and for file blocks the
+    token cache knows in their current version; the other blocks are estimated from their size. Once `done`,
+    the totals cover the whole plan.
+    """
+
+    def __init__(self, plan: FlattenPlan, encoding_names: List[str]):
+        self.files_total = len(plan.files)
+        self.files = 0
+        self.bytes = 0  # Of the files whose content is included
+        self.cached_files = 0  # Files whose block tokens all came from the token cache
+        self.chars = 0  # Characters (bytes, for files) of everything, for models without a counted encoding
+        self.skipped: Dict[Path, SkippedFile] = {}
+        self.done = False
+        self._counted = dict.fromkeys(encoding_names, 0)
+        self._uncounted_bytes = dict.fromkeys(encoding_names, 0)
+        self._cached_bytes = dict.fromkeys(encoding_names, 0)
+        self._cached_tokens = dict.fromkeys(encoding_names, 0)
+
+    def add_text(self, text: str, tokens: Dict[str, int]):
+        self.chars += len(text)
+        for name, count in tokens.items():
+            self._counted[name] += count
+
+    def add_file(self, f_path: Path, estimate: FileEstimate):
+        self.files += 1
+        if estimate.skipped is not None:
+            self.skipped[f_path] = estimate.skipped
+            self.chars += len(render_file_block_body(skip_message(estimate.skipped)))  # What the output holds
+        else:
+            self.bytes += estimate.size
+            self.chars += estimate.size
+        cached = True
+        for name in self._counted:
+            block = estimate.block_tokens.get(name)
+            if block is None:
+                self._uncounted_bytes[name] += estimate.size
+                cached = False
+            else:
+                self._counted[name] += block
+                if estimate.skipped is None:
+                    self._cached_bytes[name] += estimate.size
+                    self._cached_tokens[name] += block
+        if cached and estimate.skipped is None:
+            self.cached_files += 1
+
+    def bytes_per_token(self, name: str) -> float:
+        if self._cached_bytes[name] >= MIN_RATIO_SAMPLE_BYTES and self._cached_tokens[name] > 0:
+            return self._cached_bytes[name] / self._cached_tokens[name]
+        return DEFAULT_BYTES_PER_TOKEN
+
+    def token_counts(self) -> Dict[str, int]:
+        return {
+            name: counted + round(self._uncounted_bytes[name] / self.bytes_per_token(name))
+            for name, counted in self._counted.items()
+        }
+
+    def estimated_encodings(self) -> List[str]:
+        """The encodings whose count includes estimated blocks."""
+        return [name for name, uncounted in self._uncounted_bytes.items() if uncounted > 0]
+
+    def to_json(self) -> dict:
+        return {
+            "done": self.done,
+            "files": self.files,
+            "files_total": self.files_total,
+            "bytes": self.bytes,
+            "skipped": len(self.skipped),
+            "cached_files": self.cached_files,
+            "token_counts": self.token_counts(),
+            "estimated": self.estimated_encodings(),
+        }
+
+
+def estimate_file(flattener: Flattener, f_path: Path, encodings: Dict[str, object]) -> FileEstimate:
+    """A file's block: a stat and token cache lookups; its first bytes are only read (to tell binary and minified
+    files apart) when the cache does not know the block."""
+    key = flattener.file_key(f_path)
+    if key is None:
+        return FileEstimate(0, None, dict.fromkeys(encodings))  # Shown as a short read error
+    size = key[2]
+    skipped = size_limit_skip(size, flattener.read_limits)
+    if skipped is None:
+        cache = flattener.token_cache
+        block_tokens = {name: cache.get(key, name) if cache is not None else None for name in encodings}
+        if block_tokens and all(tokens is not None for tokens in block_tokens.values()):
+            return FileEstimate(size, None, block_tokens)  # Counted before, so it was read as text
+        skipped, _ = classify_file(f_path, flattener.read_limits, flattener.source)
+        if skipped is None:
+            return FileEstimate(size, None, block_tokens)
+    return FileEstimate(size, skipped, count_with(encodings, render_file_block_body(skip_message(skipped))))
+
+
+def iter_estimate(
+    flattener: Flattener, plan: FlattenPlan, progress_seconds: float = DEFAULT_PROGRESS_SECONDS
+) -> Iterator[SelectionEstimate]:
+    """The estimate of a flatten of `plan`, yielded every progress_seconds while files are looked at (files are
+    stat'ed on the flattener's reader workers) and once more when done. Nothing is read for files the token
+    cache knows; the same SelectionEstimate object is updated and yielded each time.
+
+    The total size limit is applied in output order, as Flattener.plan does.
+    """
+    encodings = flattener.counted_encodings()
+    estimate = SelectionEstimate(plan, list(encodings))
+    if plan.empty:
+        estimate.add_text(EMPTY_SELECTION_MESSAGE, count_with(encodings, EMPTY_SELECTION_MESSAGE))
+        estimate.done = True
+        yield estimate
+        return
+
+    limits = flattener.read_limits
+    read_total = 0
+    # Path lines are counted together, once per progress report: each ends in a newline and the next starts
+    # with a path, so joined they count the same as apart
+    path_lines: List[str] = []
+
+    def count_path_lines():
+        text = "".join(path_lines)
+        estimate.add_text(text, count_with(encodings, text))
+        path_lines.clear()
+
+    next_progress = time.monotonic() + progress_seconds
+    file_estimates = map_ordered(lambda f_path: estimate_file(flattener, f_path, encodings), plan.files, flattener.reader_workers)
+    for f_path, file_estimate in zip(plan.files, file_estimates):
+        path_lines.append(f"{display_path_for_file(f_path, plan.common_ancestor)}\n")
+        if file_estimate.skipped is None and limits.max_total_bytes is not None:
+            if read_total + file_estimate.size > limits.max_total_bytes:
+                skipped = total_limit_skip(file_estimate.size, limits)
+                file_estimate = file_estimate._replace(
+                    skipped=skipped, block_tokens=count_with(encodings, render_file_block_body(skip_message(skipped)))
+                )
+            else:
+                read_total += file_estimate.size
+        estimate.add_file(f_path, file_estimate)
+        if time.monotonic() >= next_progress:
+            count_path_lines()
+            yield estimate
+            next_progress = time.monotonic() + progress_seconds
+
+    count_path_lines()
+    # The tree last: for a large selection it is a long text to tokenize, and the files matter more early on
+    header = plan.header + "Context files:\n"
+    if not plan.files:
+        header += NO_FILES_MESSAGE
+    estimate.add_text(header, count_with(encodings, header))
+    estimate.done = True
+    yield estimate
@@ -0,0 +1,138 @@
+# treeb/treeb/exclusions.py
+
+import fnmatch
+import os
+import re
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Pattern, Tuple
+
+# Path.match() is case-insensitive on Windows, so the compiled patterns are too
+_PATTERN_FLAGS = re.IGNORECASE if os.name == "nt" else 0
+
+
+def _split_path(path: str) -> List[str]:
+    if os.altsep:
+        path = path.replace(os.altsep, os.sep)
+    return [part for part in path.split(os.sep) if part]
+
+
+def _split_rule(rule: str) -> Tuple[str, ...]:
+    return tuple(part for part in rule.replace("\\", "/").split("/") if part)
+
+
+def _translate(pattern_part: str) -> str:
+    # fnmatch.translate gives "(?s:...)\Z"; drop the anchor so parts can be combined and joined
+    return fnmatch.translate(pattern_part)[: -len(r"\Z")]
+
+
+class ExclusionMatcher:
+    """Exclusion rules ("dirs", "files", "patterns") compiled for fast per-entry checks.
+
+    Exact names live in frozensets, all single-component glob patterns are folded into one regex, and
+    rules containing a slash (e.g. "doc/api") match the trailing components of the path. Results are the
+    same excluded_info dicts check_if_item_is_excluded has always returned; path rules report
+    "Directory Path"/"File Path".
+    """
+
+    def __init__(self, dirs: Tuple[str, ...], files: Tuple[str, ...], patterns: Tuple[str, ...]):
+        self.dir_names = frozenset(d for d in dirs if "/" not in d and "\\" not in d)
+        self.file_names = frozenset(f for f in files if "/" not in f and "\\" not in f)
+        # Path-shaped name rules, keyed by their last component so only candidates get compared
+        self.dir_paths = self._index_path_rules(d for d in dirs if d not in self.dir_names)
+        self.file_paths = self._index_path_rules(f for f in files if f not in self.file_names)
+
+        # Patterns are tried in rule order, like the old loop did; the first alternative that matches wins
+        self._name_patterns: List[str] = []
+        self._multi_patterns: List[Tuple[str, int, bool, Pattern]] = []  # (rule, parts, anchored, regex)
+        alternatives = []
+        for pattern in patterns:
+            parts = _split_rule(pattern)
+            if not parts:
+                continue
+            anchored = pattern.startswith(("/", "\\"))
+            if len(parts) == 1 and not anchored:
+                alternatives.append(f"(?P<p{len(self._name_patterns)}>{_translate(parts[0])})")
+                self._name_patterns.append(pattern)
+            else:
+                regex = re.compile("/".join(_translate(part) for part in parts) + r"\Z", _PATTERN_FLAGS)
+                self._multi_patterns.append((pattern, len(parts), anchored, regex))
+        self._name_regex: Optional[Pattern] = (
+            re.compile(r"(?:" + "|".join(alternatives) + r")\Z", _PATTERN_FLAGS) if alternatives else None
+        )
+
+    @staticmethod
+    def _index_path_rules(rules) -> Dict[str, List[Tuple[Tuple[str, ...], str]]]:
+        index: Dict[str, List[Tuple[Tuple[str, ...], str]]] = {}
+        for rule in rules:
+            parts = _split_rule(rule)
+            if parts:
+                index.setdefault(parts[-1], []).append((parts, rule))
+        return index
+
+    @staticmethod
+    def _match_path_rule(path: str, candidates) -> Optional[str]:
+        parts = _split_path(path)
+        for rule_parts, rule in candidates:
+            if tuple(parts[-len(rule_parts):]) == rule_parts:
+                return rule
+        return None
+
+    def _match_pattern(self, path: str, name: str) -> Optional[str]:
+        if self._name_regex is not None:
+            m = self._name_regex.match(name)
+            if m:
+                return self._name_patterns[int(m.lastgroup[1:])]
+        if self._multi_patterns:
+            parts = _split_path(path)
+            for pattern, n_parts, anchored, regex in self._multi_patterns:
+                if len(parts) < n_parts or (anchored and len(parts) != n_parts):
+                    continue
+                if regex.match("/".join(parts[-n_parts:])):
+                    return pattern
+        return None
+
+    def match(self, path: str, name: str, is_dir: bool, is_file: bool) -> Optional[dict]:
+        """Excluded_info for an item whose type is already known, or None. Never touches the filesystem."""
+        if is_dir:
+            if name in self.dir_names:
+                return {"type": "Directory Name", "rule": name}
+            candidates = self.dir_paths.get(name)
+            if candidates:
+                rule = self._match_path_rule(path, candidates)
+                if rule:
+                    return {"type": "Directory Path", "rule": rule}
+            pattern = self._match_pattern(path, name)  # Patterns can match directory names too
+            if pattern:
+                return {"type": "Directory Pattern", "rule": pattern}
+        elif is_file:
+            if name in self.file_names:
+                return {"type": "File Name", "rule": name}
+            candidates = self.file_paths.get(name)
+            if candidates:
+                rule = self._match_path_rule(path, candidates)
+                if rule:
+                    return {"type": "File Path", "rule": rule}
+            pattern = self._match_pattern(path, name)
+            if pattern:
+                return {"type": "File Pattern", "rule": pattern}
+        return None
+
+    def match_path(self, item: Path) -> Optional[dict]:
+        """Like match(), for a Path whose type still has to be looked up (one stat)."""
+        is_dir = item.is_dir()
+        return self.match(str(item), item.name, is_dir, not is_dir and item.is_file())
+
+
+@lru_cache(maxsize=8)
+def _compile(dirs: Tuple[str, ...], files: Tuple[str, ...], patterns: Tuple[str, ...]) -> ExclusionMatcher:
+    return ExclusionMatcher(dirs, files, patterns)
+
+
+def get_exclusion_matcher(rules: dict) -> ExclusionMatcher:
+    """Compiled matcher for an exclusion rules dict; only recompiled when the rules' contents change."""
+    return _compile(
+        tuple(rules.get("dirs", [])),
+        tuple(rules.get("files", [])),
+        tuple(rules.get("patterns", [])),
+    )
@@ -0,0 +1,735 @@
+# treeb/treeb/flatten.py
+
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import IO, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from treeb.classify import ReadLimits, SkippedFile, classify_files, skip_message
+from treeb.exclusions import get_exclusion_matcher
+from treeb.gitsource import GitRepository, GitRevision
+from treeb.ignorefiles import IgnoreFileRules
+from treeb.ingest import DEFAULT_CHUNK_BYTES, DEFAULT_MMAP_THRESHOLD_BYTES, MappedText, map_file_text
+from treeb.metrics import span, traced_check
+from treeb.packing import (
+    BUDGET_NOTE,
+    DEFAULT_PRIORITY_POLICY,
+    PRIORITY_POLICIES,
+    TREE_ONLY,
+    TRUNCATED,
+    PackCandidate,
+    PackingDecision,
+    pack_files,
+    selection_depth,
+    truncate_block_body,
+)
+from treeb.pipeline import MultiEncodingCounter, SegmentTokenCounter, map_ordered, raise_if_cancelled
+from treeb.selection import Selection, normalize_selection
+from treeb.sharding import (
+    PIECE_PATH_SUFFIX,
+    SHARD_FILES_LINE,
+    SHARD_HEADER_MODES,
+    SHARD_NUMBER_PLACEHOLDER,
+    SHARD_TREE_REFERENCE,
+    ShardItem,
+    estimate_line_tokens,
+    plan_shards,
+)
+from treeb.tokencache import FileKey, TokenCountCache
+from treeb.walker import walk_selection
+
+logger = logging.getLogger(__name__)
+
+TIKTOKEN_ENCODING_NAME = "cl100k_base"
+DEFAULT_READER_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+DEFAULT_TOKENIZER_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def render_file_block_body(content: str) -> str:
+    """The part of a file's output block after its path line; the token cache stores the token count of this per file."""
+    return f"\"\"\"\n{content}\n\"\"\"\n\n"
+
+
+def read_file_text(f_path: Path) -> Tuple[str, Optional[FileKey]]:
+    """Read one file's text, with the cache key of the version that was read (None, and a placeholder text, on errors)."""
+    try:
+        with open(f_path, "r", encoding="utf-8", errors="replace") as f:
+            st = os.fstat(f.fileno())
+            content = f.read()
+        return content, (str(f_path), st.st_mtime_ns, st.st_size)
+    except UnicodeDecodeError:
+        return "[binary file or undecodable content skipped]", None
+    except Exception as e:
+        return f"[Error reading file: {e}]", None
+
+
+# render_file_block_body around content that is produced in chunks
+BLOCK_OPENING, BLOCK_CLOSING = render_file_block_body("\x00").split("\x00")
+
+
+# (path, why it is skipped or None) -> its text (or the skip message) and the key of the version read
+OpenText = Callable[[Path, Optional[SkippedFile]], Tuple[Union[str, MappedText], Optional[FileKey]]]
+
+
+class Segment(NamedTuple):
+    text: str
+    key: Optional[FileKey] = None  # Token cache key of the file whose block this is (part of)
+    final: bool = True  # False for all but the last part of a block produced in parts
+
+
+def mapped_block_segments(content: MappedText, file_key: Optional[FileKey]) -> Iterator[Segment]:
+    """A mapped file's block body as parts of about one chunk each (see SegmentTokenCounter.add)."""
+    pending = None
+    for chunk in content.chunks():
+        if pending is None:
+            pending = BLOCK_OPENING + chunk
+        else:
+            yield Segment(pending, file_key, final=False)
+            pending = chunk
+    yield Segment((BLOCK_OPENING if pending is None else pending) + BLOCK_CLOSING, file_key)
+
+
+def display_path_for_file(f_path: Path, common_ancestor_for_tree: Optional[Path]) -> str:
+    """The path line shown above a file's contents: relative to the tree root when possible."""
+    if common_ancestor_for_tree is not None:
+        try:
+            # Attempt to make path relative to the common ancestor for display
+            return str(f_path.relative_to(common_ancestor_for_tree))
+        except ValueError:  # path is not under common_ancestor (e.g. different drive, or complex selection)
+            pass
+    return f".../{f_path.parent.name}/{f_path.name}" if f_path.parent and f_path.parent.name else f_path.name
+
+
+def build_nested_dict(
+    paths: List[Path], root_for_display: Path, already_resolved: bool = False, cancel: Optional[threading.Event] = None
+) -> dict:  # Used List[Path] for clarity for 3.9
+    tree = {}
+    resolved_root_for_display = root_for_display.resolve()
+    for p in paths:
+        raise_if_cancelled(cancel)
+        try:
+            abs_p = p if already_resolved else p.resolve()
+            if resolved_root_for_display in abs_p.parents or resolved_root_for_display == abs_p:
+                rel_parts = abs_p.relative_to(resolved_root_for_display).parts
+                if not rel_parts:
+                    rel_parts = (abs_p.name,) if abs_p.name else (str(abs_p),)
+            else:
+                rel_parts = (abs_p.name,) if abs_p.name else (str(abs_p),)
+
+        except ValueError:
+            rel_parts = (p.name if p.name else str(p),)
+        except Exception as e:
+            logger.error(f"Path resolution error in build_nested_dict for {p} relative to {root_for_display}: {e}")
+            rel_parts = (p.name + " (path error)",)
+
+        cursor = tree
+        for part in rel_parts:
+            cursor = cursor.setdefault(part, {})
+    return tree
+
+
+def ascii_tree(d: dict, prefix: str = "") -> List[str]:  # Used List[str] and dict
+    lines = []
+    items = list(d.items())
+    for i, (name, child) in enumerate(items):
+        is_last = i == (len(items) - 1)
+        connector = "└── " if is_last else "├── "
+        lines.append(prefix + connector + name)
+        if child:
+            extension = "    " if is_last else "│   "
+            lines.extend(ascii_tree(child, prefix + extension))
+    return lines
+
+
+EMPTY_SELECTION_MESSAGE = "No files or directories selected, or all selected items/contents are excluded by current rules."
+NO_FILES_MESSAGE = "No files selected/accessible/found (after exclusion and directory expansion).\n"
+
+
+class FlattenPlan(NamedTuple):
+    header: str  # "code base:" + ASCII tree, or a note when no structure is left
+    files: List[Path]  # Files to read, in output order
+    common_ancestor: Optional[Path]  # Root the tree and file paths are shown relative to
+    empty: bool  # Nothing left to show at all: the output is just EMPTY_SELECTION_MESSAGE
+    selected: List[Path]  # The resolved selection the walk started from
+    skipped: Dict[Path, SkippedFile]  # Files of `files` shown without their content (filled in by Flattener.plan)
+    directories: Sequence[str] = ()  # Directories the walk listed (working tree only), to tell when it is stale
+
+
+def plan_flatten(
+    raw_paths_from_client: List[str],
+    exclusion_rules: dict,
+    ignore_files: bool = False,
+    source: Optional[GitRevision] = None,
+    cancel: Optional[threading.Event] = None,
+    excluded: Sequence[str] = (),
+) -> FlattenPlan:
+    """Walk the selection and build the tree header; file contents are only read by Flattener.iter_segments.
+
+    The selection is the items of raw_paths_from_client with their subtrees, less the `excluded` items and
+    theirs (see normalize_selection: paths below another selected path are walked once, with it). With a
+    `source`, the selection is walked in that git revision rather than the working tree (ignore files do not
+    apply there: everything in a commit is tracked). Once `cancel` is set, the walk stops by raising Cancelled.
+    """
+    ignore_rules = IgnoreFileRules() if ignore_files and source is None else None
+
+    selection = normalize_selection(Selection(raw_paths_from_client, excluded))
+    initial_selection_nodes = [Path(p) for p in selection.include]
+
+    # Missing and excluded selections are skipped by the walk itself; exclusion rules (and .gitignore/.ignore
+    # files when requested) then apply to every item discovered below the selected directories.
+    matcher = get_exclusion_matcher(exclusion_rules)
+    is_excluded = traced_check(matcher.match)
+    if selection.exclude:
+        deselected = frozenset(selection.exclude)
+        check_rules = is_excluded
+
+        def is_excluded(path: str, *args) -> Optional[dict]:
+            if path in deselected:
+                return {"type": "Deselected", "rule": path}
+            return check_rules(path, *args)
+
+    if cancel is not None:
+        check = is_excluded
+
+        def is_excluded(*args) -> Optional[dict]:  # Every item walked is checked: a cancel takes effect mid-walk
+            raise_if_cancelled(cancel)
+            return check(*args)
+
+    with span("walk"):
+        if source is not None:
+            walk = source.walk(initial_selection_nodes, is_excluded)
+        else:
+            walk = walk_selection(initial_selection_nodes, is_excluded, ignore_rules)
+    raise_if_cancelled(cancel)
+
+    if not walk.structure_paths and not walk.files:
+        return FlattenPlan(
+            header="",
+            files=[],
+            common_ancestor=None,
+            empty=True,
+            selected=initial_selection_nodes,
+            skipped={},
+            directories=walk.directories,
+        )
+
+    final_resolved_paths_for_structure = walk.structure_paths
+    final_files_to_process = walk.files
+
+    header = ""
+    common_ancestor_for_tree = None
+    with span("tree"):  # The ASCII tree header
+        if not final_resolved_paths_for_structure:
+            header = "No valid paths for structure (after exclusion).\n\n"
+        else:
+            try:
+                real_paths_for_structure = [walk.real_path(p) for p in final_resolved_paths_for_structure]
+                abs_path_strings_for_commonpath = [str(p) for p in real_paths_for_structure]
+                if not abs_path_strings_for_commonpath:
+                    common_ancestor_for_tree = Path(".").resolve()  # Fallback
+                else:
+                    common_ancestor_str = os.path.commonpath(abs_path_strings_for_commonpath)
+                    common_ancestor_for_tree = Path(common_ancestor_str)
+                    is_file = source.is_file if source is not None else Path.is_file
+                    if is_file(common_ancestor_for_tree):  # commonpath can return a file if all paths are that file
+                        common_ancestor_for_tree = common_ancestor_for_tree.parent
+            except ValueError:  # commonpath raises ValueError if paths are on different drives (Windows)
+                common_ancestor_for_tree = Path(".").resolve()  # Fallback
+
+            subset = build_nested_dict(real_paths_for_structure, common_ancestor_for_tree, already_resolved=True, cancel=cancel)
+            raise_if_cancelled(cancel)
+
+            header_root_name_display = ""
+            if common_ancestor_for_tree:
+                name_to_display = common_ancestor_for_tree.name
+                # Handle cases where common_ancestor is root (e.g., '/', 'C:\') or '.'
+                if not name_to_display or name_to_display == "." and str(common_ancestor_for_tree) != ".":
+                    name_to_display = str(common_ancestor_for_tree)
+                elif name_to_display == "." and str(common_ancestor_for_tree) == ".":
+                    name_to_display = "Selected Structure"  # Or APP_ROOT.name or similar context
+                header_root_name_display = f"{name_to_display}/\n" if name_to_display else "Selected Structure/\n"
+            else:  # Should ideally not happen if common_ancestor_for_tree is set
+                header_root_name_display = "Selected Structure/\n"
+
+            header = "code base:\n" + header_root_name_display + "\n".join(ascii_tree(subset)) + "\n\n"
+
+    return FlattenPlan(
+        header=header,
+        files=final_files_to_process,
+        common_ancestor=common_ancestor_for_tree,
+        empty=False,
+        selected=initial_selection_nodes,
+        skipped={},
+        directories=walk.directories,
+    )
+
+
+def finish_token_count(token_counter: Optional[SegmentTokenCounter]) -> int:
+    """Token count of everything added to the counter; 0 without an encoding, -1 on tokenization errors."""
+    if not token_counter:
+        logger.warning("Tiktoken encoding not available. Token count 0.")
+        return 0
+    try:
+        return token_counter.total()
+    except Exception as e:
+        logger.error(f"Error tokenizing final text: {e}")
+        return -1  # Indicate error
+
+
+def load_encoding(name: str = TIKTOKEN_ENCODING_NAME):
+    """The tiktoken encoding `name`, or None if tiktoken or its BPE file is not available. Imports tiktoken lazily."""
+    try:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding(name)
+    except Exception as e:
+        logger.error(f"Could not load tiktoken encoding '{name}': {e}.")
+        return None
+    logger.info(f"Successfully loaded tiktoken encoding: {name}")
+    return encoding
+
+
+def load_encodings(names: Iterable[str]) -> Dict[str, object]:
+    """The tiktoken encodings that could be loaded, by name."""
+    encodings = {}
+    for name in names:
+        encoding = load_encoding(name)
+        if encoding is not None:
+            encodings[name] = encoding
+    return encodings
+
+
+class Flattener:
+    """Flatten output for one set of exclusion rules and tokenizer settings; used by the web app and the CLI.
+
+    Without an encoding, text is still produced but nothing is counted, and budget packing and sharding
+    (which need per-file counts) raise ValueError. Budgets, shards and truncation are measured with
+    `encoding`; new_model_counter() also counts with the `count_encodings`. With a `source`, paths are read
+    from that git revision instead of the working tree. Once `cancel` is set, walking, classifying and opening
+    files raise Cancelled, which stops whatever is producing the output.
+    """
+
+    def __init__(
+        self,
+        exclusion_rules: dict,
+        encoding=None,
+        token_cache: Optional[TokenCountCache] = None,
+        reader_workers: int = DEFAULT_READER_WORKERS,
+        tokenizer_workers: int = DEFAULT_TOKENIZER_WORKERS,
+        tokenizer_batch_size: int = 64,
+        tokenizer_batch_chars: int = 4 * 1024 * 1024,
+        count_encodings: Sequence = (),
+        read_limits: ReadLimits = ReadLimits(),
+        mmap_threshold: Optional[int] = DEFAULT_MMAP_THRESHOLD_BYTES,
+        chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+        source: Optional[GitRevision] = None,
+        cancel: Optional[threading.Event] = None,
+    ):
+        self.exclusion_rules = exclusion_rules
+        self.source = source
+        self.cancel = cancel
+        self.encoding = encoding
+        self.count_encodings = count_encodings
+        self.read_limits = read_limits
+        self.mmap_threshold = mmap_threshold
+        self.chunk_bytes = chunk_bytes
+        self.token_cache = token_cache
+        self.reader_workers = reader_workers
+        self.tokenizer_workers = tokenizer_workers
+        self.tokenizer_batch_size = tokenizer_batch_size
+        self.tokenizer_batch_chars = tokenizer_batch_chars
+
+    def with_encoding(self, encoding) -> "Flattener":
+        """The same flattener measuring budgets, shards and truncation with another encoding."""
+        return Flattener(
+            self.exclusion_rules,
+            encoding=encoding,
+            token_cache=self.token_cache,
+            reader_workers=self.reader_workers,
+            tokenizer_workers=self.tokenizer_workers,
+            tokenizer_batch_size=self.tokenizer_batch_size,
+            tokenizer_batch_chars=self.tokenizer_batch_chars,
+            count_encodings=self.count_encodings,
+            read_limits=self.read_limits,
+            mmap_threshold=self.mmap_threshold,
+            chunk_bytes=self.chunk_bytes,
+            source=self.source,
+            cancel=self.cancel,
+        )
+
+    def plan(self, raw_paths: List[str], ignore_files: bool = False, excluded: Sequence[str] = ()) -> FlattenPlan:
+        """plan_flatten, then the files not to read (binary, minified, over the size limits), without reading them."""
+        plan = plan_flatten(raw_paths, self.exclusion_rules, ignore_files, self.source, self.cancel, excluded)
+        with span("classify"):
+            skipped = classify_files(plan.files, self.read_limits, self.reader_workers, self.source, self.cancel)
+        return plan._replace(skipped=skipped)
+
+    def read_text(self, plan: FlattenPlan, f_path: Path) -> Tuple[str, Optional[FileKey]]:
+        """read_file_text, or the skip message (and no cache key) for a file the plan skips."""
+        raise_if_cancelled(self.cancel)
+        skipped = plan.skipped.get(f_path)
+        if skipped is not None:
+            return skip_message(skipped), None
+        if self.source is not None:
+            return self.source.read_text(f_path)
+        return read_file_text(f_path)
+
+    def open_text(self, f_path: Path, skipped: Optional[SkippedFile] = None) -> Tuple[Union[str, MappedText], Optional[FileKey]]:
+        """read_file_text (the skip message for a skipped file), but files of mmap_threshold bytes or more are
+        memory-mapped and decoded chunk by chunk as they are consumed."""
+        raise_if_cancelled(self.cancel)
+        if skipped is not None:
+            return skip_message(skipped), None
+        if self.source is not None:
+            return self.source.read_text(f_path)
+        if self.mmap_threshold is not None:
+            try:
+                large = os.stat(f_path).st_size >= max(self.mmap_threshold, 1)
+            except OSError:
+                large = False
+            if large:
+                return map_file_text(f_path, self.chunk_bytes)
+        return read_file_text(f_path)
+
+    @staticmethod
+    def skipped_report(plan: FlattenPlan) -> List[dict]:
+        """The skipped files for API responses: display path, reason and size, in output order."""
+        return [
+            {"path": display_path_for_file(f_path, plan.common_ancestor), "reason": skipped.reason, "size": skipped.size}
+            for f_path, skipped in plan.skipped.items()
+        ]
+
+    def iter_segments(
+        self, plan: FlattenPlan, packing: Optional[PackingDecision] = None, open_text: Optional[OpenText] = None
+    ) -> Iterator[Segment]:
+        """The flatten output as consecutive segments, reading files as it goes.
+
+        Joining the texts gives the full output. Each file contributes its path line and its block body (which
+        carries the token cache key of the version read); the segment cuts are valid for SegmentTokenCounter.
+        Large files are memory-mapped and their block comes in parts of about chunk_bytes, so no segment holds
+        a whole large file.
+        With a packing decision, tree-only files are left out and truncated files get an excerpt within their
+        allowance, followed by a note on what was cut.
+        Files are opened with `open_text` instead of Flattener.open_text when given.
+        """
+        open_text = open_text or self.open_text
+        if plan.empty:
+            yield Segment(EMPTY_SELECTION_MESSAGE)
+            return
+        yield Segment(plan.header + "Context files:\n")
+        if not plan.files:
+            yield Segment(NO_FILES_MESSAGE)
+            return
+        if packing is None:
+            included = [(f_path, None) for f_path in plan.files]
+        else:
+            included = [(f_path, packed) for f_path, packed in zip(plan.files, packing.files) if packed.mode != TREE_ONLY]
+        # Files are read on a thread pool but consumed in plan.files order
+        texts = map_ordered(
+            lambda f_path: open_text(f_path, plan.skipped.get(f_path)), [f_path for f_path, _ in included], self.reader_workers
+        )
+        for (f_path, packed), (content, file_key) in zip(included, texts):
+            yield Segment(f"{display_path_for_file(f_path, plan.common_ancestor)}\n")
+            if packed is not None and packed.mode == TRUNCATED:
+                if isinstance(content, MappedText):
+                    content = content.read()
+                block_body, _ = truncate_block_body(
+                    self.encoding, content, packed.allowance - packed.path_tokens, render_file_block_body
+                )
+                yield Segment(block_body)
+            elif isinstance(content, MappedText):
+                yield from mapped_block_segments(content, file_key)
+            else:
+                yield Segment(render_file_block_body(content), file_key)
+        if packing is not None and packing.note():
+            yield Segment(packing.note())
+
+    def new_token_counter(self, workers: Optional[int] = None) -> Optional[SegmentTokenCounter]:
+        if not self.encoding:
+            return None
+        return SegmentTokenCounter(
+            self.encoding,
+            self.token_cache,
+            workers=self.tokenizer_workers if workers is None else workers,
+            batch_size=self.tokenizer_batch_size,
+            max_batch_chars=self.tokenizer_batch_chars,
+        )
+
+    def counted_encodings(self) -> Dict[str, object]:
+        """`encoding` and each of `count_encodings` by name, each distinct encoding once."""
+        encodings = {}
+        for encoding in [self.encoding, *self.count_encodings]:
+            if encoding is not None:
+                encodings.setdefault(encoding.name, encoding)
+        return encodings
+
+    def new_model_counter(self) -> MultiEncodingCounter:
+        """A counter for each of counted_encodings(), splitting the tokenizer workers between them; with no
+        encodings at all it still counts characters."""
+        encodings = self.counted_encodings()
+        workers = max(self.tokenizer_workers // max(len(encodings), 1), 1) if self.tokenizer_workers > 0 else 0
+        return MultiEncodingCounter(
+            {
+                name: SegmentTokenCounter(
+                    encoding,
+                    self.token_cache,
+                    workers=workers,
+                    batch_size=self.tokenizer_batch_size,
+                    max_batch_chars=self.tokenizer_batch_chars,
+                )
+                for name, encoding in encodings.items()
+            }
+        )
+
+    def _count(self, text: str) -> int:
+        return len(self.encoding.encode_ordinary(text))
+
+    def _require_encoding(self, feature: str):
+        if not self.encoding:
+            raise ValueError(f"{feature} needs the tiktoken encoding, which is not available.")
+
+    def file_key(self, f_path: Path) -> Optional[FileKey]:
+        """The token cache key of the file's current version without reading it (one stat, or the revision's
+        blob id); None if it cannot be looked up."""
+        try:
+            if self.source is not None:
+                return self.source.file_key(f_path)
+            st = f_path.stat()
+        except (OSError, ValueError):
+            return None
+        return (str(f_path), st.st_mtime_ns, st.st_size)
+
+    def file_block_token_count(self, f_path: Path, skipped: Optional[SkippedFile] = None) -> int:
+        """Tokens of a file's block body: from the token cache if the file is unchanged (one stat), else read and encoded.
+
+        A skipped file's block is its skip message.
+        """
+        if skipped is not None:
+            return self._count(render_file_block_body(skip_message(skipped)))
+        cache = self.token_cache
+        if cache is not None:
+            key = self.file_key(f_path)
+            cached = cache.get(key, self.encoding.name) if key is not None else None
+            if cached is not None:
+                return cached
+        content, file_key = self.open_text(f_path)
+        if isinstance(content, MappedText):
+            tokens = sum(self._count(segment.text) for segment in mapped_block_segments(content, None))
+        else:
+            tokens = self._count(render_file_block_body(content))
+        if file_key is not None and cache is not None:
+            cache.put(file_key, self.encoding.name, tokens)
+        return tokens
+
+    def count_files(self, plan: FlattenPlan) -> List[Tuple[str, int, int]]:
+        """(display path, path line tokens, block body tokens) per file of the plan, in output order.
+
+        Block counts come from the token cache where possible; only changed files are read and encoded.
+        """
+        counts = []
+        block_tokens = map_ordered(
+            lambda f_path: self.file_block_token_count(f_path, plan.skipped.get(f_path)), plan.files, self.reader_workers
+        )
+        for f_path, tokens in zip(plan.files, block_tokens):
+            display_path = display_path_for_file(f_path, plan.common_ancestor)
+            counts.append((display_path, self._count(display_path + "\n"), tokens))
+        if self.token_cache is not None:
+            self.token_cache.flush()
+        return counts
+
+    def pack(
+        self,
+        plan: FlattenPlan,
+        budget: int,
+        policy: str = DEFAULT_PRIORITY_POLICY,
+        weights: Optional[Dict[str, float]] = None,
+    ) -> PackingDecision:
+        """Decide which files of the plan fit into `budget` tokens (see pack_files). Raises ValueError."""
+        self._require_encoding("Token budget packing")
+        if policy not in PRIORITY_POLICIES:
+            raise ValueError(f"Unknown budget_policy {policy!r} (expected one of: {', '.join(PRIORITY_POLICIES)})")
+        try:
+            weights = {str(Path(p).resolve()): float(w) for p, w in (weights or {}).items()}
+        except (AttributeError, TypeError, ValueError):
+            raise ValueError("budget_weights must map paths to numbers.")
+        selected = [str(p) for p in plan.selected]
+
+        def weight_for(f_path: Path) -> float:
+            for candidate in (f_path, *f_path.parents):  # The nearest weighted ancestor applies
+                weight = weights.get(str(candidate))
+                if weight is not None:
+                    return weight
+            return 0.0
+
+        candidates = [
+            PackCandidate(
+                path=display_path,
+                tokens=path_tokens + block_tokens,
+                path_tokens=path_tokens,
+                depth=selection_depth(str(f_path), selected, os.sep),
+                weight=weight_for(f_path),
+            )
+            for f_path, (display_path, path_tokens, block_tokens) in zip(plan.files, self.count_files(plan))
+        ]
+
+        # Everything that is not a file entry: the tree header, and the note with its counts at their widest
+        fixed_tokens = sum(self._count(segment.text) for segment in self.iter_segments(plan._replace(files=[])))
+        note_tokens = 0
+        if plan.files:
+            fixed_tokens -= self._count(NO_FILES_MESSAGE)  # Only shown when there are no files
+            note = BUDGET_NOTE.format(budget=budget, truncated=len(plan.files), tree_only=len(plan.files))
+            note_tokens = self._count(note)
+        return pack_files(candidates, budget, fixed_tokens, note_tokens, policy)
+
+    @staticmethod
+    def shard_header_text(plan: FlattenPlan, index: int, count: int, header_mode: str) -> str:
+        files_line = SHARD_FILES_LINE.format(index=index, count=count)
+        if index == 1 or header_mode == "tree":
+            return plan.header + files_line
+        return SHARD_TREE_REFERENCE.format(count=count) + files_line
+
+    def shards(self, plan: FlattenPlan, limit: int, header_mode: str = "reference") -> List[dict]:
+        """The flatten output split into shards of at most `limit` tokens. Raises ValueError.
+
+        Boundaries are planned from per-file token counts (see count_files); only files too large for a
+        shard are encoded again, once, to be split at line boundaries. Each shard's token_count is the sum of
+        its segments' counts, so no shard text is encoded as a whole.
+        """
+        self._require_encoding("Sharded output")
+        if header_mode not in SHARD_HEADER_MODES:
+            raise ValueError(f"Unknown shard_header {header_mode!r} (expected one of: {', '.join(SHARD_HEADER_MODES)})")
+        if plan.empty or not plan.files:
+            text = "".join(segment.text for segment in self.iter_segments(plan))
+            return [{"index": 1, "text": text, "token_count": self._count(text), "files": []}]
+
+        counts = self.count_files(plan)
+        placeholder = SHARD_NUMBER_PLACEHOLDER
+        fence_tokens = self._count(render_file_block_body(""))
+        items = [
+            ShardItem(
+                tokens=path_tokens + block_tokens,
+                piece_overhead=self._count(
+                    display_path + PIECE_PATH_SUFFIX.format(first=placeholder, last=placeholder, total=placeholder) + "\n"
+                )
+                + fence_tokens,
+            )
+            for display_path, path_tokens, block_tokens in counts
+        ]
+        planned = plan_shards(
+            items,
+            limit,
+            first_header_tokens=self._count(self.shard_header_text(plan, 1, placeholder, header_mode)),
+            header_tokens=self._count(self.shard_header_text(plan, 2, placeholder, header_mode)),
+            line_tokens=lambda index: estimate_line_tokens(self.encoding, self.read_text(plan, plan.files[index])[0]),
+        )
+
+        # Files are read once, in order; the pieces of a split file share its text
+        texts = map_ordered(lambda f_path: self.read_text(plan, f_path), plan.files, self.reader_workers)
+        current_index, content, file_key, lines = -1, "", None, None
+        shards = []
+        for shard_number, shard in enumerate(planned, start=1):
+            token_counter = self.new_token_counter(workers=0)
+            parts = [self.shard_header_text(plan, shard_number, len(planned), header_mode)]
+            token_counter.add(parts[0])
+            shard_files = []
+            for entry in shard.entries:
+                while current_index < entry.file_index:
+                    content, file_key = next(texts)
+                    current_index += 1
+                    lines = None
+                display_path = counts[entry.file_index][0]
+                if entry.first_line is None:
+                    segments = [(f"{display_path}\n", None), (render_file_block_body(content), file_key)]
+                else:
+                    if lines is None:
+                        lines = content.split("\n")
+                    display_path += PIECE_PATH_SUFFIX.format(first=entry.first_line, last=entry.last_line, total=len(lines))
+                    piece = "\n".join(lines[entry.first_line - 1 : entry.last_line])
+                    segments = [(f"{display_path}\n", None), (render_file_block_body(piece), None)]
+                for text, key in segments:
+                    parts.append(text)
+                    token_counter.add(text, key)
+                shard_files.append(display_path)
+            shards.append(
+                {"index": shard_number, "text": "".join(parts), "token_count": finish_token_count(token_counter), "files": shard_files}
+            )
+        return shards
+
+
+class FlattenResult(NamedTuple):
+    text: Optional[str]  # None when the output was written to a file or stream
+    token_count: Optional[int]  # None when not counted; -1 on tokenization errors
+    files: int  # Number of files whose contents were included
+    skipped: List[dict]  # Files shown without their content: Flattener.skipped_report
+
+
+def flatten_paths(
+    paths: Iterable[str] = (),
+    preset: Optional[str] = None,
+    exclusion_rules: Optional[dict] = None,
+    output: Union[None, str, os.PathLike, IO[str]] = None,
+    count_tokens: bool = True,
+    ignore_files: bool = False,
+    encoding_name: str = TIKTOKEN_ENCODING_NAME,
+    token_cache: Optional[TokenCountCache] = None,
+    read_limits: ReadLimits = ReadLimits(),
+    revision: Optional[str] = None,
+    repository: str = ".",
+) -> FlattenResult:
+    """Flatten a selection the way Generate does, without the web app.
+
+    `paths` and the selection of the preset `preset` ("user/<name>", "default/<name>" or a bare name) are
+    combined. exclusion_rules defaults to the app's active rules (system_defaults.json). The text is
+    returned, or written to `output` (a path or a text stream) as it is produced. Binary, minified and
+    oversized files (see read_limits) are not read; the result lists them in `skipped`. With `revision`
+    (a branch, tag or commit of the git repository containing `repository`), the paths are read as of that
+    commit from the repository's object database, whatever the working tree holds. Raises ValueError for an
+    unknown preset, repository or revision.
+    """
+    from treeb import presets
+
+    selection, excluded = [str(p) for p in paths], []
+    if preset:
+        preset_file = presets.find_selection_preset(preset)
+        if preset_file is None:
+            raise ValueError(f"Selection preset '{preset}' not found")
+        preset_selection = presets.load_selection_preset(preset_file).selection
+        selection.extend(preset_selection.include)
+        excluded.extend(preset_selection.exclude)
+
+    flattener = Flattener(
+        exclusion_rules if exclusion_rules is not None else presets.load_exclusion_rules(),
+        encoding=load_encoding(encoding_name) if count_tokens else None,
+        token_cache=token_cache,
+        read_limits=read_limits,
+        source=GitRepository.discover(repository).revision(revision) if revision else None,
+    )
+    plan = flattener.plan(selection, ignore_files=ignore_files, excluded=excluded)
+
+    token_counter = flattener.new_token_counter()
+    text_parts: List[str] = []
+    stream = open(output, "w", encoding="utf-8") if isinstance(output, (str, os.PathLike)) else output
+    try:
+        for text, file_key, final in flattener.iter_segments(plan):
+            if stream is not None:
+                stream.write(text)
+            else:
+                text_parts.append(text)
+            if token_counter:
+                token_counter.add(text, file_key, final)
+        token_count = finish_token_count(token_counter) if token_counter else None
+    finally:
+        if token_counter:
+            token_counter.close()
+        if stream is not None and stream is not output:
+            stream.close()
+        if flattener.source is not None:
+            flattener.source.repository.close()
+
+    return FlattenResult(
+        text=None if stream is not None else "".join(text_parts),
+        token_count=token_count,
+        files=len(plan.files) - len(plan.skipped),
+        skipped=Flattener.skipped_report(plan),
+    )
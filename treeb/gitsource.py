@@ -0,0 +1,441 @@
+# treeb/treeb/gitsource.py
+
+import logging
+import os
+import posixpath
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from treeb.listing import ListedEntry
+from treeb.tokencache import FileKey
+from treeb.walker import ExclusionCheck, SelectionWalk
+
+logger = logging.getLogger(__name__)
+
+GIT_BINARY = os.environ.get("TREEB_GIT", "git")
+DEFAULT_BLOB_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_SNAPSHOT_CACHE_ENTRIES = 4
+# Branch and tag names are resolved again after this long, so new commits show up within it; a full commit id
+# names the same commit for good
+RESOLVED_REVISION_SECONDS = 2.0
+MAX_RESOLVED_REVISIONS = 256
+
+# ls-tree modes
+TREE_MODE = "040000"
+SYMLINK_MODE = "120000"
+SUBMODULE_MODE = "160000"
+
+
+class GitEntry(NamedTuple):
+    mode: str
+    sha: str
+    size: int  # Bytes of the blob; 0 for trees and submodules
+
+
+def run_git(args: List[str], cwd: Optional[str] = None) -> bytes:
+    """stdout of a git command; ValueError with git's message if it fails or git is not installed."""
+    try:
+        completed = subprocess.run(
+            [GIT_BINARY, *args], cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+    except OSError as e:
+        raise ValueError(f"Could not run git: {e}")
+    if completed.returncode != 0:
+        message = completed.stderr.decode("utf-8", errors="replace").strip().splitlines()
+        raise ValueError(message[-1] if message else f"git {args[0]} failed")
+    return completed.stdout
+
+
+class RevisionSnapshot:
+    """Every path of one commit (from a single `git ls-tree -r -t -l`), by repository-relative posix path."""
+
+    def __init__(self, commit: str, entries: Dict[str, GitEntry]):
+        self.commit = commit
+        self.entries = entries
+        self.children: Dict[str, List[str]] = {"": []}
+        for rel in entries:
+            parent, name = posixpath.split(rel)
+            self.children.setdefault(parent, []).append(name)
+            if entries[rel].mode == TREE_MODE:
+                self.children.setdefault(rel, [])
+
+    @classmethod
+    def from_ls_tree(cls, commit: str, output: bytes) -> "RevisionSnapshot":
+        entries = {}
+        for record in output.split(b"\0"):
+            if not record:
+                continue
+            meta, raw_path = record.split(b"\t", 1)
+            mode, _, sha, size = meta.decode("ascii").split()
+            entries[os.fsdecode(raw_path)] = GitEntry(mode, sha, int(size) if size != "-" else 0)
+        return cls(commit, entries)
+
+    def is_dir(self, rel: str) -> bool:
+        return rel in self.children
+
+
+class GitRepository:
+    """A local repository whose objects are read with the git binary, so loose objects, packfiles and
+    alternates all work as they do for git itself.
+
+    Blobs come from one long-running `git cat-file --batch` process and are kept in an LRU of at most
+    blob_cache_bytes; the tree of a commit is listed once and kept as a RevisionSnapshot. Blob ids name
+    their content, so neither cache is ever stale.
+    """
+
+    def __init__(
+        self,
+        toplevel: str,
+        blob_cache_bytes: int = DEFAULT_BLOB_CACHE_BYTES,
+        snapshot_cache_entries: int = DEFAULT_SNAPSHOT_CACHE_ENTRIES,
+    ):
+        self.toplevel = toplevel
+        self.blob_cache_bytes = blob_cache_bytes
+        self.snapshot_cache_entries = snapshot_cache_entries
+        self._blobs: "OrderedDict[str, bytes]" = OrderedDict()
+        self._blob_bytes = 0
+        self._snapshots: "OrderedDict[str, RevisionSnapshot]" = OrderedDict()
+        self._resolved: Dict[str, Tuple[str, float]] = {}  # Revision -> (commit, monotonic time resolved)
+        self._lock = threading.Lock()  # Guards the caches
+        self._batch_lock = threading.Lock()  # One request at a time on the cat-file pipe
+        self._batch: Optional[subprocess.Popen] = None
+
+    @classmethod
+    def discover(cls, path: str, **kwargs) -> "GitRepository":
+        """The repository containing `path` (a working tree or a bare repository). Raises ValueError."""
+        if not os.path.isdir(path):
+            raise ValueError(f"Repository path {path} is not a directory")
+        bare, git_dir = run_git(["rev-parse", "--is-bare-repository", "--absolute-git-dir"], cwd=path).decode().split("\n")[:2]
+        if bare == "true":
+            return cls(os.path.realpath(git_dir), **kwargs)
+        toplevel = run_git(["rev-parse", "--show-toplevel"], cwd=path).decode().strip()
+        return cls(os.path.realpath(toplevel), **kwargs)
+
+    def resolve_revision(self, rev: str) -> str:
+        """The commit id a revision (branch, tag, sha, "HEAD~2", ...) names, as git said within the last
+        RESOLVED_REVISION_SECONDS. Raises ValueError."""
+        if not rev or rev.startswith("-"):
+            raise ValueError(f"Invalid revision {rev!r}")
+        now = time.monotonic()
+        with self._lock:
+            known = self._resolved.get(rev)
+        if known is not None and (known[0] == rev or now - known[1] < RESOLVED_REVISION_SECONDS):
+            return known[0]
+        try:
+            output = run_git(["rev-parse", "--verify", "--quiet", f"{rev}^{{commit}}"], cwd=self.toplevel)
+        except ValueError:
+            raise ValueError(f"Unknown revision {rev!r} in {self.toplevel}")
+        commit = output.decode("ascii").strip()
+        with self._lock:
+            if len(self._resolved) >= MAX_RESOLVED_REVISIONS:
+                self._resolved.clear()
+            self._resolved[rev] = (commit, now)
+        return commit
+
+    def snapshot(self, commit: str) -> RevisionSnapshot:
+        with self._lock:
+            snapshot = self._snapshots.get(commit)
+            if snapshot is not None:
+                self._snapshots.move_to_end(commit)
+                return snapshot
+        output = run_git(["ls-tree", "-r", "-t", "-l", "-z", "--full-tree", commit], cwd=self.toplevel)
+        snapshot = RevisionSnapshot.from_ls_tree(commit, output)
+        logger.info(f"Git: listed {len(snapshot.entries)} paths of {commit[:12]} in {self.toplevel}")
+        with self._lock:
+            self._snapshots[commit] = snapshot
+            while len(self._snapshots) > self.snapshot_cache_entries:
+                self._snapshots.popitem(last=False)
+        return snapshot
+
+    def read_blob(self, sha: str) -> bytes:
+        """A blob's content, from the cache or the cat-file process. Raises ValueError for a missing object."""
+        with self._lock:
+            data = self._blobs.get(sha)
+            if data is not None:
+                self._blobs.move_to_end(sha)
+                return data
+        data = self._cat_file(sha)
+        if len(data) <= self.blob_cache_bytes:
+            with self._lock:
+                if sha not in self._blobs:
+                    self._blobs[sha] = data
+                    self._blob_bytes += len(data)
+                while self._blob_bytes > self.blob_cache_bytes:
+                    _, evicted = self._blobs.popitem(last=False)
+                    self._blob_bytes -= len(evicted)
+        return data
+
+    def _cat_file(self, sha: str) -> bytes:
+        with self._batch_lock:
+            for _ in range(2):
+                if self._batch is None or self._batch.poll() is not None:
+                    try:
+                        self._batch = subprocess.Popen(
+                            [GIT_BINARY, "cat-file", "--batch"],
+                            cwd=self.toplevel,
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL,
+                        )
+                    except OSError as e:
+                        raise ValueError(f"Could not run git: {e}")
+                try:
+                    self._batch.stdin.write(sha.encode("ascii") + b"\n")
+                    self._batch.stdin.flush()
+                    header = self._batch.stdout.readline().split()
+                    if len(header) == 2 and header[1] == b"missing":
+                        raise ValueError(f"Object {sha} is missing from {self.toplevel}")
+                    size = int(header[2])
+                    data = self._batch.stdout.read(size)
+                    self._batch.stdout.read(1)  # The newline after the content
+                    if len(data) != size:
+                        raise OSError("short read")
+                    return data
+                except (OSError, IndexError) as e:  # The process died; start a new one once
+                    logger.warning(f"Git: cat-file process for {self.toplevel} failed ({e}), restarting it.")
+                    self._stop_batch()
+            raise ValueError(f"Could not read object {sha} from {self.toplevel}")
+
+    def _stop_batch(self):
+        if self._batch is not None:
+            try:
+                self._batch.kill()
+                self._batch.wait()
+            except OSError:
+                pass
+            self._batch = None
+
+    def revision(self, rev: str) -> "GitRevision":
+        return GitRevision(self, rev)
+
+    def close(self):
+        with self._batch_lock:
+            self._stop_batch()
+
+
+class GitRevision:
+    """One commit of a repository as a flatten source, in place of the working tree.
+
+    Paths are those the files have in the working tree (toplevel joined with the path in the commit), so
+    selections, tree node ids and displayed paths look the same as for a checkout of the commit. Symlinks
+    are resolved within the commit as a checkout would resolve them; submodules are shown without content.
+    Only tracked files exist, so .gitignore rules have nothing left to drop.
+    """
+
+    MAX_SYMLINK_HOPS = 40
+
+    def __init__(self, repository: GitRepository, rev: str):
+        self.repository = repository
+        self.rev = rev
+        self.commit = repository.resolve_revision(rev)
+        self.snapshot = repository.snapshot(self.commit)
+        self._real: Dict[str, Optional[str]] = {}
+
+    def relative(self, path) -> Optional[str]:
+        """The repository-relative posix path of a path below toplevel, "" for toplevel, None if outside."""
+        path_str, top = str(path), self.repository.toplevel.rstrip(os.sep)
+        if path_str == top:
+            return ""
+        if path_str.startswith(top + os.sep):
+            return path_str[len(top) + 1 :].replace(os.sep, "/")
+        return None
+
+    def absolute(self, rel: str) -> str:
+        return os.path.join(self.repository.toplevel, *rel.split("/")) if rel else self.repository.toplevel
+
+    def real_relative(self, rel: str) -> Optional[str]:
+        """`rel` with every symlink in it replaced by its target, like os.path.realpath in a checkout; None if
+        it does not exist in the commit or a link leads out of the repository."""
+        if rel not in self._real:
+            self._real[rel] = self._resolve(rel)
+        return self._real[rel]
+
+    def _resolve(self, rel: str) -> Optional[str]:
+        entries = self.snapshot.entries
+        resolved, pending, hops = "", rel.split("/"), 0
+        while pending:
+            name = pending.pop(0)
+            if name in ("", "."):
+                continue
+            if name == "..":
+                if not resolved:
+                    return None
+                resolved = posixpath.dirname(resolved)
+                continue
+            candidate = posixpath.join(resolved, name) if resolved else name
+            entry = entries.get(candidate)
+            if entry is None:
+                return None
+            if entry.mode != SYMLINK_MODE:
+                resolved = candidate
+                continue
+            hops += 1
+            if hops > self.MAX_SYMLINK_HOPS:
+                return None
+            target = os.fsdecode(self.repository.read_blob(entry.sha))
+            if target.startswith("/"):
+                target_rel = self.relative(os.path.normpath(target))
+                if target_rel is None:
+                    return None
+                resolved, pending = "", target_rel.split("/") + pending
+            else:
+                pending = target.split("/") + pending
+        return resolved
+
+    def _dangling_target(self, rel: str) -> str:
+        """Where a link that does not resolve points, as os.path.realpath reports it for a dangling link."""
+        target = os.fsdecode(self.repository.read_blob(self.snapshot.entries[rel].sha))
+        parent = self.real_relative(posixpath.dirname(rel)) or ""
+        return os.path.normpath(os.path.join(self.absolute(parent), target))
+
+    def _real_path(self, path) -> Optional[str]:
+        rel = self.relative(path)
+        return self.real_relative(rel) if rel is not None else None
+
+    def entry(self, path) -> Optional[GitEntry]:
+        real = self._real_path(path)
+        return self.snapshot.entries.get(real) if real else None
+
+    def exists(self, path) -> bool:
+        return self._real_path(path) is not None
+
+    def is_dir(self, path) -> bool:
+        real = self._real_path(path)
+        return real is not None and self.snapshot.is_dir(real)
+
+    def is_file(self, path) -> bool:
+        entry = self.entry(path)
+        return entry is not None and entry.mode not in (TREE_MODE, SUBMODULE_MODE)
+
+    def list_directory(self, dir_path: str) -> List[ListedEntry]:
+        """The directory's entries as snapshot_directory would list them in a checkout. Raises OSError."""
+        real = self._real_path(dir_path)
+        if real is None or not self.snapshot.is_dir(real):
+            raise FileNotFoundError(f"{dir_path} is not a directory in {self.commit[:12]}")
+        listed = []
+        for name in self.snapshot.children[real]:
+            child_rel = posixpath.join(real, name) if real else name
+            is_symlink = self.snapshot.entries[child_rel].mode == SYMLINK_MODE
+            child_real = self.real_relative(child_rel) if is_symlink else child_rel
+            entry = self.snapshot.entries.get(child_real) if child_real else None
+            is_dir = child_real is not None and self.snapshot.is_dir(child_real)
+            real_path = None
+            if is_symlink:
+                real_path = self.absolute(child_real) if child_real is not None else self._dangling_target(child_rel)
+            listed.append(
+                ListedEntry(
+                    name=name,
+                    path=os.path.join(dir_path, name),
+                    is_dir=is_dir,
+                    is_file=entry is not None and entry.mode not in (TREE_MODE, SUBMODULE_MODE),
+                    is_symlink=is_symlink,
+                    real_path=real_path,
+                    exists=child_real is not None,
+                )
+            )
+        listed.sort(key=lambda e: (not e.is_dir, e.name.lower()))
+        return listed
+
+    def walk(self, selected_paths: Iterable[Path], is_excluded: ExclusionCheck) -> SelectionWalk:
+        """walk_selection over the commit instead of the filesystem: same exclusions, symlink handling and order."""
+        structure: Set[str] = set()
+        files: Set[str] = set()
+        real_paths: Dict[str, str] = {}
+        walked_dirs: Set[str] = set()
+        stack: List[Tuple[str, str]] = []
+
+        for root in selected_paths:
+            root_str = str(root)
+            if not self.exists(root_str):
+                logger.warning(f"Walk: Selected path {root_str} does not exist in {self.commit[:12]}. Skipping.")
+                continue
+            is_dir, is_file = self.is_dir(root_str), self.is_file(root_str)
+            exclusion_info = is_excluded(root_str, root.name, is_dir, is_file)
+            if exclusion_info:
+                logger.debug(f"Walk: Directly selected item {root_str} is excluded by rule: {exclusion_info}. Skipping.")
+                continue
+            structure.add(root_str)
+            if is_file:
+                files.add(root_str)
+            elif is_dir:
+                stack.append((root_str, root_str))
+
+        while stack:
+            dir_path, dir_real = stack.pop()
+            if dir_path in walked_dirs:
+                continue
+            walked_dirs.add(dir_path)
+            for entry in self.list_directory(dir_path):
+                exclusion_info = is_excluded(entry.path, entry.name, entry.is_dir, entry.is_file)
+                if exclusion_info:
+                    logger.debug(f"Walk: {entry.path} excluded by rule: {exclusion_info}. Skipping its children.")
+                    continue
+                structure.add(entry.path)
+                child_real = entry.real_path if entry.is_symlink else os.path.join(dir_real, entry.name)
+                if child_real != entry.path:
+                    real_paths[entry.path] = child_real
+                if entry.is_file:
+                    files.add(entry.path)
+                elif entry.is_dir:
+                    if entry.is_symlink and (dir_real == child_real or dir_real.startswith(child_real.rstrip(os.sep) + os.sep)):
+                        logger.warning(f"Walk: Not following symlink loop {entry.path} -> {child_real}")
+                        continue
+                    stack.append((entry.path, child_real))
+
+        return SelectionWalk(
+            structure_paths=[Path(p) for p in sorted(structure, key=str.lower)],
+            files=[Path(p) for p in sorted(files, key=str.lower)],
+            real_paths=real_paths,
+        )
+
+    def size(self, path) -> Optional[int]:
+        entry = self.entry(path)
+        return entry.size if entry is not None and entry.mode not in (TREE_MODE, SUBMODULE_MODE) else None
+
+    def read_head(self, path, size: int) -> bytes:
+        entry = self.entry(path)
+        return self.repository.read_blob(entry.sha)[:size] if entry is not None else b""
+
+    def file_key(self, path) -> Optional[FileKey]:
+        """Token cache key of the file's content: the blob id, so every path and revision with it share a count."""
+        entry = self.entry(path)
+        return (f"git-blob:{entry.sha}", 0, entry.size) if entry is not None else None
+
+    def read_text(self, path) -> Tuple[str, Optional[FileKey]]:
+        """read_file_text for the file as of this commit."""
+        entry = self.entry(path)
+        if entry is None or entry.mode in (TREE_MODE, SUBMODULE_MODE):
+            return "[Error reading file: not a file in this revision]", None
+        try:
+            text = self.repository.read_blob(entry.sha).decode("utf-8", errors="replace")
+        except ValueError as e:
+            return f"[Error reading file: {e}]", None
+        if "\r" in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+        return text, (f"git-blob:{entry.sha}", 0, entry.size)
+
+
+class GitRepositories:
+    """GitRepository objects (and their cat-file processes and caches) shared across requests, by toplevel,
+    and the toplevel found for each repository path asked for, so git runs once per path."""
+
+    def __init__(self, blob_cache_bytes: int = DEFAULT_BLOB_CACHE_BYTES):
+        self.blob_cache_bytes = blob_cache_bytes
+        self._by_toplevel: Dict[str, GitRepository] = {}
+        self._toplevels: Dict[str, str] = {}  # Repository path -> toplevel
+        self._lock = threading.Lock()
+
+    def revision(self, repo_path: str, rev: str) -> GitRevision:
+        """The revision `rev` of the repository containing repo_path. Raises ValueError."""
+        with self._lock:
+            repository = self._by_toplevel.get(self._toplevels.get(repo_path, ""))
+        if repository is None or not os.path.isdir(repo_path):
+            discovered = GitRepository.discover(repo_path, blob_cache_bytes=self.blob_cache_bytes)
+            with self._lock:
+                repository = self._by_toplevel.setdefault(discovered.toplevel, discovered)
+                self._toplevels[repo_path] = repository.toplevel
+        return repository.revision(rev)
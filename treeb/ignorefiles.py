@@ -0,0 +1,261 @@
+# treeb/treeb/ignorefiles.py
+
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Pattern, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Read in every directory, later files override earlier ones (same as ripgrep)
+IGNORE_FILE_NAMES = (".gitignore", ".ignore")
+# Read once at the repository top, with the lowest precedence
+REPO_EXCLUDE_FILE = os.path.join(".git", "info", "exclude")
+
+_PARSED_FILE_CACHE_SIZE = 2048
+
+
+class IgnorePattern(NamedTuple):
+    text: str  # The line as written, for the UI
+    source: str  # File name it came from, e.g. ".gitignore"
+    negated: bool
+    dir_only: bool
+    anchored: bool  # Matched against the path relative to the file's directory instead of the name
+    regex: str
+
+
+def _translate(pattern: str) -> str:
+    """Translate a gitignore glob into a regex (without anchors). '/' is never matched by * ? or [...]."""
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern.startswith("**", i):
+                j = i + 2
+                at_segment_start = i == 0 or pattern[i - 1] == "/"
+                at_segment_end = j == n or pattern[j] == "/"
+                if at_segment_start and at_segment_end:
+                    if j == n:  # "foo/**" or "**": everything below
+                        out.append(".*")
+                        i = j
+                    else:  # "**/": zero or more directories
+                        out.append("(?:.*/)?")
+                        i = j + 1
+                    continue
+                out.append("[^/]*")
+                i = j
+                continue
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            j = i + 1
+            if j < n and pattern[j] in "!^":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            while j < n and pattern[j] != "]":
+                j += 1
+            if j >= n:  # No closing bracket: literal
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1 : j]
+                negate = body[:1] in ("!", "^")
+                if negate:
+                    body = body[1:]
+                body = "".join(ch if ch == "-" else re.escape(ch) for ch in body)
+                out.append(f"[^/{body}]" if negate else f"[{body}]")
+                i = j
+        elif c == "\\" and i + 1 < n:
+            out.append(re.escape(pattern[i + 1]))
+            i += 1
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+def parse_ignore_line(line: str, source: str) -> Optional[IgnorePattern]:
+    """One line of a gitignore-style file, or None for blanks and comments."""
+    line = line.rstrip("\r\n")
+    # Trailing spaces are ignored unless escaped
+    stripped = line.rstrip(" ")
+    if stripped.endswith("\\") and len(stripped) < len(line):
+        stripped += " "
+    line = stripped
+    if not line or line.startswith("#"):
+        return None
+
+    text = line
+    negated = line.startswith("!")
+    if negated:
+        line = line[1:]
+    elif line.startswith(("\\!", "\\#")):
+        line = line[1:]
+
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+    anchored = "/" in line  # A slash at the start or in the middle ties the pattern to the file's directory
+    line = line.lstrip("/")
+    return IgnorePattern(
+        text=text, source=source, negated=negated, dir_only=dir_only, anchored=anchored, regex=_translate(line)
+    )
+
+
+class IgnoreRuleSet:
+    """The patterns read from one directory's ignore files, compiled into a few combined regexes.
+
+    Within a directory the last matching pattern wins, so alternatives are combined in reverse order and
+    the first alternative that matches is the answer.
+    """
+
+    def __init__(self, base_dir: str, patterns: List[IgnorePattern]):
+        self.base_dir = base_dir
+        self.patterns = patterns
+        # (match against name?, item is dir?) -> combined regex, or None if no pattern applies
+        self._regexes: Dict[Tuple[bool, bool], Optional[Pattern]] = {}
+        for by_name in (True, False):
+            for is_dir in (True, False):
+                alternatives = [
+                    f"(?P<p{index}>{pattern.regex})"
+                    for index, pattern in reversed(list(enumerate(patterns)))
+                    if pattern.anchored != by_name and (is_dir or not pattern.dir_only)
+                ]
+                self._regexes[(by_name, is_dir)] = (
+                    re.compile("(?:" + "|".join(alternatives) + r")\Z", re.DOTALL) if alternatives else None
+                )
+
+    def _relative(self, path: str) -> Optional[str]:
+        prefix = self.base_dir.rstrip(os.sep) + os.sep
+        if not path.startswith(prefix):
+            return None
+        rel = path[len(prefix) :]
+        return rel.replace(os.sep, "/") if os.sep != "/" else rel
+
+    def match(self, path: str, name: str, is_dir: bool) -> Optional[IgnorePattern]:
+        """The deciding pattern for an item below base_dir (may be a negation), or None."""
+        best = -1
+        name_regex = self._regexes[(True, is_dir)]
+        if name_regex is not None:
+            m = name_regex.match(name)
+            if m:
+                best = int(m.lastgroup[1:])
+        rel_regex = self._regexes[(False, is_dir)]
+        if rel_regex is not None:
+            rel = self._relative(path)
+            if rel is not None:
+                m = rel_regex.match(rel)
+                if m:
+                    best = max(best, int(m.lastgroup[1:]))
+        return self.patterns[best] if best >= 0 else None
+
+
+class DirIgnoreContext:
+    """The ignore rule stack in effect for the entries of one directory."""
+
+    def __init__(self, dir_path: str, rule_sets: Tuple[IgnoreRuleSet, ...], ignored_by: Optional[dict]):
+        self.dir_path = dir_path
+        self.rule_sets = rule_sets  # Outermost first
+        self.ignored_by = ignored_by  # Set when the directory itself (or an ancestor) is ignored
+
+    def match(self, path: str, name: str, is_dir: bool) -> Optional[dict]:
+        """Excluded_info for an entry of this directory, or None if it is not ignored."""
+        if self.ignored_by:
+            return self.ignored_by
+        for rule_set in reversed(self.rule_sets):  # Deeper ignore files override outer ones
+            pattern = rule_set.match(path, name, is_dir)
+            if pattern is not None:
+                return None if pattern.negated else {"type": pattern.source, "rule": pattern.text}
+        return None
+
+
+_parsed_files: "OrderedDict[str, Tuple[int, int, List[IgnorePattern]]]" = OrderedDict()
+_parsed_files_lock = threading.Lock()
+
+
+def load_ignore_file(file_path: str, source: str) -> Optional[List[IgnorePattern]]:
+    """Parsed patterns of an ignore file, or None if it does not exist. Cached until its mtime/size change."""
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    with _parsed_files_lock:
+        cached = _parsed_files.get(file_path)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            _parsed_files.move_to_end(file_path)
+            return cached[2]
+    try:
+        with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+            patterns = [p for p in (parse_ignore_line(line, source) for line in f) if p is not None]
+    except OSError as e:
+        logger.warning(f"Could not read ignore file {file_path}: {e}")
+        return None
+    with _parsed_files_lock:
+        _parsed_files[file_path] = (st.st_mtime_ns, st.st_size, patterns)
+        _parsed_files.move_to_end(file_path)
+        while len(_parsed_files) > _PARSED_FILE_CACHE_SIZE:
+            _parsed_files.popitem(last=False)
+    return patterns
+
+
+class IgnoreFileRules:
+    """Per-directory cache of ignore rule stacks for one walk or tree request.
+
+    Each directory's ignore files are read once; the stack for a directory is its parent's stack plus its
+    own files. Rules are collected upwards to the repository top (the nearest directory containing .git),
+    or the filesystem root outside a repository. Ignore files inside ignored directories are not read,
+    as with git.
+    """
+
+    def __init__(self):
+        self._contexts: Dict[str, DirIgnoreContext] = {}
+
+    def _load_rule_set(self, dir_path: str, names: Optional[Iterable[str]], is_repo_top: bool) -> Optional[IgnoreRuleSet]:
+        patterns: List[IgnorePattern] = []
+        if is_repo_top:
+            patterns.extend(load_ignore_file(os.path.join(dir_path, REPO_EXCLUDE_FILE), "info/exclude") or [])
+        present = set(names) if names is not None else None
+        for file_name in IGNORE_FILE_NAMES:
+            if present is not None and file_name not in present:
+                continue  # Known from the directory listing, no need to try opening it
+            patterns.extend(load_ignore_file(os.path.join(dir_path, file_name), file_name) or [])
+        return IgnoreRuleSet(dir_path, patterns) if patterns else None
+
+    def for_directory(self, dir_path: str, names: Optional[Iterable[str]] = None) -> DirIgnoreContext:
+        """Rule stack for the entries of dir_path. Pass the directory's entry names if already listed."""
+        context = self._contexts.get(dir_path)
+        if context is not None:
+            return context
+
+        parent_path = os.path.dirname(dir_path)
+        is_repo_top = names is not None and ".git" in names
+        if names is None:
+            is_repo_top = os.path.exists(os.path.join(dir_path, ".git"))
+
+        if is_repo_top or not parent_path or parent_path == dir_path:
+            rule_sets: Tuple[IgnoreRuleSet, ...] = ()
+            ignored_by = None
+        else:
+            parent = self.for_directory(parent_path)
+            rule_sets = parent.rule_sets
+            ignored_by = parent.match(dir_path, os.path.basename(dir_path), True)
+
+        if ignored_by is None:
+            own_rules = self._load_rule_set(dir_path, names, is_repo_top)
+            if own_rules is not None:
+                rule_sets = rule_sets + (own_rules,)
+        context = DirIgnoreContext(dir_path, rule_sets, ignored_by)
+        self._contexts[dir_path] = context
+        return context
+
+    def match(self, path: str, is_dir: bool) -> Optional[dict]:
+        """Excluded_info for a single path, using (and caching) the stack of its parent directory."""
+        parent_path = os.path.dirname(path)
+        if not parent_path or parent_path == path:
+            return None
+        return self.for_directory(parent_path).match(path, os.path.basename(path), is_dir)
@@ -0,0 +1,102 @@
+# treeb/treeb/ingest.py
+
+import mmap
+import os
+import re
+from pathlib import Path
+from typing import Iterator, Optional, Tuple, Union
+
+from treeb.tokencache import FileKey
+
+DEFAULT_MMAP_THRESHOLD_BYTES = 1024 * 1024  # Smaller files are read in one go
+DEFAULT_CHUNK_BYTES = 256 * 1024
+
+# Chunks end right after a newline followed by a letter or digit: tiktoken's pre-tokenizers (cl100k_base,
+# o200k_base) always split there, so the token counts of the chunks add up to the count of the whole text.
+SAFE_CUT = re.compile(rb"\n(?=[A-Za-z0-9])")
+
+
+class MappedText:
+    """A large file's text, decoded from a memory map one bounded chunk at a time.
+
+    The text is what read_file_text would return (UTF-8 with replacement characters, universal newlines):
+    chunks end after a newline, so no character or "\\r\\n" pair is ever split. Pages already decoded are
+    released with madvise, so memory use follows the chunk size rather than the file size.
+    """
+
+    def __init__(self, mapped: mmap.mmap, chunk_bytes: int = DEFAULT_CHUNK_BYTES):
+        self._map = mapped
+        self.chunk_bytes = max(chunk_bytes, 1)
+
+    def _cut(self, start: int) -> int:
+        """End of the chunk starting at `start`: a SAFE_CUT within twice the chunk size, else any newline, else
+        the nearest character boundary (only these last two may shift the token count by a token or so)."""
+        size = len(self._map)
+        soft_end = start + self.chunk_bytes
+        hard_end = start + 2 * self.chunk_bytes
+        if hard_end >= size:
+            return size
+        match = SAFE_CUT.search(self._map, soft_end, hard_end)
+        if match:
+            return match.end()
+        newline = self._map.find(b"\n", soft_end, hard_end)
+        if newline != -1:
+            return newline + 1
+        end = hard_end
+        while end > start and self._splits_character(end):
+            end -= 1
+        if end == start:  # A single character wider than the window
+            end = hard_end
+            while end < size and self._splits_character(end):
+                end += 1
+        return end
+
+    def _splits_character(self, position: int) -> bool:
+        """Whether cutting before `position` would split a UTF-8 sequence or a "\\r\\n" pair."""
+        byte = self._map[position]
+        return 0x80 <= byte < 0xC0 or (byte == 0x0A and self._map[position - 1] == 0x0D)
+
+    def _release(self, start: int, end: int):
+        if not hasattr(mmap, "MADV_DONTNEED"):
+            return
+        start -= start % mmap.PAGESIZE
+        end -= end % mmap.PAGESIZE
+        if end > start:
+            self._map.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+    def chunks(self) -> Iterator[str]:
+        """The text in chunks of about chunk_bytes; closes the map once exhausted."""
+        try:
+            start = 0
+            size = len(self._map)
+            while start < size:
+                end = self._cut(start)
+                text = self._map[start:end].decode("utf-8", errors="replace")
+                if "\r" in text:
+                    text = text.replace("\r\n", "\n").replace("\r", "\n")
+                self._release(start, end)
+                yield text
+                start = end
+        finally:
+            self.close()
+
+    def read(self) -> str:
+        return "".join(self.chunks())
+
+    def close(self):
+        if not self._map.closed:
+            self._map.close()
+
+
+def map_file_text(f_path: Path, chunk_bytes: int = DEFAULT_CHUNK_BYTES) -> Tuple[Union[str, MappedText], Optional[FileKey]]:
+    """read_file_text for a large file: its text as a MappedText, with the cache key of the version mapped.
+
+    Nothing is read yet; the text is decoded as the chunks are consumed.
+    """
+    try:
+        with open(f_path, "rb") as f:
+            st = os.fstat(f.fileno())
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return MappedText(mapped, chunk_bytes), (str(f_path), st.st_mtime_ns, st.st_size)
+    except Exception as e:
+        return f"[Error reading file: {e}]", None
@@ -0,0 +1,212 @@
+# treeb/treeb/jobs.py
+
+import logging
+import secrets
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+from treeb.flatten import Segment
+from treeb.pipeline import Cancelled
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOB_WORKERS = 2
+DEFAULT_MAX_QUEUED_JOBS = 16
+# Finished jobs keep their result this long, for the page to fetch (again) without flattening again
+DEFAULT_RESULT_TTL_SECONDS = 300.0
+# A job nobody has asked about for this long is cancelled: the page that submitted it was closed
+DEFAULT_ABANDON_SECONDS = 60.0
+# How often finished jobs are expired and abandoned ones cancelled while there are unfinished jobs
+WATCH_INTERVAL_SECONDS = 1.0
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+class QueueFull(Exception):
+    """Raised by FlattenJobs.submit when max_queued jobs are already waiting for a worker."""
+
+
+class FlattenJob:
+    """A flatten run by FlattenJobs: its state, its progress while it runs and its result once done.
+
+    Progress counts the files read (files_total leaves out the files the plan skips), their bytes and the
+    tokens counted so far; tokenizing lags reading a little. The output produced so far can be read while the
+    job runs (text_from), so the page can show it as it grows. Updated by the job's thread, read by any.
+    """
+
+    def __init__(self, job_id: str, abandon_seconds: float = DEFAULT_ABANDON_SECONDS):
+        self.id = job_id
+        self.abandon_seconds = abandon_seconds
+        self.state = QUEUED
+        self.cancel_event = threading.Event()  # Given to the Flattener, so it stops walking and reading
+        self.submitted = time.monotonic()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.last_seen = self.submitted
+        self.files_total: Optional[int] = None  # Known once the selection has been walked
+        self.files_done = 0
+        self.bytes_done = 0
+        self.tokens = 0
+        self.result: Optional[dict] = None
+        self.error: Optional[str] = None
+        # The segments' texts so far (the strings the output is joined from, not copies) and where each ends;
+        # dropped once the job finishes and its result holds the whole text
+        self._text_parts: List[str] = []
+        self._text_ends: List[int] = []
+
+    @property
+    def done(self) -> bool:
+        return self.state in FINISHED_STATES
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def seen(self):
+        self.last_seen = time.monotonic()
+
+    def abandoned(self) -> bool:
+        return not self.done and time.monotonic() - self.last_seen > self.abandon_seconds
+
+    def add_segment(self, segment: Segment, tokens: int):
+        """Progress after a segment of the output: a file was read when its (last) block segment has a key."""
+        if segment.key is not None and segment.final:
+            self.files_done += 1
+            self.bytes_done += segment.key[2]
+        self.tokens = tokens
+        self._text_parts.append(segment.text)  # Before its end: text_from only looks at parts with an end
+        self._text_ends.append((self._text_ends[-1] if self._text_ends else 0) + len(segment.text))
+
+    def text_from(self, offset: int) -> Tuple[str, int]:
+        """The output produced so far after character `offset`, and the offset it reaches; ("", offset) once
+        the job has finished (the result holds the whole text) or when nothing new was produced."""
+        parts, ends = self._text_parts, self._text_ends
+        count = len(ends)
+        if count == 0 or ends[count - 1] <= offset:
+            return "", offset
+        first = bisect_right(ends, offset, 0, count)
+        start = ends[first - 1] if first else 0
+        return parts[first][offset - start :] + "".join(parts[first + 1 : count]), ends[count - 1]
+
+    def to_json(self, with_result: bool = False) -> dict:
+        end = self.finished if self.finished is not None else time.monotonic()
+        data = {
+            "id": self.id,
+            "state": self.state,
+            "files_total": self.files_total,
+            "files_done": self.files_done,
+            "bytes": self.bytes_done,
+            "tokens": self.tokens,
+            "elapsed_ms": round((end - self.started) * 1000, 2) if self.started is not None else 0.0,
+        }
+        if self.error is not None:
+            data["error"] = self.error
+        if with_result and self.result is not None:
+            data["result"] = self.result
+        return data
+
+
+class FlattenJobs:
+    """Flatten jobs run on a bounded pool of worker threads, at most `workers` at a time.
+
+    At most max_queued jobs wait for a worker; submit raises QueueFull beyond that. Finished jobs are kept
+    result_ttl seconds after they finish; unfinished jobs that are not asked about (get) for abandon_seconds
+    are cancelled. Both are checked when jobs are submitted or looked up, and by a watcher thread while any
+    job is unfinished.
+    """
+
+    def __init__(
+        self,
+        workers: int = DEFAULT_JOB_WORKERS,
+        max_queued: int = DEFAULT_MAX_QUEUED_JOBS,
+        result_ttl: float = DEFAULT_RESULT_TTL_SECONDS,
+        abandon_seconds: float = DEFAULT_ABANDON_SECONDS,
+    ):
+        self.workers = max(workers, 1)
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self.abandon_seconds = abandon_seconds
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="treeb-job")
+        self._jobs: "OrderedDict[str, FlattenJob]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._watcher: Optional[threading.Thread] = None
+
+    def submit(self, run: Callable[[FlattenJob], dict]) -> FlattenJob:
+        """Queue run(job), whose return value becomes the job's result. A Cancelled it raises cancels the job;
+        any other exception fails it with the exception's message."""
+        with self._lock:
+            self._expire()
+            if sum(1 for job in self._jobs.values() if job.state == QUEUED) >= self.max_queued:
+                raise QueueFull(f"{self.max_queued} flatten jobs are already waiting; try again later.")
+            job = FlattenJob(secrets.token_hex(8), self.abandon_seconds)
+            self._jobs[job.id] = job
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch, name="treeb-job-watcher", daemon=True)
+                self._watcher.start()
+        self._pool.submit(self._run, job, run)
+        return job
+
+    def _watch(self):
+        while True:
+            time.sleep(WATCH_INTERVAL_SECONDS)
+            with self._lock:
+                self._expire()
+                if all(job.done for job in self._jobs.values()):
+                    self._watcher = None  # The next submit starts a new one
+                    return
+
+    def _run(self, job: FlattenJob, run: Callable[[FlattenJob], dict]):
+        job.started = time.monotonic()
+        state = CANCELLED
+        try:
+            if not (job.cancel_event.is_set() or job.abandoned()):
+                job.state = RUNNING
+                job.result = run(job)
+                state = DONE
+        except Cancelled:
+            pass
+        except Exception as e:
+            logger.error(f"Flatten job {job.id} failed: {e}")
+            job.error = str(e)
+            state = FAILED
+        if state == CANCELLED:
+            logger.info(f"Flatten job {job.id} cancelled after {job.files_done} files")
+        job.finished = time.monotonic()  # Before the state: a finished job is expired by its finish time
+        job.state = state
+        job._text_parts, job._text_ends = [], []
+
+    def get(self, job_id: str) -> Optional[FlattenJob]:
+        """The job, if it is still kept; asking keeps an unfinished job from being cancelled as abandoned."""
+        with self._lock:
+            self._expire()
+            job = self._jobs.get(job_id)
+        if job is not None:
+            job.seen()
+        return job
+
+    def cancel(self, job_id: str) -> Optional[FlattenJob]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            job.cancel()
+        return job
+
+    def _expire(self):
+        now = time.monotonic()
+        for job_id, job in list(self._jobs.items()):
+            if job.done and now - job.finished > self.result_ttl:
+                del self._jobs[job_id]
+            elif job.abandoned() and not job.cancel_event.is_set():
+                logger.info(f"Flatten job {job_id}: not asked about for {self.abandon_seconds:.0f} s, cancelling")
+                job.cancel()
+
+    @property
+    def counts(self) -> dict:
+        """Jobs kept, by state."""
+        with self._lock:
+            states = [job.state for job in self._jobs.values()]
+        return {state: states.count(state) for state in (QUEUED, RUNNING, *FINISHED_STATES)}
@@ -0,0 +1,76 @@
+# treeb/treeb/lazy.py
+
+import logging
+import threading
+import time
+from typing import Callable, Generic, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class BackgroundLoader(Generic[T]):
+    """A value computed once on a daemon thread: started explicitly with start() or by the first get().
+
+    get() waits for it (and re-raises what the loader raised); peek() never waits. Used for startup work
+    that requests may need but that should not delay the server from accepting them.
+    """
+
+    def __init__(self, name: str, load: Callable[[], T]):
+        self.name = name
+        self._load = load
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._value: Optional[T] = None
+        self._error: Optional[BaseException] = None
+        self.load_ms: Optional[float] = None
+
+    def start(self) -> "BackgroundLoader[T]":
+        with self._lock:
+            if self._thread is None and not self._done.is_set():
+                self._thread = threading.Thread(target=self._run, name=f"treeb-{self.name}", daemon=True)
+                self._thread.start()
+        return self
+
+    def _run(self):
+        started = time.perf_counter()
+        value, error = None, None
+        try:
+            value = self._load()
+        except BaseException as e:
+            logger.error(f"Background load '{self.name}' failed: {e}")
+            error = e
+        with self._lock:
+            self.load_ms = (time.perf_counter() - started) * 1000
+            if not self._done.is_set():  # Unless set() gave a value meanwhile
+                self._value, self._error = value, error
+                self._done.set()
+
+    def get(self, timeout: Optional[float] = None) -> T:
+        """The value, waiting for the load (raises TimeoutError if it takes longer than `timeout` seconds)."""
+        self.start()
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"'{self.name}' is still loading")
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def peek(self, default: Optional[T] = None) -> Optional[T]:
+        """The value if it has loaded successfully, else `default`. Does not start or wait for the load."""
+        if self._done.is_set() and self._error is None:
+            return self._value
+        return default
+
+    def set(self, value: T):
+        """Use `value` from now on, as if it had been loaded (a load still running is ignored when it ends)."""
+        with self._lock:
+            self._value, self._error = value, None
+            self._done.set()
+
+    @property
+    def status(self) -> str:
+        if self._done.is_set():
+            return "failed" if self._error is not None else "ready"
+        return "loading" if self._thread is not None else "idle"
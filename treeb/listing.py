@@ -0,0 +1,319 @@
+# treeb/treeb/listing.py
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from treeb.walker import entry_is_dir, entry_is_file, scan_directory
+
+logger = logging.getLogger(__name__)
+
+# A directory whose mtime is this close to the moment it was listed may change again within the same mtime
+# tick (coarse filesystem timestamps), so such a listing is not trusted on mtime alone
+RACY_MTIME_WINDOW_NS = 2_000_000_000
+
+
+class ListedEntry(NamedTuple):
+    """What the tree needs to know about one directory entry, captured when the directory was listed."""
+
+    name: str
+    path: str
+    is_dir: bool
+    is_file: bool
+    is_symlink: bool
+    real_path: Optional[str]  # Resolved target for symlinks, None otherwise
+    exists: bool  # False for dangling symlinks
+
+
+def snapshot_directory(path: str) -> List[ListedEntry]:
+    """scan_directory() turned into plain tuples that stay valid after the scandir iterator is gone."""
+    listed = []
+    for entry in scan_directory(path):
+        is_dir = entry_is_dir(entry)
+        is_file = not is_dir and entry_is_file(entry)
+        is_symlink = entry.is_symlink()
+        listed.append(
+            ListedEntry(
+                name=entry.name,
+                path=entry.path,
+                is_dir=is_dir,
+                is_file=is_file,
+                is_symlink=is_symlink,
+                real_path=os.path.realpath(entry.path) if is_symlink else None,
+                exists=is_dir or is_file or not is_symlink or os.path.exists(entry.path),
+            )
+        )
+    return listed
+
+
+class InotifyWatcher:
+    """Minimal inotify binding (Linux, via ctypes) reporting which watched directories changed.
+
+    on_change(dir_path, subtree) is called from a background thread; `subtree` is True when everything
+    below dir_path may have moved or vanished too. on_change(None, True) means events were lost.
+    """
+
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o0004000
+    IN_CLOEXEC = 0o2000000
+
+    WATCH_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+    _EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, libc, fd: int, on_change: Callable[[Optional[str], bool], None]):
+        self._libc = libc
+        self._fd = fd
+        self._on_change = on_change
+        self._lock = threading.Lock()
+        self._wd_by_path: Dict[str, int] = {}
+        self._path_by_wd: Dict[int, str] = {}
+        self._thread = threading.Thread(target=self._read_events, name="treeb-inotify", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def create(cls, on_change: Callable[[Optional[str], bool], None]) -> Optional["InotifyWatcher"]:
+        """A running watcher, or None where inotify is not available (callers then revalidate by mtime)."""
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(cls.IN_NONBLOCK | cls.IN_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            logger.info(f"inotify not available ({e}); directory listings are revalidated by mtime.")
+            return None
+        if fd < 0:
+            logger.info(f"inotify_init1 failed ({os.strerror(ctypes.get_errno())}); directory listings are revalidated by mtime.")
+            return None
+        return cls(libc, fd, on_change)
+
+    def watch(self, dir_path: str) -> bool:
+        """Start watching dir_path (no-op if already watched). False if the watch could not be added."""
+        with self._lock:
+            if dir_path in self._wd_by_path:
+                return True
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dir_path), self.WATCH_MASK)
+            if wd < 0:
+                # ENOSPC (fs.inotify.max_user_watches reached) and friends: fall back to mtime checks
+                logger.debug(f"inotify_add_watch failed for {dir_path}: {os.strerror(ctypes.get_errno())}")
+                return False
+            self._wd_by_path[dir_path] = wd
+            self._path_by_wd[wd] = dir_path
+            return True
+
+    def is_watched(self, dir_path: str) -> bool:
+        with self._lock:
+            return dir_path in self._wd_by_path
+
+    def unwatch(self, dir_path: str):
+        with self._lock:
+            wd = self._wd_by_path.pop(dir_path, None)
+            if wd is not None:
+                self._path_by_wd.pop(wd, None)
+                self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _read_events(self):
+        while True:
+            try:
+                select.select([self._fd], [], [])
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            except OSError as e:
+                logger.error(f"inotify reader stopped: {e}")
+                self._on_change(None, True)
+                return
+            offset = 0
+            while offset + self._EVENT_HEADER.size <= len(data):
+                wd, mask, _cookie, name_len = self._EVENT_HEADER.unpack_from(data, offset)
+                offset += self._EVENT_HEADER.size
+                name = os.fsdecode(data[offset : offset + name_len].split(b"\0", 1)[0])
+                offset += name_len
+                self._handle_event(wd, mask, name)
+
+    def _handle_event(self, wd: int, mask: int, name: str):
+        if mask & self.IN_Q_OVERFLOW:
+            self._on_change(None, True)
+            return
+        with self._lock:
+            dir_path = self._path_by_wd.get(wd)
+            if dir_path is not None and mask & (self.IN_IGNORED | self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                # The kernel dropped the watch (or is about to); a fresh listing will add a new one
+                self._path_by_wd.pop(wd, None)
+                if self._wd_by_path.get(dir_path) == wd:
+                    del self._wd_by_path[dir_path]
+        if dir_path is None:
+            return
+        if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+            self._on_change(dir_path, True)
+            return
+        self._on_change(dir_path, False)
+        if name and mask & self.IN_ISDIR and mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+            self._on_change(os.path.join(dir_path, name), True)
+
+
+class _Listing(NamedTuple):
+    entries: List[ListedEntry]
+    mtime_ns: int
+    listed_at_ns: int
+    watched: bool
+
+
+class DirectoryListingCache:
+    """Sorted directory listings kept in memory, bounded by the total number of entries (LRU).
+
+    A listing is reused while nothing invalidated it: directories watched with inotify are served without
+    any syscall until the watcher reports a change; elsewhere (other platforms, watch limit reached) the
+    directory's mtime is compared with the one seen at listing time.
+    """
+
+    def __init__(self, max_entries: int = 200_000, use_inotify: bool = True):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._listings: "OrderedDict[str, _Listing]" = OrderedDict()
+        self._total_entries = 0
+        self._generations: Dict[str, int] = {}  # Changes reported per directory, so a scan can tell it missed one
+        self._epoch = 0  # Changes reported for whole subtrees (or everything)
+        self._lock = threading.Lock()
+        self._watcher = InotifyWatcher.create(self._on_change) if use_inotify else None
+
+    def _on_change(self, dir_path: Optional[str], subtree: bool):
+        if dir_path is None:
+            self.invalidate_all()
+        else:
+            self.invalidate(dir_path, subtree=subtree)
+
+    def _drop(self, dir_path: str, unwatch: bool):
+        # Called with self._lock held
+        listing = self._listings.pop(dir_path, None)
+        if listing is not None:
+            self._total_entries -= len(listing.entries)
+        if unwatch and self._watcher is not None:
+            self._watcher.unwatch(dir_path)
+            self._generations.pop(dir_path, None)
+
+    def _generation(self, dir_path: str) -> Tuple[int, int]:
+        # Called with self._lock held
+        return self._epoch, self._generations.get(dir_path, 0)
+
+    def invalidate(self, dir_path: str, subtree: bool = False):
+        with self._lock:
+            self._generations[dir_path] = self._generations.get(dir_path, 0) + 1
+            self._drop(dir_path, unwatch=False)
+            if subtree:
+                self._epoch += 1
+                prefix = dir_path.rstrip(os.sep) + os.sep
+                for cached_path in [p for p in self._listings if p.startswith(prefix)]:
+                    self._drop(cached_path, unwatch=False)
+
+    def invalidate_all(self):
+        with self._lock:
+            self._epoch += 1
+            self._listings.clear()
+            self._total_entries = 0
+
+    def _is_fresh(self, dir_path: str, listing: _Listing) -> bool:
+        if listing.watched and self._watcher is not None and self._watcher.is_watched(dir_path):
+            return True
+        if listing.mtime_ns >= listing.listed_at_ns - RACY_MTIME_WINDOW_NS:
+            return False  # Changed too recently for its mtime to prove anything
+        try:
+            return os.stat(dir_path).st_mtime_ns == listing.mtime_ns
+        except OSError:
+            return False
+
+    def list(self, dir_path: str) -> List[ListedEntry]:
+        """Sorted entries of dir_path (directories first), from memory when still valid. Raises OSError."""
+        with self._lock:
+            listing = self._listings.get(dir_path)
+        if listing is not None and self._is_fresh(dir_path, listing):
+            with self._lock:
+                if dir_path in self._listings:
+                    self._listings.move_to_end(dir_path)
+                self.hits += 1
+            return listing.entries
+
+        # Watch before listing, so a change made while scanning is not missed
+        with self._lock:
+            generation = self._generation(dir_path)
+        watched = self._watcher.watch(dir_path) if self._watcher is not None else False
+        listed_at_ns = time.time_ns()
+        mtime_ns = os.stat(dir_path).st_mtime_ns
+        entries = snapshot_directory(dir_path)
+
+        with self._lock:
+            if self._generation(dir_path) != generation:
+                # Reported while scanning, maybe before the scan got there: the watch can no longer vouch for
+                # this listing, its mtime must
+                watched = False
+            self.misses += 1
+            self._drop(dir_path, unwatch=False)
+            self._listings[dir_path] = _Listing(entries, mtime_ns, listed_at_ns, watched)
+            self._total_entries += len(entries)
+            while self._total_entries > self.max_entries and len(self._listings) > 1:
+                oldest_path = next(iter(self._listings))
+                self._drop(oldest_path, unwatch=True)
+        return entries
+
+
+class ListingPage(NamedTuple):
+    """One page of a sorted directory listing, as /api/tree sends it."""
+
+    entries: List[ListedEntry]
+    total: int  # Entries in the directory
+    matched: int  # ... whose names contain the filter (all of them without one)
+    start: int  # Position of the page's first entry among the matched ones
+    cursor: Optional[str]  # Where the next page starts (see entry_cursor); None on the last page
+
+
+def entry_cursor(entry: ListedEntry) -> str:
+    """The cursor of the page after `entry`: its type and name, which still place it once it is gone."""
+    return ("d:" if entry.is_dir else "f:") + entry.name
+
+
+def _cursor_position(entries: List[ListedEntry], cursor: str) -> int:
+    kind, _, name = cursor.partition(":")
+    for i, entry in enumerate(entries):
+        if entry.name == name:
+            return i + 1
+    # Removed since the last page: the page goes on where it would sort
+    key = (kind != "d", name.lower())
+    return next((i for i, entry in enumerate(entries) if (not entry.is_dir, entry.name.lower()) > key), len(entries))
+
+
+def page_listing(
+    entries: List[ListedEntry],
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    name_filter: str = "",
+    until: Optional[str] = None,
+) -> ListingPage:
+    """At most `limit` (None: all) of the entries after `cursor` whose names contain `name_filter` (ignoring
+    case), or more to reach the entry named `until` when it comes later. Costs no syscall."""
+    total = len(entries)
+    if name_filter:
+        needle = name_filter.lower()
+        entries = [entry for entry in entries if needle in entry.name.lower()]
+    start = _cursor_position(entries, cursor) if cursor else 0
+    end = len(entries) if limit is None else min(start + limit, len(entries))
+    if until is not None:
+        end = next((i + 1 for i in range(end, len(entries)) if entries[i].name == until), end)
+    page = entries[start:end]
+    return ListingPage(page, total, len(entries), start, entry_cursor(page[-1]) if page and end < len(entries) else None)
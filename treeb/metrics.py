@@ -0,0 +1,208 @@
+# treeb/treeb/metrics.py
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the request duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+COUNTER_HELP = {
+    "entries_checked": "Items checked against the exclusion rules while walking a selection (debug and profile requests)",
+    "excluded": "Items left out by the exclusion rules or ignore files (debug and profile requests)",
+    "files": "Files in the output",
+    "files_skipped": "Files shown as skipped (binary, minified or over a size limit) instead of read",
+    "files_read": "Files whose content was read",
+    "bytes_read": "Bytes of the files read",
+    "tokens": "Output tokens (reference encoding)",
+    "directories_listed": "Directories listed for the tree",
+    "entries_listed": "Entries of the directories listed for the tree",
+    "result_cache_hits": "Flattens answered with a stored output (nothing had changed)",
+}
+
+
+class RequestTrace:
+    """Time per stage and counters of one request, reported by MetricsRegistry and, on request, in the response.
+
+    Stages may nest (exclusion checks happen during the walk), so their times do not add up to the total.
+    Only `detailed` traces (of debug and profile requests) time and count each exclusion check.
+    """
+
+    def __init__(self, endpoint: str, detailed: bool = False):
+        self.endpoint = endpoint
+        self.detailed = detailed
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}  # Seconds
+        self.counters: Dict[str, int] = {}
+        self.profile_path: Optional[str] = None
+
+    def add_time(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def span(self, stage: str) -> "Span":
+        return Span(self, stage)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def breakdown(self) -> dict:
+        result = {
+            "total_ms": round(self.elapsed() * 1000, 2),
+            "stages_ms": {stage: round(seconds * 1000, 2) for stage, seconds in self.stages.items()},
+            "counters": dict(self.counters),
+        }
+        if self.profile_path is not None:
+            result["profile"] = self.profile_path
+        return result
+
+    def server_timing(self) -> str:
+        """The stages and total as a Server-Timing header value (shown by browser dev tools)."""
+        parts = [f"{stage.replace('.', '-')};dur={seconds * 1000:.2f}" for stage, seconds in self.stages.items()]
+        parts.append(f"total;dur={self.elapsed() * 1000:.2f}")
+        return ", ".join(parts)
+
+
+class Span:
+    """Times a with-block into a trace's stage. A class rather than a generator-based context manager: spans
+    wrap every file of a flatten, so entering one has to be cheap."""
+
+    __slots__ = ("trace", "stage", "started")
+
+    def __init__(self, trace: RequestTrace, stage: str):
+        self.trace = trace
+        self.stage = stage
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> bool:
+        self.trace.add_time(self.stage, time.perf_counter() - self.started)
+        return False
+
+
+class NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info) -> bool:
+        return False
+
+
+NO_SPAN = NoSpan()
+
+_current_trace: ContextVar[Optional[RequestTrace]] = ContextVar("treeb_trace", default=None)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def tracing(trace: RequestTrace) -> Iterator[RequestTrace]:
+    """Make `trace` the one span() and count() record into, in this thread, for the duration of the block."""
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+def span(stage: str):
+    """A context manager timing its block into the current request's trace; nothing is measured outside a
+    traced request."""
+    trace = _current_trace.get()
+    return NO_SPAN if trace is None else Span(trace, stage)
+
+
+def count(name: str, n: int = 1):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.count(name, n)
+
+
+def traced_check(check: Callable[..., Optional[dict]], stage: str = "exclusions") -> Callable[..., Optional[dict]]:
+    """`check` (an exclusion check) timed into the current trace as `stage`, counting the items checked and
+    excluded; `check` itself unless the request's trace is detailed, as that costs two clock reads and two
+    counter updates per item walked. Worker threads do not see the trace, so call it in the request's thread."""
+    trace = _current_trace.get()
+    if trace is None or not trace.detailed:
+        return check
+    clock = time.perf_counter
+
+    def timed(*args) -> Optional[dict]:
+        started = clock()
+        info = check(*args)
+        trace.add_time(stage, clock() - started)
+        trace.counters["entries_checked"] = trace.counters.get("entries_checked", 0) + 1
+        if info:
+            trace.counters["excluded"] = trace.counters.get("excluded", 0) + 1
+        return info
+
+    return timed
+
+
+class MetricsRegistry:
+    """Aggregates of finished request traces, rendered in the Prometheus text format."""
+
+    def __init__(self, buckets: Tuple[float, ...] = DURATION_BUCKETS, prefix: str = "treeb"):
+        self.buckets = buckets
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._requests: Dict[str, List] = {}  # endpoint -> [count, sum of seconds, per-bucket counts]
+        self._stage_seconds: Dict[Tuple[str, str], float] = {}
+        self._counters: Dict[Tuple[str, str], int] = {}
+
+    def record(self, trace: RequestTrace):
+        seconds = trace.elapsed()
+        with self._lock:
+            entry = self._requests.setdefault(trace.endpoint, [0, 0.0, [0] * len(self.buckets)])
+            entry[0] += 1
+            entry[1] += seconds
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    entry[2][index] += 1
+            for stage, stage_seconds in trace.stages.items():
+                key = (trace.endpoint, stage)
+                self._stage_seconds[key] = self._stage_seconds.get(key, 0.0) + stage_seconds
+            for name, value in trace.counters.items():
+                key = (trace.endpoint, name)
+                self._counters[key] = self._counters.get(key, 0) + value
+
+    def render(self) -> str:
+        p = self.prefix
+        with self._lock:
+            requests = {endpoint: (n, total, list(buckets)) for endpoint, (n, total, buckets) in self._requests.items()}
+            stage_seconds = dict(self._stage_seconds)
+            counters = dict(self._counters)
+        lines = [
+            f"# HELP {p}_request_duration_seconds Time to produce a response (for streams, until the last record)",
+            f"# TYPE {p}_request_duration_seconds histogram",
+        ]
+        for endpoint, (n, total, buckets) in sorted(requests.items()):
+            for bound, bucket_count in zip(self.buckets, buckets):
+                lines.append(f'{p}_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {bucket_count}')
+            lines.append(f'{p}_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {n}')
+            lines.append(f'{p}_request_duration_seconds_sum{{endpoint="{endpoint}"}} {total:.6f}')
+            lines.append(f'{p}_request_duration_seconds_count{{endpoint="{endpoint}"}} {n}')
+        lines.append(f"# HELP {p}_stage_seconds_total Time spent per request stage (stages may nest)")
+        lines.append(f"# TYPE {p}_stage_seconds_total counter")
+        for (endpoint, stage), seconds in sorted(stage_seconds.items()):
+            lines.append(f'{p}_stage_seconds_total{{endpoint="{endpoint}",stage="{stage}"}} {seconds:.6f}')
+        for name in sorted({name for _, name in counters}):
+            lines.append(f"# HELP {p}_{name}_total {COUNTER_HELP.get(name, name.replace('_', ' ').capitalize())}")
+            lines.append(f"# TYPE {p}_{name}_total counter")
+            for (endpoint, counter_name), value in sorted(counters.items()):
+                if counter_name == name:
+                    lines.append(f'{p}_{name}_total{{endpoint="{endpoint}"}} {value}')
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,160 @@
+# treeb/treeb/packing.py
+
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+# How each selected file ends up in budgeted output
+FULL = "full"
+TRUNCATED = "truncated"
+TREE_ONLY = "tree_only"
+
+# Order in which files get a share of the budget. Weights (higher first) always come before the policy.
+PRIORITY_POLICIES = ("smallest", "shallowest", "order")
+DEFAULT_PRIORITY_POLICY = "smallest"
+
+# Below this many tokens, a truncated file would show too little to be worth it
+MIN_TRUNCATED_TOKENS = 200
+
+TRUNCATION_MARKER = "[... truncated to fit the token budget: {shown} of {total} lines shown]"
+BUDGET_NOTE = "[Token budget {budget}: {truncated} file(s) truncated, {tree_only} file(s) listed in the tree only]\n"
+
+
+class PackCandidate(NamedTuple):
+    path: str  # As displayed in the output
+    tokens: int  # Cost of including the file in full: path line plus block
+    path_tokens: int  # Cost of the path line alone
+    depth: int  # Directory levels below the selected item it came from (0 = selected itself)
+    weight: float  # User weight, higher is packed first (default 0)
+
+
+class PackedFile(NamedTuple):
+    path: str
+    mode: str  # FULL, TRUNCATED or TREE_ONLY
+    tokens: int  # Cost in full
+    path_tokens: int
+    allowance: int  # Tokens reserved for the file in the output (path line included); 0 when tree only
+
+
+class PackingDecision(NamedTuple):
+    budget: int
+    policy: str
+    fixed_tokens: int  # Tree header and, when files had to be cut, the budget note
+    files: List[PackedFile]  # Same order as the candidates (output order)
+
+    @property
+    def planned_tokens(self) -> int:
+        return self.fixed_tokens + sum(f.allowance for f in self.files)
+
+    def count(self, mode: str) -> int:
+        return sum(1 for f in self.files if f.mode == mode)
+
+    def note(self) -> str:
+        """Line appended to the output when some files were not included in full, else ""."""
+        truncated, tree_only = self.count(TRUNCATED), self.count(TREE_ONLY)
+        if not truncated and not tree_only:
+            return ""
+        return BUDGET_NOTE.format(budget=self.budget, truncated=truncated, tree_only=tree_only)
+
+    def to_json(self) -> dict:
+        return {
+            "budget": self.budget,
+            "policy": self.policy,
+            "planned_tokens": self.planned_tokens,
+            "fits": self.planned_tokens <= self.budget,
+            "counts": {mode: self.count(mode) for mode in (FULL, TRUNCATED, TREE_ONLY)},
+            "files": [
+                {"path": f.path, "mode": f.mode, "tokens": f.tokens, "allowance": f.allowance} for f in self.files
+            ],
+        }
+
+
+def _priority_key(policy: str, candidates: List[PackCandidate]) -> Callable[[int], tuple]:
+    if policy == "smallest":
+        return lambda i: (-candidates[i].weight, candidates[i].tokens, i)
+    if policy == "shallowest":
+        return lambda i: (-candidates[i].weight, candidates[i].depth, candidates[i].tokens, i)
+    if policy == "order":
+        return lambda i: (-candidates[i].weight, i)
+    raise ValueError(f"Unknown priority policy '{policy}' (expected one of: {', '.join(PRIORITY_POLICIES)})")
+
+
+def pack_files(
+    candidates: List[PackCandidate],
+    budget: int,
+    fixed_tokens: int,
+    note_tokens: int = 0,
+    policy: str = DEFAULT_PRIORITY_POLICY,
+    min_truncated_tokens: int = MIN_TRUNCATED_TOKENS,
+) -> PackingDecision:
+    """Decide which files go in full, truncated or tree-only so the output stays within budget.
+
+    Works on token counts alone. Files are taken in priority order and included in full while they fit
+    (a file that does not fit is skipped, so smaller lower-priority files can still get in); whatever is
+    left then goes to the highest-priority skipped file as a truncated excerpt, if it is large enough.
+    note_tokens is only reserved when not everything fits.
+    """
+    by_priority = sorted(range(len(candidates)), key=_priority_key(policy, candidates))
+    if fixed_tokens + sum(c.tokens for c in candidates) <= budget:
+        files = [PackedFile(c.path, FULL, c.tokens, c.path_tokens, c.tokens) for c in candidates]
+        return PackingDecision(budget=budget, policy=policy, fixed_tokens=fixed_tokens, files=files)
+
+    fixed_tokens += note_tokens
+    modes = [TREE_ONLY] * len(candidates)
+    allowances = [0] * len(candidates)
+    remaining = budget - fixed_tokens
+
+    for i in by_priority:
+        if candidates[i].tokens <= remaining:
+            modes[i] = FULL
+            allowances[i] = candidates[i].tokens
+            remaining -= candidates[i].tokens
+    for i in by_priority:
+        if modes[i] == TREE_ONLY and remaining - candidates[i].path_tokens >= min_truncated_tokens:
+            modes[i] = TRUNCATED
+            allowances[i] = remaining
+            remaining = 0
+
+    files = [
+        PackedFile(c.path, mode, c.tokens, c.path_tokens, allowance)
+        for c, mode, allowance in zip(candidates, modes, allowances)
+    ]
+    return PackingDecision(budget=budget, policy=policy, fixed_tokens=fixed_tokens, files=files)
+
+
+def truncate_block_body(encoding, content: str, max_tokens: int, render: Callable[[str], str]) -> Tuple[str, int]:
+    """render() of the longest whole-line prefix of content (plus a marker) that stays within max_tokens.
+
+    content is encoded once; the candidate excerpt is cut from its tokens and re-encoded only to confirm
+    the fit (tokens can merge differently at the cut). Returns (block body, its token count).
+    """
+    total_lines = content.count("\n") + 1
+    tokens = encoding.encode_ordinary(content)
+    overhead = len(encoding.encode_ordinary(render(TRUNCATION_MARKER.format(shown=total_lines, total=total_lines))))
+    keep = max_tokens - overhead
+    for _ in range(4):
+        if keep <= 0:
+            break
+        excerpt = encoding.decode(tokens[:keep])
+        cut = excerpt.rfind("\n")
+        if cut > 0:
+            excerpt = excerpt[:cut]  # Whole lines only, unless the first line alone is too long
+        shown = excerpt.count("\n") + 1
+        body = render(excerpt + "\n" + TRUNCATION_MARKER.format(shown=shown, total=total_lines))
+        body_tokens = len(encoding.encode_ordinary(body))
+        if body_tokens <= max_tokens:
+            return body, body_tokens
+        keep -= body_tokens - max_tokens
+    body = render(TRUNCATION_MARKER.format(shown=0, total=total_lines))
+    return body, len(encoding.encode_ordinary(body))
+
+
+def selection_depth(path: str, selected: List[str], sep: str) -> int:
+    """Directory levels between path and the deepest selected item containing it (0 if none does)."""
+    best: Optional[int] = None
+    for root in selected:
+        if path == root:
+            return 0
+        prefix = root.rstrip(sep) + sep
+        if path.startswith(prefix):
+            depth = path[len(prefix) :].count(sep)
+            best = depth if best is None else min(best, depth)
+    return best or 0
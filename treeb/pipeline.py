@@ -0,0 +1,211 @@
+# treeb/treeb/pipeline.py
+
+import itertools
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+from treeb.tokencache import FileKey, TokenCountCache
+from treeb.tokenizers import TokenCounts
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class Cancelled(Exception):
+    """Raised when work given a cancel event notices it was set."""
+
+
+def raise_if_cancelled(cancel: Optional[threading.Event]):
+    if cancel is not None and cancel.is_set():
+        raise Cancelled()
+
+
+def map_ordered(func: Callable[[T], R], items: Iterable[T], workers: int, read_ahead: Optional[int] = None) -> Iterator[R]:
+    """Yield func(item) for each item, in input order, computing up to `read_ahead` results ahead on a thread pool.
+
+    With workers <= 1 this is a plain loop. The read-ahead bound (default: 2 per worker) caps how many results
+    are held in memory at once, however fast the pool is compared to the consumer.
+    """
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    read_ahead = max(read_ahead or workers * 2, 1)
+    iterator = iter(items)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="treeb-read") as pool:
+        window: Deque[Future] = deque(pool.submit(func, item) for item in itertools.islice(iterator, read_ahead))
+        try:
+            while window:
+                future = window.popleft()
+                for item in itertools.islice(iterator, 1):
+                    window.append(pool.submit(func, item))
+                yield future.result()
+        finally:
+            for future in window:  # Consumer stopped early or a read raised: drop what is still queued
+                future.cancel()
+
+
+class SegmentTokenCounter:
+    """Token count of a text added as consecutive segments, re-encoding only segments the cache cannot answer.
+
+    Each segment must start where the encoding's pre-tokenizer splits anyway, so that the per-segment counts
+    add up to the count of the joined text. Flatten output satisfies this by cutting right after the
+    closing quotes and blank line of each file block, and right before the opening quotes. Segments added
+    with a file key are looked up in and added to the cache. A large file's block may be added as several
+    consecutive parts with the same key, all but the last with final=False: the cache is asked at the first
+    part (a hit skips the rest) and given the sum of the parts.
+
+    Misses are tokenized in batches (up to batch_size segments or max_batch_chars characters) on worker
+    threads; tiktoken releases the GIL while encoding, so batches run in parallel with each other and with
+    file reading. At most two batches per worker are in flight: add() waits for the oldest one beyond that,
+    which bounds the text held for tokenizing. With workers <= 0 every batch is encoded inline.
+    add() never raises: the first tokenization error is kept and raised by total().
+    """
+
+    def __init__(
+        self,
+        encoding,
+        cache: Optional[TokenCountCache] = None,
+        workers: int = 0,
+        batch_size: int = 64,
+        max_batch_chars: int = 4 * 1024 * 1024,
+    ):
+        self.encoding = encoding
+        self.cache = cache
+        self.batch_size = max(batch_size, 1)
+        self.max_batch_chars = max(max_batch_chars, 1)
+        self._max_in_flight = max(workers, 1) * 2
+        self._total = 0
+        self._error: Optional[Exception] = None
+        self._batch: List[Tuple[str, Optional[FileKey], bool]] = []
+        self._batch_chars = 0
+        self._pending: Deque[Tuple[List[Tuple[Optional[FileKey], bool]], Future]] = deque()
+        self._parts_key: Optional[FileKey] = None  # Key of the file being added in parts
+        self._parts_cached = False  # ... whose count came from the cache
+        self._counted_parts: Tuple[Optional[FileKey], int] = (None, 0)  # Tokens of the parts recorded so far
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="treeb-tokenize") if workers > 0 else None
+
+    def _count_texts(self, texts: List[str]) -> List[int]:
+        return [len(self.encoding.encode_ordinary(text)) for text in texts]
+
+    def _record(self, keys: List[Tuple[Optional[FileKey], bool]], counts: List[int]):
+        # Batches are recorded in the order they were added, so the parts of a file arrive in order
+        for (key, final), count in zip(keys, counts):
+            self._total += count
+            if key is None or self.cache is None:
+                continue
+            parts_key, parts_tokens = self._counted_parts
+            earlier = parts_tokens if parts_key == key else 0
+            if final:
+                self.cache.put(key, self.encoding.name, earlier + count)
+                self._counted_parts = (None, 0)
+            else:
+                self._counted_parts = (key, earlier + count)
+
+    def _submit_batch(self):
+        if not self._batch:
+            return
+        texts = [text for text, _, _ in self._batch]
+        keys = [(key, final) for _, key, final in self._batch]
+        self._batch = []
+        self._batch_chars = 0
+        if self._pool is None:
+            self._record(keys, self._count_texts(texts))
+            return
+        self._pending.append((keys, self._pool.submit(self._count_texts, texts)))
+        # Collect finished batches, and block on the oldest while too many are outstanding
+        while self._pending and (self._pending[0][1].done() or len(self._pending) > self._max_in_flight):
+            done_keys, future = self._pending.popleft()
+            self._record(done_keys, future.result())
+
+    def add(self, text: str, key: Optional[FileKey] = None, final: bool = True):
+        if self._error is not None:
+            return
+        try:
+            if key is not None and key == self._parts_key:  # A later part of a file added in parts
+                if final:
+                    self._parts_key = None
+                if self._parts_cached:
+                    return
+            else:
+                self._parts_key = None if final else key
+                self._parts_cached = False
+                if key is not None and self.cache is not None:
+                    cached = self.cache.get(key, self.encoding.name)
+                    if cached is not None:
+                        self._total += cached
+                        self._parts_cached = True
+                        return
+            self._batch.append((text, key, final))
+            self._batch_chars += len(text)
+            if len(self._batch) >= self.batch_size or self._batch_chars >= self.max_batch_chars:
+                self._submit_batch()
+        except Exception as e:
+            self._error = e
+            self.close()
+
+    def counted(self) -> int:
+        """Tokens counted so far: cache hits and finished batches, not what is still being tokenized."""
+        return self._total
+
+    def total(self) -> int:
+        """Wait for outstanding batches and return the token count of everything added (flushes the cache)."""
+        try:
+            if self._error is not None:
+                raise self._error
+            self._submit_batch()
+            while self._pending:
+                keys, future = self._pending.popleft()
+                self._record(keys, future.result())
+            return self._total
+        finally:
+            self.close()
+            if self.cache is not None:
+                self.cache.flush()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+class MultiEncodingCounter:
+    """The same segments counted with several encodings, one SegmentTokenCounter each.
+
+    Every counter tokenizes on its own workers, so the encodings are counted concurrently, and each looks up
+    and stores the file blocks under its own encoding in the shared token cache. Characters are counted too,
+    for estimates of models without a counted encoding.
+    """
+
+    def __init__(self, counters: Dict[str, SegmentTokenCounter]):
+        self.counters = counters
+        self.chars = 0
+
+    def add(self, text: str, key: Optional[FileKey] = None, final: bool = True):
+        self.chars += len(text)
+        for counter in self.counters.values():
+            counter.add(text, key, final)
+
+    def counted(self) -> Dict[str, int]:
+        return {name: counter.counted() for name, counter in self.counters.items()}
+
+    def counts(self) -> TokenCounts:
+        """Wait for all counters; an encoding whose tokenization failed gets -1."""
+        by_encoding = {}
+        for name, counter in self.counters.items():
+            try:
+                by_encoding[name] = counter.total()
+            except Exception as e:
+                logger.error(f"Error tokenizing with {name}: {e}")
+                by_encoding[name] = -1
+        return TokenCounts(by_encoding, self.chars)
+
+    def close(self):
+        for counter in self.counters.values():
+            counter.close()
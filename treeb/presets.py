@@ -0,0 +1,204 @@
+# treeb/treeb/presets.py
+
+import json
+import logging
+import os
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+
+from treeb.selection import Selection, normalize_selection
+
+logger = logging.getLogger(__name__)
+
+# The checkout treeb runs from (app.py, presets/, static/); relative preset paths are relative to it
+APP_ROOT = Path(__file__).resolve().parent.parent
+
+# --- Preset Directory Configuration ---
+PRESET_BASE_DIR = APP_ROOT / "presets"
+
+SELECTION_PRESET_BASE_DIR = PRESET_BASE_DIR / "selections"
+DEFAULT_SELECTION_PRESETS_DIR = SELECTION_PRESET_BASE_DIR / "default"
+USER_SELECTION_PRESETS_DIR = PRESET_BASE_DIR / "user"  # Corrected from PRESET_BASE_DIR to USER_SELECTION_PRESETS_DIR
+
+EXCLUSION_PRESET_BASE_DIR = PRESET_BASE_DIR / "exclusions"
+DEFAULT_EXCLUSION_PRESETS_DIR = EXCLUSION_PRESET_BASE_DIR / "default"
+SYSTEM_DEFAULTS_FILE = DEFAULT_EXCLUSION_PRESETS_DIR / "system_defaults.json"
+
+# Per-file token counts survive restarts here, so flattening only re-tokenizes files that changed
+TOKEN_CACHE_DB_PATH = PRESET_BASE_DIR / "cache" / "token_counts.sqlite3"
+# Manifests of recent flattens (and the texts they sent), for flattening only what changed since one of them
+SNAPSHOTS_DIR = PRESET_BASE_DIR / "cache" / "snapshots"
+# Outputs of recent flattens by selection, served again (or partly rebuilt) while the files have not changed
+RESULT_CACHE_DIR = PRESET_BASE_DIR / "cache" / "results"
+
+
+# --- Default Exclusion Data (Master Definition for system_defaults.json) ---
+class DefaultExclusionData:
+    DIRS = [
+        # General
+        ".git",
+        ".venv",
+        "venv",
+        ".env",
+        "env",
+        "node_modules",
+        ".next",
+        "__pycache__",
+        ".pytest_cache",
+        ".mypy_cache",
+        "build",
+        "dist",
+        "target",
+        "out",
+        "site",
+        ".vscode",
+        ".idea",
+        # CI/CD & Docs
+        ".gitlab-ci-local",   # NEW
+        "_docs",              # NEW
+        # Flutter
+        ".dart_tool",
+        "Pods",
+        ".gradle",
+        "DerivedData",
+        ".pub-cache",
+        ".pub",
+        ".generated",
+        "bin",
+        "gen",
+        "proguard",
+        "captures",
+        ".navigation",
+        ".externalNativeBuild",
+        "freeline",
+        "cmake-build-debug",
+        "cmake-build-release",
+        "doc/api",
+        # Svelte (4 and 5)
+        ".svelte-kit",        # already existed, left for clarity
+        "bower_components",
+        ".grunt",
+        ".nuxt",
+        ".vuepress",
+        ".docusaurus",
+        ".serverless",
+        ".vitepress",
+        ".temp",
+        "coverage",
+    ]
+    FILES = [
+        # unchanged ...
+    ]
+    PATTERNS = [
+        # unchanged ...
+    ]
+
+
+def default_exclusion_rules() -> dict:
+    """The built-in exclusion rules, in the format of system_defaults.json."""
+    return {
+        "description": "System default exclusions (source: app.py DefaultExclusionData). Applied at startup.",
+        "dirs": list(DefaultExclusionData.DIRS),
+        "files": list(DefaultExclusionData.FILES),
+        "patterns": list(DefaultExclusionData.PATTERNS),
+    }
+
+
+def read_exclusion_rules(rules_file: Path) -> Optional[dict]:
+    """Exclusion rules from a JSON file with "description", "dirs", "files" and "patterns", or None if missing/invalid."""
+    if not rules_file.exists():
+        return None
+    try:
+        with open(rules_file, "r", encoding="utf-8") as f:
+            loaded_rules = json.load(f)
+    except Exception as e:
+        logger.error(f"Error loading {rules_file}: {e}.")
+        return None
+    if all(key in loaded_rules for key in ["description", "dirs", "files", "patterns"]) and isinstance(
+        loaded_rules["dirs"], list
+    ) and isinstance(loaded_rules["files"], list) and isinstance(loaded_rules["patterns"], list):
+        return loaded_rules
+    logger.warning(f"File {rules_file} has invalid structure.")
+    return None
+
+
+def load_exclusion_rules() -> dict:
+    """The active exclusion rules: system_defaults.json if it is valid, else the built-in defaults. Never writes."""
+    return read_exclusion_rules(SYSTEM_DEFAULTS_FILE) or default_exclusion_rules()
+
+
+def get_selection_preset_path(name: str, preset_type: str) -> Optional[Path]:
+    """Return the JSON preset file path for a given name/type, or None if invalid."""
+    safe_name = "".join(c for c in name if c.isalnum() or c in "-_").strip()
+    if not safe_name:
+        return None
+
+    if preset_type == "default":
+        base_dir = DEFAULT_SELECTION_PRESETS_DIR
+    elif preset_type == "user":
+        base_dir = USER_SELECTION_PRESETS_DIR
+    else:
+        return None
+
+    return base_dir / f"{safe_name}.json"
+
+
+def find_selection_preset(preset_id: str) -> Optional[Path]:
+    """Existing preset file for "user/<name>", "default/<name>" or a bare name (user presets first)."""
+    if "/" in preset_id:
+        preset_type, name = preset_id.split("/", 1)
+        candidates = [get_selection_preset_path(name, preset_type)]
+    else:
+        candidates = [get_selection_preset_path(preset_id, "user"), get_selection_preset_path(preset_id, "default")]
+    return next((p for p in candidates if p is not None and p.exists()), None)
+
+
+class SelectionPreset(NamedTuple):
+    selection: Selection  # Includes absolute and resolved, excludes absolute
+    warm: bool = False  # Kept flattened in the background, so that Generate finds its output ready
+    ignore_files: bool = False  # How a warm preset is flattened (as with the ignore files option)
+
+
+def load_selection_preset(preset_file: Path) -> SelectionPreset:
+    """A selection preset: {"include": [...], "exclude": [...], "warm": ..., "ignore_files": ...} (see Selection),
+    or a plain JSON list of included paths. Relative paths are relative to APP_ROOT. Raises ValueError (or
+    OSError) if it cannot be used."""
+    data = json.loads(preset_file.read_text(encoding="utf-8"))
+    warm = ignore_files = False
+    excluded = []
+    if isinstance(data, dict):
+        warm, ignore_files = bool(data.get("warm")), bool(data.get("ignore_files"))
+        excluded = data.get("exclude", [])
+        data = data.get("include", data.get("paths"))
+    if not isinstance(data, list) or not isinstance(excluded, list):
+        raise ValueError("Invalid preset file format (expected lists of paths)")
+    resolved_absolute_paths = []
+    for path_str_in_file in data:
+        path_obj = Path(path_str_in_file)
+        # If path is relative, it's assumed to be relative to APP_ROOT
+        # If absolute, it's used as is.
+        # Presets should ideally store paths relative to APP_ROOT or be very explicit about absolute paths.
+        if not path_obj.is_absolute():
+            path_obj = (APP_ROOT / path_obj).resolve()
+        else:
+            path_obj = path_obj.resolve()  # Ensure absolute paths are also resolved (e.g. symlinks)
+        resolved_absolute_paths.append(str(path_obj))
+    # Excluded items are named as the tree shows them, below an included directory: not resolved
+    excluded_paths = [os.path.abspath(APP_ROOT / str(path_str_in_file)) for path_str_in_file in excluded]
+    return SelectionPreset(Selection(resolved_absolute_paths, excluded_paths), warm, ignore_files)
+
+
+def save_selection_preset(preset_file: Path, selection: Selection, warm: bool = False, ignore_files: bool = False):
+    """Store a selection preset, with the paths below APP_ROOT relative to it. Raises OSError."""
+    data = normalize_selection(selection).relative_to(APP_ROOT)
+    if warm:  # Warmed the way the page flattens it: with or without ignore files
+        data.update(warm=True, ignore_files=ignore_files)
+    preset_file.parent.mkdir(parents=True, exist_ok=True)
+    preset_file.write_text(json.dumps(data, indent=2), encoding="utf-8")
+
+
+def selection_preset_ids() -> List[str]:
+    """Ids ("default/<name>", then "user/<name>") of the selection presets, sorted by name within each type."""
+    return [f"default/{p.stem}" for p in sorted(DEFAULT_SELECTION_PRESETS_DIR.glob("*.json"))] + [
+        f"user/{p.stem}" for p in sorted(USER_SELECTION_PRESETS_DIR.glob("*.json"))
+    ]
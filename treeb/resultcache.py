@@ -0,0 +1,387 @@
+# treeb/treeb/resultcache.py
+
+import hashlib
+import json
+import logging
+import os
+import stat
+import threading
+import time
+import uuid
+import zlib
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from treeb.classify import SkippedFile, classify_file, limit_total, total_limit_skip
+from treeb.flatten import (
+    BLOCK_CLOSING,
+    BLOCK_OPENING,
+    Flattener,
+    FlattenPlan,
+    Segment,
+    plan_flatten,
+)
+from treeb.ingest import MappedText
+from treeb.listing import RACY_MTIME_WINDOW_NS
+from treeb.metrics import span
+from treeb.pipeline import map_ordered, raise_if_cancelled
+from treeb.selection import Selection, normalize_selection
+from treeb.tokencache import FileKey
+from treeb.tokenizers import TokenCounts
+
+logger = logging.getLogger(__name__)
+
+RESULT_SCHEMA_VERSION = 1
+DEFAULT_MAX_CACHE_BYTES = 256 * 1024 * 1024
+
+
+class CachedFile(NamedTuple):
+    key: Optional[FileKey]  # Version the stored text holds; None if it could not be looked up
+    skip_reason: Optional[str]  # Why classify_file skips it (before the total size limit), or None
+    content: Optional[Tuple[int, int]]  # Span of its content in the stored text, when it was read
+
+
+class CachedResult(NamedTuple):
+    """A stored flatten output and what it was made of: enough to tell, with stats only, whether it is still
+    what a flatten of the same selection would produce, and which files' blocks are not."""
+
+    fingerprint: str
+    created_ns: int  # When the flatten that produced it started: later mtimes prove nothing
+    text_name: str  # File holding the text, next to the manifest
+    header_length: int  # Of plan.header, at the start of the text
+    common_ancestor: Optional[str]
+    selected: Dict[str, Optional[str]]  # Selected path -> "dir", "file", "other" or None (missing)
+    directories: Dict[str, Optional[int]]  # Directory listed by the walk -> mtime_ns (None: could not stat)
+    files: Dict[str, CachedFile]  # In output order
+    token_counts: Dict[str, int]
+    chars: int
+
+    def to_json(self) -> dict:
+        return {
+            "version": RESULT_SCHEMA_VERSION,
+            "fingerprint": self.fingerprint,
+            "created_ns": self.created_ns,
+            "text_name": self.text_name,
+            "header_length": self.header_length,
+            "common_ancestor": self.common_ancestor,
+            "selected": self.selected,
+            "directories": self.directories,
+            "files": [[path, *(f.key[1:] if f.key else (None, None)), f.skip_reason, f.content] for path, f in self.files.items()],
+            "token_counts": self.token_counts,
+            "chars": self.chars,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "CachedResult":
+        if data.get("version") != RESULT_SCHEMA_VERSION:
+            raise ValueError(f"Cached result {data.get('fingerprint')} has an unsupported version")
+        files = {}
+        for path, mtime_ns, size, skip_reason, content in data["files"]:
+            key = (path, mtime_ns, size) if mtime_ns is not None else None
+            files[path] = CachedFile(key, skip_reason, tuple(content) if content is not None else None)
+        return cls(
+            data["fingerprint"],
+            data["created_ns"],
+            data["text_name"],
+            data["header_length"],
+            data["common_ancestor"],
+            data["selected"],
+            data["directories"],
+            files,
+            data["token_counts"],
+            data["chars"],
+        )
+
+
+def path_kind(path: str) -> Optional[str]:
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        return None
+    return "dir" if stat.S_ISDIR(mode) else "file" if stat.S_ISREG(mode) else "other"
+
+
+def directory_mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def selection_fingerprint(raw_paths: List[str], flattener: Flattener, ignore_files: bool, excluded: Sequence[str] = ()) -> str:
+    """What the output of a flatten depends on besides the files themselves: the selection (however it was
+    written), the exclusion rules, ignore files and the read limits."""
+    selection = normalize_selection(Selection(raw_paths, excluded))
+    described = {
+        "version": RESULT_SCHEMA_VERSION,
+        "paths": list(selection.include),
+        "excluded": list(selection.exclude),
+        "exclusions": flattener.exclusion_rules,
+        "ignore_files": bool(ignore_files),
+        "read_limits": list(flattener.read_limits),
+    }
+    return hashlib.sha1(json.dumps(described, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Flatten outputs by selection fingerprint: a small JSON manifest and the zlib-compressed text each.
+
+    Entries are written whole and never updated in place; the least recently used are deleted once all of
+    them take more than max_bytes on disk.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int = DEFAULT_MAX_CACHE_BYTES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _manifest_path(self, fingerprint: str) -> Path:
+        return self.directory / f"{fingerprint}.json"
+
+    def load(self, fingerprint: str) -> Optional[CachedResult]:
+        path = self._manifest_path(fingerprint)
+        try:
+            entry = CachedResult.from_json(json.loads(path.read_text(encoding="utf-8")))
+            os.utime(path)  # Recently used
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Result cache: ignoring unreadable entry {fingerprint}: {e}")
+            return None
+        return entry
+
+    def read_text(self, entry: CachedResult) -> Optional[str]:
+        """The entry's text, or None if it is gone (replaced by a newer save or evicted) or unreadable."""
+        try:
+            return zlib.decompress((self.directory / entry.text_name).read_bytes()).decode("utf-8", errors="surrogatepass")
+        except (OSError, zlib.error) as e:
+            logger.warning(f"Result cache: text of {entry.fingerprint} is not available: {e}")
+            return None
+
+    def save(self, entry: CachedResult, text: str):
+        data = zlib.compress(text.encode("utf-8", errors="surrogatepass"), 1)
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            text_path = self.directory / entry.text_name
+            tmp = text_path.with_suffix(".tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, text_path)
+            path = self._manifest_path(entry.fingerprint)
+            try:
+                replaced = json.loads(path.read_text(encoding="utf-8")).get("text_name")
+            except (OSError, ValueError, AttributeError):
+                replaced = None
+            tmp = path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(entry.to_json(), separators=(",", ":")), encoding="utf-8")
+            os.replace(tmp, path)
+            if replaced and replaced != entry.text_name:
+                try:
+                    (self.directory / replaced).unlink()
+                except OSError:
+                    pass
+            self._evict()
+
+    def _evict(self):
+        # Called with self._lock held. Files are named "<fingerprint>.json" and "<fingerprint>-<id>.txt.z".
+        sizes: Dict[str, int] = {}
+        used: Dict[str, int] = {}
+        for path in self.directory.iterdir():
+            fingerprint = path.name.split("-", 1)[0].split(".", 1)[0]
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            sizes[fingerprint] = sizes.get(fingerprint, 0) + st.st_size
+            if path.suffix == ".json":
+                used[fingerprint] = st.st_mtime_ns
+        total = sum(sizes.values())
+        for fingerprint in sorted(sizes, key=lambda fingerprint: used.get(fingerprint, 0)):
+            if total <= self.max_bytes:
+                break
+            for path in self.directory.glob(f"{fingerprint}*"):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+            total -= sizes[fingerprint]
+
+
+class CachedFlatten:
+    """A full flatten of one selection that reuses what a ResultCache holds for it.
+
+    plan() walks the selection again only when a selected item or a directory the last walk listed has
+    changed (by mtime), and re-classifies only the files whose version (stat) changed. unchanged_result() is
+    the stored output when nothing did; otherwise iter_segments() reads only the changed files and takes the
+    other blocks from the stored text. Versions too close to the stored flatten to be trusted are treated as
+    changed. Call record() with each segment sent and save() at the end to store the new output.
+    """
+
+    def __init__(
+        self,
+        cache: ResultCache,
+        flattener: Flattener,
+        raw_paths: List[str],
+        ignore_files: bool = False,
+        excluded: Sequence[str] = (),
+    ):
+        self.cache = cache
+        self.flattener = flattener
+        self.raw_paths = raw_paths
+        self.ignore_files = ignore_files
+        self.excluded = excluded
+        self.started_ns = time.time_ns()
+        self.fingerprint = selection_fingerprint(raw_paths, flattener, ignore_files, excluded)
+        self.entry = cache.load(self.fingerprint)
+        self.walk_reused = False
+        self.reused: Dict[str, FileKey] = {}  # Files unchanged since the stored flatten, by path
+        self._keys: Dict[str, Optional[FileKey]] = {}  # Versions of this flatten's files, by path
+        self._reasons: Dict[str, Optional[str]] = {}
+        self._stored_text: Optional[str] = None
+        self._offset = 0  # Characters sent so far
+        self._block_start: Optional[int] = None  # Of the block being sent in parts
+        self._contents: Dict[str, Tuple[int, int]] = {}
+        self._read_keys: Dict[str, FileKey] = {}
+
+    def _trusted(self, mtime_ns: Optional[int]) -> bool:
+        return mtime_ns is not None and mtime_ns < self.entry.created_ns - RACY_MTIME_WINDOW_NS
+
+    def _walk_unchanged(self) -> bool:
+        entry = self.entry
+        if any(path_kind(path) != kind for path, kind in entry.selected.items()):
+            return False
+        paths = list(entry.directories)
+        mtimes = map_ordered(directory_mtime, paths, self.flattener.reader_workers)
+        for path, mtime_ns in zip(paths, mtimes):
+            raise_if_cancelled(self.flattener.cancel)
+            if mtime_ns != entry.directories[path] or not self._trusted(mtime_ns):
+                return False
+        return True
+
+    def _stored_plan(self) -> Optional[FlattenPlan]:
+        entry = self.entry
+        text = self.stored_text()  # The tree header is its start
+        if text is None:
+            return None
+        return FlattenPlan(
+            header=text[: entry.header_length],
+            files=[Path(path) for path in entry.files],
+            common_ancestor=Path(entry.common_ancestor) if entry.common_ancestor is not None else None,
+            empty=False,
+            selected=[Path(path) for path in entry.selected],
+            skipped={},
+            directories=list(entry.directories),
+        )
+
+    def stored_text(self) -> Optional[str]:
+        if self._stored_text is None and self.entry is not None:
+            self._stored_text = self.cache.read_text(self.entry)
+            if self._stored_text is None:
+                self.entry = None  # Its text is gone: nothing can be reused
+        return self._stored_text
+
+    def plan(self) -> FlattenPlan:
+        """Flattener.plan for the selection, from the stored walk and classifications where still valid."""
+        flattener = self.flattener
+        plan = None
+        if self.entry is not None and not self.ignore_files:
+            with span("walk"):
+                if self._walk_unchanged():
+                    plan = self._stored_plan()  # None if the stored text has gone
+                    self.walk_reused = plan is not None
+        if plan is None:
+            plan = plan_flatten(
+                self.raw_paths, flattener.exclusion_rules, self.ignore_files, None, flattener.cancel, self.excluded
+            )
+        stored = self.entry.files if self.entry is not None else {}
+        limits = flattener.read_limits
+
+        def classify(f_path: Path) -> Tuple[Optional[SkippedFile], int]:
+            path = str(f_path)
+            key = flattener.file_key(f_path)
+            self._keys[path] = key
+            recorded = stored.get(path)
+            if key is not None and recorded is not None and recorded.key == key and self._trusted(key[1]):
+                self.reused[path] = key
+                self._reasons[path] = recorded.skip_reason
+                return (SkippedFile(recorded.skip_reason, key[2]) if recorded.skip_reason else None), key[2]
+            skip, size = classify_file(f_path, limits)
+            self._reasons[path] = skip.reason if skip is not None else None
+            return skip, size
+
+        with span("classify"):
+            classified = map_ordered(classify, plan.files, flattener.reader_workers)
+            return plan._replace(skipped=limit_total(plan.files, classified, limits, flattener.cancel))
+
+    def unchanged_result(self, plan: FlattenPlan) -> Optional[Tuple[str, TokenCounts]]:
+        """The stored output and its token counts if it is still exactly what flattening `plan` produces."""
+        entry = self.entry
+        # Same walk and versions, and (by the fingerprint) the same read limits: the same skips too
+        if entry is None or not self.walk_reused or len(self.reused) != len(plan.files):
+            return None
+        if not set(self.flattener.counted_encodings()) <= set(entry.token_counts):
+            return None
+        text = self.stored_text()
+        if text is None:
+            return None
+        return text, TokenCounts(dict(entry.token_counts), entry.chars)
+
+    def open_text(self, f_path: Path, skipped: Optional[SkippedFile] = None) -> Tuple[Union[str, MappedText], Optional[FileKey]]:
+        """Flattener.open_text, but the content of an unchanged file comes from the stored text."""
+        path = str(f_path)
+        key = self.reused.get(path)
+        if key is not None and skipped is None:
+            recorded = self.entry.files[path]
+            text = self.stored_text()
+            if recorded.content is not None and text is not None:
+                raise_if_cancelled(self.flattener.cancel)
+                start, end = recorded.content
+                return text[start:end], key
+        return self.flattener.open_text(f_path, skipped)
+
+    def iter_segments(self, plan: FlattenPlan):
+        return self.flattener.iter_segments(plan, open_text=self.open_text)
+
+    def record(self, segment: Segment):
+        """Note where each file's content is in the output, as it is sent."""
+        if segment.key is not None:
+            if self._block_start is None:
+                self._block_start = self._offset
+            if segment.final:
+                end = self._offset + len(segment.text)
+                self._contents[segment.key[0]] = (self._block_start + len(BLOCK_OPENING), end - len(BLOCK_CLOSING))
+                self._read_keys[segment.key[0]] = segment.key
+                self._block_start = None
+        self._offset += len(segment.text)
+
+    def save(self, plan: FlattenPlan, text: str, counts: TokenCounts):
+        """Store the output of this flatten (nothing is stored if a count failed or the selection is empty)."""
+        if plan.empty or -1 in counts.by_encoding.values():
+            return
+        limits = self.flattener.read_limits
+        over_total = total_limit_skip(0, limits).reason if limits.max_total_bytes is not None else None
+        files = {}
+        for f_path in plan.files:
+            path = str(f_path)
+            reason = self._reasons.get(path)
+            if reason == over_total:
+                reason = None
+            key = self._read_keys.get(path, self._keys.get(path))
+            files[path] = CachedFile(key, reason, self._contents.get(path) if path not in plan.skipped else None)
+        entry = CachedResult(
+            fingerprint=self.fingerprint,
+            created_ns=self.started_ns,
+            text_name=f"{self.fingerprint}-{uuid.uuid4().hex[:8]}.txt.z",
+            header_length=len(plan.header),
+            common_ancestor=str(plan.common_ancestor) if plan.common_ancestor is not None else None,
+            selected={str(path): path_kind(str(path)) for path in plan.selected},
+            directories={path: directory_mtime(path) for path in plan.directories},
+            files=files,
+            token_counts=dict(counts.by_encoding),
+            chars=counts.chars,
+        )
+        try:
+            self.cache.save(entry, text)
+        except OSError as e:
+            logger.error(f"Result cache: could not store {self.fingerprint}: {e}")
@@ -0,0 +1,633 @@
+# treeb/treeb/search.py
+
+import logging
+import os
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from treeb.classify import ReadLimits, SNIFF_BYTES, sniff_content
+from treeb.exclusions import ExclusionMatcher
+from treeb.gitsource import GitRevision
+from treeb.listing import ListedEntry
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_RESULTS = 50
+# Working-tree indexes re-list their directories at most this often, when searched (revisions never change)
+DEFAULT_REFRESH_SECONDS = 2.0
+# Content changes do not show in directory listings: indexed files are re-stat'ed at most this often
+DEFAULT_CONTENT_REFRESH_SECONDS = 30.0
+DEFAULT_CONTENT_LIMITS = ReadLimits(max_file_bytes=1024 * 1024, max_total_bytes=256 * 1024 * 1024)
+DEFAULT_MAX_INDEXES = 4
+# Paths matching a query beyond this many (per tier, see SearchIndex.search) are not scored: very short queries
+# match nearly everything
+MAX_SCORED_CANDIDATES = 2000
+MIN_CONTENT_QUERY = 3  # Content search needs at least one trigram
+SNIPPET_CHARS = 120
+
+# Characters after which a query character counts as the start of a word
+WORD_BOUNDARIES = frozenset("/\\_-. ")
+
+Lister = Callable[[str], List[ListedEntry]]
+
+
+class SearchHit(NamedTuple):
+    path: str  # Relative to the index root, with os.sep
+    node_id: str  # The tree's node id: the absolute path, or the target of a symlink
+    is_dir: bool
+    score: float
+    line: Optional[int] = None  # Content matches: first matching line (1-based) and its text
+    snippet: Optional[str] = None
+
+
+class SearchResult(NamedTuple):
+    hits: List[SearchHit]
+    complete: bool  # False while the first build is still running: hits cover what is indexed so far
+    truncated: bool  # More paths matched than were scored or returned
+
+
+class _Directory(NamedTuple):
+    entries: List[ListedEntry]  # The listing this state was built from (compared by identity)
+    children: Dict[str, bool]  # Indexed entry names -> followed into (a real directory, not a symlink)
+
+
+def fuzzy_score(query: str, path: str, name_start: int) -> Optional[float]:
+    """How well `query` matches `path` (both lowercase), or None if its characters do not appear in order.
+
+    Substrings of the file name score highest, then substrings of the path, then scattered characters (each
+    tier above the next), with bonuses for characters starting a word or following the previous match;
+    shorter paths win ties.
+    """
+    name = path[name_start:]
+    position = name.find(query)
+    if position != -1:
+        score = 1000.0 + (50 if position == 0 else 0) + (25 if len(name) == len(query) else 0)
+    else:
+        position = path.find(query)
+        if position != -1:
+            score = 500.0 + (20 if position == 0 or path[position - 1] in WORD_BOUNDARIES else 0)
+        else:
+            score = 0.0
+            last = -2
+            start = 0
+            for char in query:
+                found = path.find(char, start)
+                if found == -1:
+                    return None
+                if found == last + 1:
+                    score += 5
+                elif found == 0 or path[found - 1] in WORD_BOUNDARIES:
+                    score += 8
+                if found >= name_start:
+                    score += 3
+                last, start = found, found + 1
+            score = min(score, 400.0)
+    return score - len(path) * 0.2
+
+
+def subsequence_pattern(query: str) -> "re.Pattern":
+    """The query's characters in order within one line, starting at the first one. Each gap excludes the next
+    character, so the first occurrences are taken and a line is never backtracked over."""
+    parts = [re.escape(query[0])]
+    for char in query[1:]:
+        escaped = re.escape(char)
+        parts.append(f"[^{escaped}\\n]*{escaped}")
+    return re.compile("".join(parts))
+
+
+class PathLines:
+    """Paths joined by newlines, with a lowercased copy at the same offsets, scanned in C by find and re."""
+
+    def __init__(self, text: str, lowered: str):
+        self.text = text
+        self.lowered = lowered
+
+    @classmethod
+    def join(cls, paths: Iterable[str]) -> "PathLines":
+        paths = list(paths)
+        # The rare characters whose lowercase has another length are left as they are, to keep the offsets
+        lowered = [p.lower() for p in paths]
+        lowered = [low if len(low) == len(p) else p for p, low in zip(paths, lowered)]
+        return cls("\n".join(paths), "\n".join(lowered))
+
+    def _scan(self, find: Callable[[int], Optional[int]], cap: int) -> Tuple[List[str], bool]:
+        found = []
+        position = 0
+        while True:
+            hit = find(position)
+            if hit is None:
+                return found, False
+            start = self.lowered.rfind("\n", 0, hit) + 1
+            end = self.lowered.find("\n", hit)
+            end = len(self.lowered) if end == -1 else end
+            found.append(self.text[start:end])
+            if len(found) == cap:
+                return found, True
+            position = end + 1
+
+    def naming(self, query: str, cap: int) -> Tuple[List[str], bool]:
+        """(up to `cap` paths whose last part contains the lowercase `query`, whether there were more)"""
+        pattern = re.compile(re.escape(query) + f"[^{re.escape(os.sep)}\\n]*$", re.MULTILINE)
+
+        def find(position: int) -> Optional[int]:
+            match = pattern.search(self.lowered, position)
+            return match.start() if match else None
+
+        return self._scan(find, cap)
+
+    def containing(self, query: str, cap: int) -> Tuple[List[str], bool]:
+        """(up to `cap` paths containing the lowercase `query`, whether there were more)"""
+
+        def find(position: int) -> Optional[int]:
+            hit = self.lowered.find(query, position)
+            return hit if hit != -1 else None
+
+        return self._scan(find, cap)
+
+    def matching(self, query: str, cap: int) -> Tuple[List[str], bool]:
+        """(up to `cap` paths containing the characters of the lowercase `query` in order, whether there were more)"""
+        pattern = subsequence_pattern(query)
+
+        def find(position: int) -> Optional[int]:
+            match = pattern.search(self.lowered, position)
+            return match.start() if match else None
+
+        return self._scan(find, cap)
+
+
+def file_trigrams(data: bytes) -> set:
+    return {data[i : i + 3] for i in range(len(data) - 2)}
+
+
+def _contains(posting: array, file_id: int) -> bool:
+    position = bisect_left(posting, file_id)
+    return position < len(posting) and posting[position] == file_id
+
+
+class ContentIndex:
+    """Trigram postings over the lowercased bytes of the indexed text files (ASCII letters only, as
+    bytes.lower() folds them; search_content folds its query the same way).
+
+    Only narrows a search down to candidates: every candidate is read again and checked, so a posting that
+    outlived its file's content costs a read but never a wrong result. Replaced files get a new id; the old
+    one stays in the postings (as dead) until dead ids outnumber live ones and the postings are compacted.
+    """
+
+    def __init__(self, limits: ReadLimits):
+        self.limits = limits
+        self.indexed_bytes = 0
+        self._paths: List[Optional[str]] = []  # File id -> relative path, None once dead
+        self._files: Dict[str, Tuple[int, tuple, int]] = {}  # Relative path -> (id, version key, bytes)
+        self._postings: Dict[bytes, array] = {}
+        self._dead = 0
+
+    @property
+    def file_count(self) -> int:
+        return len(self._files)
+
+    def add(self, rel: str, key: tuple, data: bytes):
+        self.remove(rel)
+        file_id = len(self._paths)
+        self._paths.append(rel)
+        self._files[rel] = (file_id, key, len(data))
+        self.indexed_bytes += len(data)
+        for gram in file_trigrams(data.lower()):
+            posting = self._postings.get(gram)
+            if posting is None:
+                self._postings[gram] = array("I", (file_id,))
+            else:
+                posting.append(file_id)
+
+    def remove(self, rel: str):
+        known = self._files.pop(rel, None)
+        if known is None:
+            return
+        file_id, _key, size = known
+        self._paths[file_id] = None
+        self.indexed_bytes -= size
+        self._dead += 1
+        if self._dead > len(self._files):
+            self._compact()
+
+    def _compact(self):
+        renumbered: Dict[int, int] = {}
+        paths: List[Optional[str]] = []
+        for old_id, rel in enumerate(self._paths):
+            if rel is not None:
+                renumbered[old_id] = len(paths)
+                paths.append(rel)
+        self._paths = paths
+        self._files = {rel: (renumbered[i], key, size) for rel, (i, key, size) in self._files.items()}
+        postings = {}
+        for gram, posting in self._postings.items():
+            kept = array("I", (renumbered[i] for i in posting if i in renumbered))
+            if kept:
+                postings[gram] = kept
+        self._postings = postings
+        self._dead = 0
+
+    def key(self, rel: str) -> Optional[tuple]:
+        known = self._files.get(rel)
+        return known[1] if known else None
+
+    def paths(self) -> List[str]:
+        return list(self._files)
+
+    def candidates(self, needle: bytes) -> Iterator[str]:
+        """Paths of the live files containing every trigram of `needle` (lowercase), in indexing order.
+
+        Lazy: walks the shortest posting and looks each id up in the others (postings are sorted, as ids only
+        grow), so a search that stops after a few hits never intersects long postings in full.
+        """
+        postings = []
+        for gram in file_trigrams(needle):
+            posting = self._postings.get(gram)
+            if posting is None:
+                return
+            postings.append(posting)
+        postings.sort(key=len)
+        paths = self._paths
+        for file_id in postings[0]:
+            if all(_contains(posting, file_id) for posting in postings[1:]) and paths[file_id] is not None:
+                yield paths[file_id]
+
+
+class SearchIndex:
+    """The paths below one root, minus excluded ones, for fuzzy filename search; optionally a ContentIndex.
+
+    The first build walks the root on a daemon thread and searches meanwhile see what is indexed so far.
+    Afterwards, a search more than refresh_seconds after the last walk starts another one in the background:
+    it lists every indexed directory again through `lister`, and a DirectoryListingCache answers that from
+    memory for directories inotify (or their mtime) says did not change, so only changed directories are
+    diffed and re-walked. Symlinked directories are indexed but not followed.
+
+    With a `source` (a git revision), the root is read from that commit and never needs refreshing.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        matcher: ExclusionMatcher,
+        lister: Lister,
+        source: Optional[GitRevision] = None,
+        refresh_seconds: float = DEFAULT_REFRESH_SECONDS,
+        content_limits: ReadLimits = DEFAULT_CONTENT_LIMITS,
+        content_refresh_seconds: float = DEFAULT_CONTENT_REFRESH_SECONDS,
+    ):
+        self.root = root
+        self.matcher = matcher
+        self.source = source
+        self.refresh_seconds = refresh_seconds
+        self.content_refresh_seconds = content_refresh_seconds
+        self.content: Optional[ContentIndex] = None
+        self.walk_ms: Optional[float] = None
+        self.complete = False
+        self._lister = lister
+        self._content_limits = content_limits
+        self._content_synced_at = 0.0
+        self._lock = threading.Lock()
+        self._paths: Dict[str, bool] = {}  # Relative path -> is a directory
+        self._links: Dict[str, str] = {}  # Relative path of a symlink -> its node id (the resolved target)
+        self._directories: Dict[str, _Directory] = {}
+        self._lines: Optional[PathLines] = None  # Rebuilt after changes
+        self._recent: Optional[Tuple[PathLines, str, PathLines]] = None  # (lines, query, the lines it matched)
+        self._worker: Optional[threading.Thread] = None
+        self._walked_at = 0.0
+        self._closed = False
+        self._start_walk()
+
+    @property
+    def path_count(self) -> int:
+        return len(self._paths)
+
+    @property
+    def busy(self) -> bool:
+        worker = self._worker
+        return worker is not None and worker.is_alive()
+
+    def close(self):
+        """Stop after the current walk; the index is not searched any more."""
+        self._closed = True
+
+    def _absolute(self, rel: str) -> str:
+        return os.path.join(self.root, rel) if rel else self.root
+
+    def _start_walk(self):
+        with self._lock:
+            if self._closed or (self._worker is not None and self._worker.is_alive()):
+                return
+            self._worker = threading.Thread(target=self._run, name="treeb-search-index", daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        started = time.perf_counter()
+        try:
+            self._walk()
+            self.complete = True
+            if self.content is not None and not self._closed:
+                self._sync_content()
+        except Exception as e:
+            logger.error(f"Search index of {self.root}: walk failed: {e}")
+        self.walk_ms = (time.perf_counter() - started) * 1000
+        self._walked_at = time.monotonic()
+
+    def _walk(self):
+        stack = [""]
+        while stack and not self._closed:
+            stack.extend(reversed(self._sync_directory(stack.pop())))  # Depth first, in listing order
+        if self._closed:
+            return
+        # Directories left behind by a move or removal that their parent's diff did not reach
+        with self._lock:
+            for rel_dir in [d for d in self._directories if d and d not in self._paths]:
+                self._forget_directory(rel_dir)
+
+    def _sync_directory(self, rel_dir: str) -> List[str]:
+        """Bring one directory's entries up to date; returns the subdirectories to visit next."""
+        known = self._directories.get(rel_dir)
+        try:
+            entries = self._lister(self._absolute(rel_dir))
+        except OSError:
+            entries = []
+        if known is not None and known.entries is entries:
+            return [self._join(rel_dir, name) for name, followed in known.children.items() if followed]
+
+        children: Dict[str, bool] = {}
+        links: Dict[str, str] = {}
+        for entry in entries:
+            if not entry.exists:
+                continue  # Dangling symlink: an error node in the tree
+            if self.matcher.match(entry.path, entry.name, entry.is_dir, entry.is_file):
+                continue
+            children[entry.name] = entry.is_dir and not entry.is_symlink
+            if entry.is_symlink:
+                links[entry.name] = entry.real_path
+        kinds = {entry.name: entry.is_dir for entry in entries if entry.name in children}
+
+        with self._lock:
+            previous = known.children if known is not None else {}
+            for name, followed in previous.items():
+                rel = self._join(rel_dir, name)
+                if name not in children or children[name] != followed or self._paths.get(rel) != kinds[name]:
+                    self._forget(rel)
+            for name in children:
+                rel = self._join(rel_dir, name)
+                self._paths[rel] = kinds[name]
+                if name in links:
+                    self._links[rel] = links[name]
+                else:
+                    self._links.pop(rel, None)
+            self._directories[rel_dir] = _Directory(entries, children)
+            self._lines = None
+        return [self._join(rel_dir, name) for name, followed in children.items() if followed]
+
+    @staticmethod
+    def _join(rel_dir: str, name: str) -> str:
+        return rel_dir + os.sep + name if rel_dir else name
+
+    def _forget(self, rel: str):
+        # Called with self._lock held
+        self._paths.pop(rel, None)
+        self._links.pop(rel, None)
+        if self.content is not None:
+            self.content.remove(rel)
+        self._forget_directory(rel)
+
+    def _forget_directory(self, rel_dir: str):
+        # Called with self._lock held
+        known = self._directories.pop(rel_dir, None)
+        if known is not None:
+            for name in known.children:
+                self._forget(self._join(rel_dir, name))
+
+    def _refresh_if_stale(self):
+        if not self.complete:
+            return
+        stale = self.source is None and time.monotonic() - self._walked_at >= self.refresh_seconds
+        if stale or (self.content is not None and not self.content_ready):
+            self._start_walk()
+
+    def node_id(self, rel: str) -> str:
+        return self._links.get(rel) or self._absolute(rel)
+
+    def ancestors(self, rel: str) -> List[str]:
+        """Node ids of the directories to open, from the root down, to reveal `rel` in the tree."""
+        ids = [self.root]
+        parts = rel.split(os.sep)[:-1]
+        for depth in range(1, len(parts) + 1):
+            ids.append(self._absolute(os.sep.join(parts[:depth])))
+        return ids
+
+    def _path_lines(self) -> PathLines:
+        with self._lock:
+            if self._lines is None:
+                self._lines = PathLines.join(self._paths)
+            return self._lines
+
+    def search(
+        self,
+        query: str,
+        limit: int = DEFAULT_MAX_RESULTS,
+        is_excluded: Optional[Callable[[str, bool], bool]] = None,
+    ) -> SearchResult:
+        """The best fuzzy matches of `query` among the indexed paths (spaces are ignored; "/" separates
+        directories). `is_excluded(absolute_path, is_dir)` drops further hits, such as ignored files.
+
+        Matches are looked for tier by tier, as they score: the query in the file name, anywhere in the path,
+        then its characters in order; a tier is only scanned when the ones above it gave fewer than `limit`
+        hits, and at most MAX_SCORED_CANDIDATES paths of each are scored. While a query is being typed,
+        each keystroke searches only the paths that matched the previous one.
+        """
+        self._refresh_if_stale()
+        query = "".join(query.lower().split()).replace("/", os.sep)
+        if not query:
+            return SearchResult([], self.complete, False)
+        lines = self._path_lines()
+        recent = self._recent
+        if recent is not None and recent[0] is lines and query.startswith(recent[1]):
+            searched = recent[2]
+        else:
+            searched = lines
+
+        hits: List[SearchHit] = []
+        seen = set()
+        truncated = False
+        for find in (searched.naming, searched.containing, searched.matching):
+            candidates, cut = find(query, MAX_SCORED_CANDIDATES)
+            truncated = truncated or cut
+            if find == searched.matching and not cut:
+                self._recent = (lines, query, PathLines.join(candidates))
+            scored = []
+            for rel in candidates:
+                if rel not in seen:
+                    seen.add(rel)
+                    score = fuzzy_score(query, rel.lower(), rel.rfind(os.sep) + 1)
+                    if score is not None:
+                        scored.append((score, rel))
+            scored.sort(key=lambda item: (-item[0], item[1]))
+            for score, rel in scored:
+                is_dir = self._paths.get(rel)
+                if is_dir is None:
+                    continue  # Removed since the lines were joined
+                if is_excluded is not None and is_excluded(self._absolute(rel), is_dir):
+                    continue
+                if len(hits) == limit:
+                    truncated = True
+                    break
+                hits.append(SearchHit(rel, self.node_id(rel), is_dir, round(score, 1)))
+            if len(hits) == limit:
+                break
+        return SearchResult(hits, self.complete, truncated)
+
+    def enable_content(self):
+        """Start indexing file contents (after the path walk, in the background) if not done already."""
+        with self._lock:
+            if self.content is not None:
+                return
+            self.content = ContentIndex(self._content_limits)
+            self._content_synced_at = 0.0
+        self._start_walk()
+
+    @property
+    def content_ready(self) -> bool:
+        return self.content is not None and self._content_synced_at > 0
+
+    def _file_key(self, rel: str) -> Optional[tuple]:
+        if self.source is not None:
+            return self.source.file_key(self._absolute(rel))
+        try:
+            st = os.stat(self._absolute(rel))
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _read(self, rel: str, size: int) -> bytes:
+        if self.source is not None:
+            return self.source.read_head(self._absolute(rel), size)
+        with open(self._absolute(rel), "rb") as f:
+            return f.read(size)
+
+    def _sync_content(self):
+        """Index new and changed text files and drop removed ones, at most every content_refresh_seconds."""
+        if self.source is not None and self._content_synced_at:
+            return
+        if time.monotonic() - self._content_synced_at < self.content_refresh_seconds:
+            return
+        content = self.content
+        limits = content.limits
+        with self._lock:
+            files = [rel for rel, is_dir in self._paths.items() if not is_dir]
+        present = set(files)
+        for rel in content.paths():
+            if rel not in present:
+                with self._lock:
+                    content.remove(rel)
+        for rel in files:
+            if self._closed:
+                return
+            key = self._file_key(rel)
+            if key is None or key == content.key(rel):
+                continue
+            size = key[-1]
+            with self._lock:
+                content.remove(rel)
+            if limits.max_file_bytes is not None and size > limits.max_file_bytes:
+                continue
+            if limits.max_total_bytes is not None and content.indexed_bytes + size > limits.max_total_bytes:
+                continue
+            try:
+                data = self._read(rel, size)
+            except (OSError, ValueError):
+                continue
+            if sniff_content(data[:SNIFF_BYTES], os.path.basename(rel), len(data), limits):
+                continue
+            with self._lock:
+                content.add(rel, key, data)
+        self._content_synced_at = time.monotonic()
+        logger.info(
+            f"Search index of {self.root}: {content.file_count} files, {content.indexed_bytes} bytes of content indexed."
+        )
+
+    def search_content(
+        self,
+        query: str,
+        limit: int = DEFAULT_MAX_RESULTS,
+        is_excluded: Optional[Callable[[str, bool], bool]] = None,
+    ) -> SearchResult:
+        """Indexed files containing `query` (ignoring the case of ASCII letters only), in tree order, with their
+        first matching line.
+
+        Raises ValueError for queries shorter than MIN_CONTENT_QUERY. Call enable_content() first; until its
+        first pass is done the result is empty and not complete.
+        """
+        if len(query) < MIN_CONTENT_QUERY:
+            raise ValueError(f"Content search needs at least {MIN_CONTENT_QUERY} characters.")
+        self._refresh_if_stale()
+        content = self.content
+        if content is None or not self.content_ready:
+            return SearchResult([], False, False)
+        needle = query.encode("utf-8").lower()  # As the index and the files are folded: ASCII letters only
+        read_limit = content.limits.max_file_bytes
+        hits = []
+        truncated = False
+        for rel in content.candidates(needle):
+            path = self._absolute(rel)
+            if is_excluded is not None and is_excluded(path, False):
+                continue
+            try:
+                data = self._read(rel, read_limit if read_limit is not None else (content.key(rel) or (0,))[-1])
+            except (OSError, ValueError):
+                continue
+            position = data.lower().find(needle)
+            if position == -1:
+                continue  # Changed since it was indexed
+            if len(hits) == limit:
+                truncated = True
+                break
+            line_start = data.rfind(b"\n", 0, position) + 1
+            line_end = data.find(b"\n", position)
+            line = data[line_start : line_end if line_end != -1 else len(data)]
+            column = position - line_start
+            snippet_start = max(0, column - SNIPPET_CHARS // 2)
+            snippet = line[snippet_start : snippet_start + SNIPPET_CHARS].decode("utf-8", errors="replace").strip()
+            hits.append(SearchHit(rel, self.node_id(rel), False, 0.0, data.count(b"\n", 0, position) + 1, snippet))
+        return SearchResult(hits, self.complete and self._content_synced_at > 0, truncated)
+
+
+class SearchIndexes:
+    """The search indexes kept in memory: one per root, revision and exclusion matcher, least recently used
+    dropped beyond max_indexes."""
+
+    def __init__(self, max_indexes: int = DEFAULT_MAX_INDEXES, **index_options):
+        self.max_indexes = max_indexes
+        self._index_options = index_options
+        self._indexes: "OrderedDict[tuple, SearchIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def index(
+        self, root: str, matcher: ExclusionMatcher, lister: Lister, source: Optional[GitRevision] = None
+    ) -> SearchIndex:
+        """The index of `root` (an already-resolved directory), starting its build if there is none yet."""
+        key = (root, source.commit if source is not None else None, matcher)
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                self._indexes.move_to_end(key)
+                return index
+            index = SearchIndex(root, matcher, lister, source, **self._index_options)
+            self._indexes[key] = index
+            while len(self._indexes) > self.max_indexes:
+                _key, dropped = self._indexes.popitem(last=False)
+                dropped.close()
+            return index
+
+    @property
+    def busy(self) -> bool:
+        """Whether any index is walking or reading right now."""
+        with self._lock:
+            return any(index.busy for index in self._indexes.values())
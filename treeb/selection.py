@@ -0,0 +1,93 @@
+# treeb/treeb/selection.py
+
+import logging
+import os
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Selection(NamedTuple):
+    """Paths under `include` and `exclude` that each cover everything below them, the deepest one deciding:
+    an item is selected when the nearest of those paths at or above it is an include. So an include below an
+    exclude is selected again, with everything below it. A path both included and excluded is excluded."""
+
+    include: Sequence[str]
+    exclude: Sequence[str] = ()
+
+    def relative_to(self, base: Path) -> dict:
+        """{"include": [...], "exclude": [...]} with the paths below `base` relative to it (others absolute)."""
+
+        def relative(path_str: str) -> str:
+            try:
+                return str(Path(path_str).relative_to(base))
+            except ValueError:
+                return path_str
+
+        return {"include": [relative(p) for p in self.include], "exclude": [relative(p) for p in self.exclude]}
+
+
+def parse_selection(data, base: Optional[Path] = None) -> Selection:
+    """A selection as sent by the page or stored in a preset: {"root": ..., "include": [...], "exclude": [...]},
+    paths relative to "root" (else to `base`; absolute paths are taken as they are). Raises ValueError."""
+    if not isinstance(data, dict):
+        raise ValueError('A selection is {"root": ..., "include": [...], "exclude": [...]}')
+    include, exclude = data.get("include", []), data.get("exclude", [])
+    if not isinstance(include, list) or not isinstance(exclude, list):
+        raise ValueError('A selection\'s "include" and "exclude" are lists of paths')
+    root = data.get("root") or base
+    if root is None:
+        return Selection([str(p) for p in include], [str(p) for p in exclude])
+    root = Path(root)
+    return Selection([str(root / str(p)) for p in include], [str(root / str(p)) for p in exclude])
+
+
+def _resolve(path_str: str) -> Optional[str]:
+    try:
+        return str(Path(path_str).resolve())
+    except Exception as e:
+        logger.warning(f"Selection: Invalid path string {path_str}: {e}. Skipping.")
+        return None
+
+
+def normalize_selection(selection: Selection) -> Selection:
+    """The same selection with each subtree listed once: what the walk needs.
+
+    Includes below another include (with no exclude in between) and excludes outside every include are
+    dropped; this is decided on the paths as written, so it costs no filesystem access. Only the includes
+    left are resolved. Excludes are rewritten below the resolved include that contains them, which is how
+    the walk names the items it reaches.
+    """
+    items: List[Tuple[Tuple[str, ...], bool, str]] = []
+    for p_str, included in [(p, True) for p in selection.include] + [(p, False) for p in selection.exclude]:
+        try:
+            absolute = os.path.abspath(str(p_str))
+        except Exception as e:
+            logger.warning(f"Selection: Invalid path string {p_str}: {e}. Skipping.")
+            continue
+        items.append((tuple(Path(absolute).parts), not included, absolute))  # Includes first where both
+
+    include: List[str] = []
+    exclude: List[str] = []
+    # Kept items containing the current one, innermost last: (parts, is_excluded, absolute, path the walk uses)
+    enclosing: List[Tuple[Tuple[str, ...], bool, str, str]] = []
+    for parts, excluded, absolute in sorted(items):
+        while enclosing and enclosing[-1][0] != parts[: len(enclosing[-1][0])]:
+            enclosing.pop()
+        inside = enclosing[-1] if enclosing else None
+        if not excluded:
+            if inside is not None and not inside[1]:
+                continue  # Walked with the include containing it
+            walked = _resolve(absolute)
+            if walked is None:
+                continue
+            include.append(walked)
+        else:
+            if inside is None or inside[1]:
+                continue  # Nothing selected there to leave out
+            walked = inside[3] + absolute[len(inside[2]) :]
+            exclude.append(walked)
+        enclosing.append((parts, excluded, absolute, walked))
+    return Selection(include, exclude)
+
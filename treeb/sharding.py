@@ -0,0 +1,105 @@
+# treeb/treeb/sharding.py
+
+import bisect
+from typing import Callable, List, NamedTuple, Optional
+
+# Headers of the shards. Every shard says where it sits; shards after the first only point back to the tree
+# unless the full tree is repeated in each of them.
+SHARD_HEADER_MODES = ("reference", "tree")
+SHARD_FILES_LINE = "Context files (shard {index} of {count}):\n"
+SHARD_TREE_REFERENCE = "code base: see the tree in shard 1 of {count}.\n\n"
+# Shard numbers are not known while planning; headers are measured with this in their place
+SHARD_NUMBER_PLACEHOLDER = 99999
+
+PIECE_PATH_SUFFIX = " (lines {first}-{last} of {total})"
+
+
+class ShardItem(NamedTuple):
+    tokens: int  # Cost of the whole file: path line plus block
+    piece_overhead: int  # Cost of a line-range piece apart from its lines: path line with range, fences
+
+
+class ShardEntry(NamedTuple):
+    file_index: int
+    first_line: Optional[int]  # 1-based, inclusive; None for the whole file
+    last_line: Optional[int]
+    tokens: int  # Planned cost
+
+
+class Shard(NamedTuple):
+    entries: List[ShardEntry]
+    tokens: int  # Planned cost, header included
+
+
+def plan_shards(
+    items: List[ShardItem],
+    limit: int,
+    first_header_tokens: int,
+    header_tokens: int,
+    line_tokens: Callable[[int], List[int]],
+) -> List[Shard]:
+    """Split files (in output order) into shards of at most `limit` tokens, in one pass over their counts.
+
+    A file that does not fit in what is left of the current shard starts a new one; a file too large for
+    any shard is split at line boundaries, using line_tokens(file_index) (estimated tokens per line, only
+    asked for such files). A single line larger than a shard ends up alone and over the limit.
+    """
+    shards: List[Shard] = []
+    entries: List[ShardEntry] = []
+    used = first_header_tokens
+
+    def close_shard():
+        nonlocal entries, used
+        shards.append(Shard(entries, used))
+        entries = []
+        used = header_tokens
+
+    for index, item in enumerate(items):
+        if used + item.tokens <= limit:
+            entries.append(ShardEntry(index, None, None, item.tokens))
+            used += item.tokens
+            continue
+        if header_tokens + item.tokens <= limit:
+            close_shard()
+            entries.append(ShardEntry(index, None, None, item.tokens))
+            used += item.tokens
+            continue
+
+        # Too large for any shard: fill shards with consecutive line ranges
+        per_line = line_tokens(index)
+        first = 0
+        piece_tokens = item.piece_overhead
+        for line_index, tokens in enumerate(per_line):
+            if line_index > first and used + piece_tokens + tokens > limit:
+                entries.append(ShardEntry(index, first + 1, line_index, piece_tokens))
+                used += piece_tokens
+                close_shard()
+                first = line_index
+                piece_tokens = item.piece_overhead
+            elif line_index == first and entries and used + piece_tokens + tokens > limit:
+                close_shard()  # Not even one line fits after what is already in this shard
+            piece_tokens += tokens
+        if per_line:
+            entries.append(ShardEntry(index, first + 1, len(per_line), piece_tokens))
+            used += piece_tokens
+
+    if entries or not shards:
+        close_shard()
+    return shards
+
+
+def estimate_line_tokens(encoding, content: str) -> List[int]:
+    """Tokens per line of content (split on "\\n"), from a single encode of the whole text.
+
+    Tokens are attributed to the line they start in, so the counts add up to the full count; a piece made
+    of some of the lines may encode to a few tokens more or less at its edges.
+    """
+    tokens = encoding.encode_ordinary(content)
+    _, offsets = encoding.decode_with_offsets(tokens)
+    line_starts = [0]
+    position = content.find("\n")
+    while position != -1:
+        line_starts.append(position + 1)
+        position = content.find("\n", position + 1)
+    token_starts = [bisect.bisect_left(offsets, start) for start in line_starts] + [len(tokens)]
+    return [token_starts[i + 1] - token_starts[i] for i in range(len(line_starts))]
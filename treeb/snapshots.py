@@ -0,0 +1,441 @@
+# treeb/treeb/snapshots.py
+
+import difflib
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import wait as wait_for_futures
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Set
+
+from treeb.flatten import (
+    EMPTY_SELECTION_MESSAGE,
+    Flattener,
+    FlattenPlan,
+    Segment,
+    display_path_for_file,
+    mapped_block_segments,
+    render_file_block_body,
+)
+from treeb.ingest import MappedText
+from treeb.listing import RACY_MTIME_WINDOW_NS
+from treeb.packing import FULL, PackingDecision
+from treeb.pipeline import map_ordered
+from treeb.tokencache import FileKey
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_SCHEMA_VERSION = 1
+DEFAULT_KEEP_SNAPSHOTS = 20
+# Old manifests are deleted in batches of this many, so that not every save has to read the kept ones
+PRUNE_BATCH = 5
+LATEST_SNAPSHOT = "latest"
+SNAPSHOT_ID = re.compile(r"[0-9A-Za-z-]{1,64}")
+DIFF_FORMATS = ("files", "unified")
+# What a flatten asked to record: its manifest only (paths, text hashes, token counts), or the texts too,
+# which a later "unified" diff against it needs
+SNAPSHOT_MANIFEST, SNAPSHOT_TEXTS = "manifest", "texts"
+SNAPSHOT_MODES = (SNAPSHOT_MANIFEST, SNAPSHOT_TEXTS)
+
+CHANGES_HEADER = "Changes since snapshot {since}: {added} added, {modified} modified, {removed} removed, {unchanged} unchanged.\n"
+CHANGE_LINE = "{status}: {path}\n"
+CHANGED_FILES_LINE = "\nChanged files:\n"
+DIFF_PATH_SUFFIX = " (diff against snapshot)"
+
+
+class ManifestFile(NamedTuple):
+    key: Optional[FileKey]  # Version read (see Flattener.file_key); None if it could not be looked up
+    digest: Optional[str]  # sha1 of the text sent; None when it was not sent in full (budget packing)
+    tokens: Optional[int]  # Block body tokens in the flattener's encoding, when counted
+
+
+class Manifest(NamedTuple):
+    """What one flatten sent: per file (by display path, in output order) its version, text hash and tokens."""
+
+    id: str
+    created: float  # time.time()
+    root: Optional[str]  # The plan's common ancestor
+    commit: Optional[str]  # The git commit read, when flattened from a revision
+    files: Dict[str, ManifestFile]
+    selection: Optional[str] = None  # Fingerprint of the selection flattened ("latest" is per root and selection)
+    texts: bool = True  # Whether the texts sent were stored too, for unified diffs against this snapshot
+
+    def to_json(self) -> dict:
+        return {
+            "version": MANIFEST_SCHEMA_VERSION,
+            "id": self.id,
+            "created": self.created,
+            "root": self.root,
+            "commit": self.commit,
+            "selection": self.selection,
+            "texts": self.texts,
+            "files": [[path, *(f.key or (None, None, None)), f.digest, f.tokens] for path, f in self.files.items()],
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Manifest":
+        if data.get("version") != MANIFEST_SCHEMA_VERSION:
+            raise ValueError(f"Snapshot {data.get('id')} has an unsupported manifest version")
+        files = {}
+        for path, key_path, mtime_ns, size, digest, tokens in data["files"]:
+            key = (key_path, mtime_ns, size) if key_path is not None else None
+            files[path] = ManifestFile(key, digest, tokens)
+        return cls(
+            data["id"], data["created"], data.get("root"), data.get("commit"), files, data.get("selection"), data.get("texts", True)
+        )
+
+    def summary(self) -> dict:
+        """For listings: the manifest without its files."""
+        token_counts = [f.tokens for f in self.files.values() if f.tokens is not None]
+        return {
+            "id": self.id,
+            "created": self.created,
+            "root": self.root,
+            "commit": self.commit,
+            "files": len(self.files),
+            "tokens": sum(token_counts),
+        }
+
+
+class FileChanges(NamedTuple):
+    since: str  # Snapshot id compared against
+    added: List[str]  # Display paths, in output order
+    modified: List[str]
+    removed: List[str]
+    unchanged: int
+
+    def to_json(self) -> dict:
+        return self._asdict()
+
+
+def text_digest(content) -> str:
+    """The digest put_text would store a text (a str or a MappedText) under, without storing it."""
+    if isinstance(content, str):
+        return hashlib.sha1(content.encode("utf-8", errors="surrogatepass")).hexdigest()
+    hasher = hashlib.sha1()
+    for chunk in content.chunks():
+        hasher.update(chunk.encode("utf-8", errors="surrogatepass"))
+    return hasher.hexdigest()
+
+
+class SnapshotStore:
+    """Manifests of recent flattens (one small JSON file each) and, when asked to, the texts they sent
+    (zlib-compressed, one file per distinct text, named by its sha1), so that later flattens can send only
+    what changed.
+
+    Snapshot ids start with their creation time, so they sort by age. About the newest `keep` manifests
+    are kept; texts no kept manifest refers to are deleted with the others. Manifests given to save_later
+    are built and saved on a background thread; reading snapshots waits for those first.
+    """
+
+    def __init__(self, directory: Path, keep: int = DEFAULT_KEEP_SNAPSHOTS):
+        self.directory = Path(directory)
+        self.keep = max(keep, 1)
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="treeb-snapshot")
+        self._pending: Dict[str, Future] = {}
+
+    def save_later(self, snapshot_id: str, build: Callable[[], Manifest]) -> str:
+        """Save the manifest build() returns (with id `snapshot_id`) in the background; the id at once."""
+
+        def run():
+            try:
+                self.save(build())
+            except Exception as e:
+                logger.error(f"Snapshots: could not save snapshot {snapshot_id}: {e}")
+            finally:
+                with self._lock:
+                    self._pending.pop(snapshot_id, None)
+
+        with self._lock:
+            self._pending[snapshot_id] = self._pool.submit(run)
+        return snapshot_id
+
+    def flush(self):
+        """Wait until the snapshots given to save_later so far are saved (or failed)."""
+        with self._lock:
+            pending = list(self._pending.values())
+        wait_for_futures(pending)
+
+    def _manifest_path(self, snapshot_id: str) -> Path:
+        return self.directory / f"{snapshot_id}.json"
+
+    def _object_path(self, digest: str) -> Path:
+        return self.directory / "objects" / digest[:2] / digest[2:]
+
+    def _write_object(self, digest: str, compressed: bytes):
+        path = self._object_path(digest)
+        if path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(compressed)
+        os.replace(tmp, path)
+
+    def put_text(self, content) -> str:
+        """Store a text (a str or a MappedText, consumed chunk by chunk) unless already stored; its digest."""
+        if isinstance(content, str):
+            data = content.encode("utf-8", errors="surrogatepass")
+            digest = hashlib.sha1(data).hexdigest()
+            if not self._object_path(digest).exists():
+                self._write_object(digest, zlib.compress(data, 1))
+            return digest
+        hasher, compressor, parts = hashlib.sha1(), zlib.compressobj(1), []
+        for chunk in content.chunks():
+            data = chunk.encode("utf-8", errors="surrogatepass")
+            hasher.update(data)
+            parts.append(compressor.compress(data))
+        parts.append(compressor.flush())
+        digest = hasher.hexdigest()
+        self._write_object(digest, b"".join(parts))
+        return digest
+
+    def read_text(self, digest: Optional[str]) -> Optional[str]:
+        """A stored text, or None if it is not (or no longer) stored."""
+        if digest is None:
+            return None
+        try:
+            return zlib.decompress(self._object_path(digest).read_bytes()).decode("utf-8", errors="surrogatepass")
+        except (OSError, zlib.error) as e:
+            logger.warning(f"Snapshots: text {digest} is not available: {e}")
+            return None
+
+    def _ids(self) -> List[str]:
+        """Stored snapshot ids, newest first."""
+        try:
+            return sorted((path.stem for path in self.directory.glob("*.json")), reverse=True)
+        except OSError:
+            return []
+
+    def _read(self, snapshot_id: str) -> Manifest:
+        return Manifest.from_json(json.loads(self._manifest_path(snapshot_id).read_text(encoding="utf-8")))
+
+    def list(self) -> List[Manifest]:
+        """The stored manifests, newest first (unreadable ones are left out)."""
+        manifests = []
+        for snapshot_id in self._ids():
+            try:
+                manifests.append(self._read(snapshot_id))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Snapshots: ignoring unreadable manifest {snapshot_id}: {e}")
+        return manifests
+
+    def latest(self, root: Optional[str], selection: Optional[str], wait: bool = True) -> Optional[Manifest]:
+        """The newest manifest of a flatten of `selection` (a fingerprint) below `root`; unless `wait` is
+        False (on the background thread itself), once the pending snapshots are saved."""
+        if wait:
+            self.flush()
+        for snapshot_id in self._ids():
+            try:
+                manifest = self._read(snapshot_id)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Snapshots: ignoring unreadable manifest {snapshot_id}: {e}")
+                continue
+            if manifest.root == root and manifest.selection == selection:
+                return manifest
+        return None
+
+    def load(self, snapshot_id: str, root: Optional[str] = None, selection: Optional[str] = None) -> Manifest:
+        """A stored manifest by id ("latest" for the newest of `selection` below `root`). Raises ValueError if
+        there is no such snapshot."""
+        if snapshot_id == LATEST_SNAPSHOT:
+            manifest = self.latest(root, selection)
+            if manifest is None:
+                raise ValueError("There is no snapshot of this selection yet: flatten it once with 'snapshot' first.")
+            return manifest
+        if not SNAPSHOT_ID.fullmatch(snapshot_id or ""):
+            raise ValueError(f"Invalid snapshot id {snapshot_id!r}")
+        self.flush()
+        try:
+            return self._read(snapshot_id)
+        except FileNotFoundError:
+            raise ValueError(f"Snapshot {snapshot_id} not found (only the last {self.keep} or so are kept)")
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            raise ValueError(f"Snapshot {snapshot_id} could not be read: {e}")
+
+    def save(self, manifest: Manifest):
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            path = self._manifest_path(manifest.id)
+            tmp = path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(manifest.to_json(), separators=(",", ":")), encoding="utf-8")
+            os.replace(tmp, path)
+            self._prune()
+
+    def _prune(self):
+        # Called with self._lock held
+        ids = self._ids()
+        if len(ids) < self.keep + PRUNE_BATCH:
+            return
+        for snapshot_id in ids[self.keep :]:
+            try:
+                self._manifest_path(snapshot_id).unlink()
+            except OSError:
+                pass
+        referenced: Set[str] = {f.digest for m in self.list() for f in m.files.values() if f.digest}
+        for prefix_dir in (self.directory / "objects").glob("??"):
+            for path in prefix_dir.iterdir():
+                if prefix_dir.name + path.name not in referenced and not path.name.endswith(".tmp"):
+                    try:
+                        path.unlink()
+                    except OSError:
+                        pass
+
+
+def new_snapshot_id() -> str:
+    now = time.time()
+    return f"{time.strftime('%Y%m%d-%H%M%S', time.gmtime(now))}{int(now * 1000) % 1000:03d}-{uuid.uuid4().hex[:6]}"
+
+
+def build_manifest(
+    flattener: Flattener,
+    plan: FlattenPlan,
+    store: SnapshotStore,
+    packing: Optional[PackingDecision] = None,
+    previous: Optional[Manifest] = None,
+    selection: Optional[str] = None,
+    store_texts: bool = True,
+    snapshot_id: Optional[str] = None,
+) -> Manifest:
+    """The manifest of what flattening `plan` sends, storing the texts not stored yet (with `store_texts`).
+
+    A file whose version (path, mtime and size, or blob id) is the one recorded in `previous` keeps its digest
+    without being read; only the others are read and hashed. Versions modified within the racy window before
+    `previous` was taken are read anyway, since they may have changed again without a new mtime, and so is
+    every file when texts are to be stored but `previous` stored none.
+    """
+    reusable: Dict[FileKey, str] = {}
+    if previous is not None and (previous.texts or not store_texts):
+        trusted_before_ns = int(previous.created * 1_000_000_000) - RACY_MTIME_WINDOW_NS
+        for recorded in previous.files.values():
+            if recorded.key is not None and recorded.digest is not None and recorded.key[1] < trusted_before_ns:
+                reusable[tuple(recorded.key)] = recorded.digest
+    sent_in_full = [True] * len(plan.files) if packing is None else [packed.mode == FULL for packed in packing.files]
+
+    def record(index: int) -> ManifestFile:
+        f_path = plan.files[index]
+        key = flattener.file_key(f_path)
+        if not sent_in_full[index]:
+            return ManifestFile(key, None, None)
+        digest = reusable.get(key) if key is not None else None
+        if digest is None:
+            content, read_key = flattener.open_text(f_path, plan.skipped.get(f_path))
+            digest = store.put_text(content) if store_texts else text_digest(content)
+            if f_path not in plan.skipped:
+                key = read_key
+        tokens = None
+        if key is not None and flattener.token_cache is not None and flattener.encoding is not None:
+            tokens = flattener.token_cache.get(key, flattener.encoding.name)
+        return ManifestFile(key, digest, tokens)
+
+    records = map_ordered(record, range(len(plan.files)), flattener.reader_workers)
+    files = {
+        display_path_for_file(f_path, plan.common_ancestor): recorded for f_path, recorded in zip(plan.files, records)
+    }
+    return Manifest(
+        id=snapshot_id or new_snapshot_id(),
+        created=time.time(),
+        root=str(plan.common_ancestor) if plan.common_ancestor is not None else None,
+        commit=flattener.source.commit if flattener.source is not None else None,
+        files=files,
+        selection=selection,
+        texts=store_texts,
+    )
+
+
+def with_token_counts(flattener: Flattener, manifest: Manifest) -> Manifest:
+    """The manifest with the counts the token cache has now for files it had none for (e.g. counted since)."""
+    if flattener.token_cache is None or flattener.encoding is None:
+        return manifest
+    files = {}
+    for path, recorded in manifest.files.items():
+        if recorded.tokens is None and recorded.key is not None and recorded.digest is not None:
+            recorded = recorded._replace(tokens=flattener.token_cache.get(recorded.key, flattener.encoding.name))
+        files[path] = recorded
+    return manifest._replace(files=files)
+
+
+def compare_manifests(previous: Manifest, current: Manifest) -> FileChanges:
+    """Files added, modified (different text, or not sent in full before) and removed since `previous`.
+
+    Files are matched by display path, which only names the same file below the same root: raises ValueError
+    for manifests of different roots.
+    """
+    if previous.root != current.root:
+        raise ValueError(f"Snapshot {previous.id} is of {previous.root}, not {current.root}: there is nothing to compare.")
+    added, modified = [], []
+    unchanged = 0
+    for path, recorded in current.files.items():
+        before = previous.files.get(path)
+        if before is None:
+            added.append(path)
+        elif before.digest is None or before.digest != recorded.digest:
+            modified.append(path)
+        else:
+            unchanged += 1
+    removed = [path for path in previous.files if path not in current.files]
+    return FileChanges(previous.id, added, modified, removed, unchanged)
+
+
+def unified_diff_text(old: str, new: str, display_path: str) -> str:
+    return "\n".join(
+        difflib.unified_diff(old.split("\n"), new.split("\n"), f"a/{display_path}", f"b/{display_path}", lineterm="")
+    )
+
+
+def iter_change_segments(
+    flattener: Flattener,
+    plan: FlattenPlan,
+    changes: FileChanges,
+    store: SnapshotStore,
+    previous: Manifest,
+    diff_format: str = "files",
+) -> Iterator[Segment]:
+    """The output of a flatten that only sends what changed since `previous`: the tree, the list of changes,
+    then the added and modified files, in full ("files") or, where the old text is still stored and the diff
+    is shorter, as a unified diff ("unified"). Segment cuts are valid for SegmentTokenCounter.
+    """
+    if plan.empty:
+        yield Segment(EMPTY_SELECTION_MESSAGE)
+        return
+    by_status = {"added": changes.added, "modified": changes.modified, "removed": changes.removed}
+    counts = {status: len(paths) for status, paths in by_status.items()}
+    summary = [plan.header, CHANGES_HEADER.format(since=changes.since, unchanged=changes.unchanged, **counts)]
+    summary.extend(CHANGE_LINE.format(status=status, path=path) for status, paths in by_status.items() for path in paths)
+
+    modified = set(changes.modified)
+    changed = set(changes.added) | modified
+    display_paths = [display_path_for_file(f_path, plan.common_ancestor) for f_path in plan.files]
+    included = [(f_path, path) for f_path, path in zip(plan.files, display_paths) if path in changed]
+    if included:
+        summary.append(CHANGED_FILES_LINE)
+    # One segment: a cut between the blank line and what precedes it would split a whitespace token
+    yield Segment("".join(summary))
+    if not included:
+        return
+    texts = map_ordered(
+        lambda f_path: flattener.open_text(f_path, plan.skipped.get(f_path)), [f_path for f_path, _ in included], flattener.reader_workers
+    )
+    for (f_path, path), (content, file_key) in zip(included, texts):
+        if diff_format == "unified" and path in modified and previous.texts:
+            old = store.read_text(previous.files[path].digest)
+            if old is not None:
+                new = content.read() if isinstance(content, MappedText) else content
+                diff = unified_diff_text(old, new, path)
+                if len(diff) < len(new):
+                    yield Segment(f"{path}{DIFF_PATH_SUFFIX}\n")
+                    yield Segment(render_file_block_body(diff))
+                    continue
+                content = new
+        yield Segment(f"{path}\n")
+        if isinstance(content, MappedText):
+            yield from mapped_block_segments(content, file_key)
+        else:
+            yield Segment(render_file_block_body(content), file_key)
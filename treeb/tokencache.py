@@ -0,0 +1,113 @@
+# treeb/treeb/tokencache.py
+
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Bump when the text whose tokens are cached (see render_file_block_body in flatten.py) changes shape
+CACHE_SCHEMA_VERSION = 1
+DEFAULT_MEMORY_ENTRIES = 100_000
+
+# (path, mtime_ns, size): identifies one version of a file's contents
+FileKey = Tuple[str, int, int]
+
+
+class TokenCountCache:
+    """Token counts of rendered file blocks, keyed by (path, mtime, size, encoding).
+
+    Lookups hit an in-memory LRU first, then a SQLite file that survives restarts. New counts are
+    buffered and written in one transaction by flush().
+    """
+
+    def __init__(self, db_path: Optional[Path], max_memory_entries: int = DEFAULT_MEMORY_ENTRIES):
+        self.db_path = db_path
+        self.max_memory_entries = max_memory_entries
+        self._memory: "OrderedDict[Tuple[str, str], Tuple[int, int, int]]" = OrderedDict()
+        self._pending: List[Tuple[str, str, int, int, int]] = []
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_failed = False
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        # Called with self._lock held
+        if self._db is not None or self._db_failed or self.db_path is None:
+            return self._db
+        try:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(str(self.db_path), check_same_thread=False)
+            if db.execute("PRAGMA user_version").fetchone()[0] != CACHE_SCHEMA_VERSION:
+                db.execute("DROP TABLE IF EXISTS token_counts")
+                db.execute(f"PRAGMA user_version = {CACHE_SCHEMA_VERSION}")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS token_counts ("
+                " path TEXT NOT NULL, encoding TEXT NOT NULL, mtime_ns INTEGER NOT NULL,"
+                " size INTEGER NOT NULL, tokens INTEGER NOT NULL, PRIMARY KEY (path, encoding)"
+                ") WITHOUT ROWID"
+            )
+            db.commit()
+            self._db = db
+        except sqlite3.Error as e:
+            logger.error(f"Token cache: could not open {self.db_path}: {e}. Continuing with the in-memory cache only.")
+            self._db_failed = True
+        return self._db
+
+    def _remember(self, path: str, encoding_name: str, mtime_ns: int, size: int, tokens: int):
+        # Called with self._lock held
+        memory_key = (path, encoding_name)
+        self._memory[memory_key] = (mtime_ns, size, tokens)
+        self._memory.move_to_end(memory_key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key: FileKey, encoding_name: str) -> Optional[int]:
+        path, mtime_ns, size = key
+        with self._lock:
+            cached = self._memory.get((path, encoding_name))
+            if cached is not None:
+                if cached[0] == mtime_ns and cached[1] == size:
+                    self._memory.move_to_end((path, encoding_name))
+                    return cached[2]
+                return None  # Stale; the database row is older still
+
+            db = self._connect()
+            if db is None:
+                return None
+            try:
+                row = db.execute(
+                    "SELECT mtime_ns, size, tokens FROM token_counts WHERE path = ? AND encoding = ?",
+                    (path, encoding_name),
+                ).fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"Token cache: lookup failed for {path}: {e}")
+                return None
+            if row is None or row[0] != mtime_ns or row[1] != size:
+                return None
+            self._remember(path, encoding_name, mtime_ns, size, row[2])
+            return row[2]
+
+    def put(self, key: FileKey, encoding_name: str, tokens: int):
+        path, mtime_ns, size = key
+        with self._lock:
+            self._remember(path, encoding_name, mtime_ns, size, tokens)
+            self._pending.append((path, encoding_name, mtime_ns, size, tokens))
+
+    def flush(self):
+        """Write counts added since the last flush to disk."""
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+            db = self._connect()
+            if db is None:
+                return
+            try:
+                with db:
+                    db.executemany("INSERT OR REPLACE INTO token_counts VALUES (?, ?, ?, ?, ?)", pending)
+            except sqlite3.Error as e:
+                logger.warning(f"Token cache: could not write {len(pending)} entries: {e}")
+
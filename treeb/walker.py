@@ -0,0 +1,152 @@
+# treeb/treeb/walker.py
+
+import logging
+import os
+import stat
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from treeb.ignorefiles import IgnoreFileRules
+
+logger = logging.getLogger(__name__)
+
+# (path, name, is_dir, is_file) -> excluded_info dict (as shown in the UI) or None
+ExclusionCheck = Callable[[str, str, bool, bool], Optional[dict]]
+
+
+def entry_is_dir(entry: os.DirEntry) -> bool:
+    """DirEntry.is_dir() that treats unreadable entries as Path.is_dir() does (False)."""
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
+
+
+def entry_is_file(entry: os.DirEntry) -> bool:
+    """DirEntry.is_file() that treats unreadable entries as Path.is_file() does (False)."""
+    try:
+        return entry.is_file()
+    except OSError:
+        return False
+
+
+def directory_sort_key(entry: os.DirEntry) -> Tuple[bool, str]:
+    """Directories first, then case-insensitively by name (the order used throughout the UI)."""
+    return (not entry_is_dir(entry), entry.name.lower())
+
+
+def scan_directory(path: str) -> List[os.DirEntry]:
+    """List a directory with a single os.scandir call, sorted with directory_sort_key.
+
+    DirEntry objects carry the file type from the listing itself, so is_dir()/is_file() cost no extra
+    syscall (a symlink costs one stat, which the entry caches). Raises OSError like os.scandir.
+    """
+    with os.scandir(path) as it:
+        entries = list(it)
+    entries.sort(key=directory_sort_key)
+    return entries
+
+
+class SelectionWalk(NamedTuple):
+    structure_paths: List[Path]  # Every non-excluded item reached, for the ASCII tree
+    files: List[Path]  # Files whose contents go into the output
+    real_paths: Dict[str, str]  # Only for items reached through a symlink: walked path -> resolved path
+    directories: Sequence[str] = ()  # Directories listed (working tree walks only)
+
+    def real_path(self, path: Path) -> Path:
+        """What path.resolve() would return, without touching the filesystem again."""
+        real = self.real_paths.get(str(path))
+        return Path(real) if real is not None else path
+
+
+def _path_sort_key(path_str: str) -> str:
+    return path_str.lower()
+
+
+def walk_selection(
+    selected_paths: Iterable[Path], is_excluded: ExclusionCheck, ignore_rules: Optional[IgnoreFileRules] = None
+) -> SelectionWalk:
+    """Expand a selection into the items to show in the tree and the files to read.
+
+    `selected_paths` should already be resolved. Each selected item costs one stat; everything below
+    a selected directory is discovered with os.scandir and never stat'ed again. Excluded items (selected
+    or discovered) are dropped together with their subtree. With `ignore_rules`, items ignored by
+    .gitignore/.ignore files are dropped the same way, so ignored directories are never listed. Both
+    result lists are sorted by lowercased path string, which is the order the flatten output has always used.
+    """
+    structure: Set[str] = set()
+    files: Set[str] = set()
+    real_paths: Dict[str, str] = {}
+    walked_dirs: Set[str] = set()
+    # Directories still to list, as (path as displayed, symlink-free real path)
+    stack: List[Tuple[str, str]] = []
+
+    for root in selected_paths:
+        root_str = str(root)
+        try:
+            st = os.stat(root_str)
+        except OSError:
+            logger.warning(f"Walk: Selected path {root_str} does not exist or is not accessible. Skipping.")
+            continue
+        is_dir = stat.S_ISDIR(st.st_mode)
+        is_file = stat.S_ISREG(st.st_mode)
+        exclusion_info = is_excluded(root_str, root.name, is_dir, is_file)
+        if not exclusion_info and ignore_rules is not None:
+            exclusion_info = ignore_rules.match(root_str, is_dir)
+        if exclusion_info:
+            logger.debug(f"Walk: Directly selected item {root_str} is excluded by rule: {exclusion_info}. Skipping.")
+            continue
+        structure.add(root_str)
+        if is_file:
+            files.add(root_str)
+        elif is_dir:
+            stack.append((root_str, root_str))
+
+    while stack:
+        dir_path, dir_real = stack.pop()
+        if dir_path in walked_dirs:  # Selected directory that is also below another selected directory
+            continue
+        walked_dirs.add(dir_path)
+
+        try:
+            with os.scandir(dir_path) as it:
+                entries = list(it)
+        except PermissionError:
+            logger.warning(f"Walk: Permission error iterating directory {dir_path}")
+            continue
+        except OSError as e:
+            logger.error(f"Walk: Error iterating directory {dir_path}: {e}")
+            continue
+        ignore_context = ignore_rules.for_directory(dir_path, [e.name for e in entries]) if ignore_rules else None
+
+        for entry in entries:
+            is_dir = entry_is_dir(entry)
+            is_file = not is_dir and entry_is_file(entry)
+            exclusion_info = is_excluded(entry.path, entry.name, is_dir, is_file)
+            if not exclusion_info and ignore_context is not None:
+                exclusion_info = ignore_context.match(entry.path, entry.name, is_dir)
+            if exclusion_info:
+                logger.debug(f"Walk: {entry.path} excluded by rule: {exclusion_info}. Skipping its children.")
+                continue
+
+            structure.add(entry.path)
+            is_symlink = entry.is_symlink()
+            child_real = os.path.realpath(entry.path) if is_symlink else os.path.join(dir_real, entry.name)
+            if child_real != entry.path:
+                real_paths[entry.path] = child_real
+
+            if is_file:
+                files.add(entry.path)
+            elif is_dir:
+                # A link back to the directory itself or one of its ancestors would never end
+                if is_symlink and (dir_real == child_real or dir_real.startswith(child_real.rstrip(os.sep) + os.sep)):
+                    logger.warning(f"Walk: Not following symlink loop {entry.path} -> {child_real}")
+                    continue
+                stack.append((entry.path, child_real))
+
+    return SelectionWalk(
+        structure_paths=[Path(p) for p in sorted(structure, key=_path_sort_key)],
+        files=[Path(p) for p in sorted(files, key=_path_sort_key)],
+        real_paths=real_paths,
+        directories=sorted(walked_dirs),
+    )
@@ -0,0 +1,131 @@
+# treeb/treeb/warm.py
+
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from treeb.pipeline import Cancelled
+
+logger = logging.getLogger(__name__)
+
+# How often the outputs of warm presets are checked (by mtime) and rebuilt where their files changed
+DEFAULT_WARM_INTERVAL_SECONDS = 30.0
+
+PENDING, WARMING, FRESH, FAILED = "pending", "warming", "fresh", "failed"
+
+
+class WarmStatus:
+    """How up to date the stored output of one warm preset is. Updated by the warmer's thread, read by any."""
+
+    def __init__(self):
+        self.state = PENDING  # Not checked yet (or changed since), then "warming" while a check runs
+        self.checked: Optional[float] = None  # time.time() of the last check that completed
+        self.rebuilt: Optional[float] = None  # ... and of the last one that found changes
+        self.files = 0
+        self.tokens = 0
+        self.elapsed_ms = 0.0
+        self.error: Optional[str] = None
+
+    def to_json(self) -> dict:
+        now = time.time()
+        data = {
+            "state": self.state,
+            "checked_seconds_ago": round(now - self.checked, 1) if self.checked is not None else None,
+            "rebuilt_seconds_ago": round(now - self.rebuilt, 1) if self.rebuilt is not None else None,
+            "files": self.files,
+            "tokens": self.tokens,
+            "elapsed_ms": self.elapsed_ms,
+        }
+        if self.error is not None:
+            data["error"] = self.error
+        return data
+
+
+class PresetWarmer:
+    """Keeps the outputs of warm selection presets up to date on a daemon thread.
+
+    Every `interval` seconds, or at once after wake(), each preset id that warm_ids() returns is passed to
+    warm(preset_id, cancel), which brings its stored output up to date and returns {"rebuilt": ...,
+    "files": ..., "tokens": ...}. Presets are warmed one at a time; stop() cancels the one being warmed.
+    """
+
+    def __init__(
+        self,
+        warm_ids: Callable[[], List[str]],
+        warm: Callable[[str, threading.Event], dict],
+        interval: float = DEFAULT_WARM_INTERVAL_SECONDS,
+    ):
+        self.warm_ids = warm_ids
+        self.warm = warm
+        self.interval = interval
+        self._statuses: Dict[str, WarmStatus] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._cancel = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "PresetWarmer":
+        with self._lock:
+            if self._thread is None:
+                self._cancel.clear()
+                self._thread = threading.Thread(target=self._run, name="treeb-preset-warmer", daemon=True)
+                self._thread.start()
+        return self
+
+    def wake(self, preset_id: Optional[str] = None):
+        """Check the warm presets now rather than at the next interval; `preset_id` (just saved) is pending."""
+        if preset_id is not None:
+            with self._lock:
+                self._statuses.setdefault(preset_id, WarmStatus()).state = PENDING
+        self._wake.set()
+
+    def stop(self):
+        self._cancel.set()
+        self._wake.set()
+
+    def status(self, preset_id: str) -> Optional[WarmStatus]:
+        with self._lock:
+            return self._statuses.get(preset_id)
+
+    def _run(self):
+        while not self._cancel.is_set():
+            self._wake.clear()  # Wakes during the pass below make for another one right after it
+            try:
+                preset_ids = self.warm_ids()
+            except Exception as e:
+                logger.error(f"Could not list the warm presets: {e}")
+                preset_ids = []
+            with self._lock:
+                self._statuses = {pid: self._statuses.get(pid) or WarmStatus() for pid in preset_ids}
+            for preset_id in preset_ids:
+                if self._cancel.is_set():
+                    break
+                self._warm_one(preset_id)
+            self._wake.wait(self.interval)
+        with self._lock:
+            self._thread = None
+
+    def _warm_one(self, preset_id: str):
+        status = self.status(preset_id)
+        if status is None:
+            return
+        status.state = WARMING
+        started = time.perf_counter()
+        try:
+            warmed = self.warm(preset_id, self._cancel)
+        except Cancelled:
+            status.state = PENDING
+            return
+        except Exception as e:
+            logger.error(f"Warming preset {preset_id} failed: {e}")
+            status.error = str(e)
+            status.state = FAILED
+            return
+        status.elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+        status.checked = time.time()
+        if warmed.get("rebuilt"):
+            status.rebuilt = status.checked
+            logger.info(f"Warm preset {preset_id}: rebuilt in {status.elapsed_ms:.0f} ms")
+        status.files, status.tokens, status.error = warmed.get("files", 0), warmed.get("tokens", 0), None
+        status.state = FRESH